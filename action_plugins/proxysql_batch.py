@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from ansible.errors import AnsibleError
+from ansible.parsing.mod_args import ModuleArgsParser
+from ansible.plugins.action import ActionBase
+from ansible.template import Templar
+
+try:
+    from ansible.plugins.loader import lookup_loader
+except ImportError:
+    from ansible.plugins import lookup_loader
+
+# Results of a folded loop waiting to be handed back to the remaining loop
+# items, keyed by task and host.  Every item of a loop runs in the same
+# worker process, so they're picked up by the following runs of the action,
+# and each one is only handed back to an item running with the arguments it
+# was worked out for.
+_batch_results = {}
+
+# ===========================================
+# proxysql batch action.
+#
+# A with_items or loop loop over a proxysql module normally runs the module
+# once for each item.  On the first item this action works out the arguments
+# of every item in the loop, and when only the per-entry options differ
+# between them it runs the module once with the entries in its list option.
+# The result for each entry, along with its diff, is then returned as the
+# result of the matching loop item, so registered results look the same as
+# when the items are run one by one.
+#
+# The loop is run item by item as usual whenever it can't be folded exactly:
+# loops using other lookups or extended loop vars, items whose shared
+# options differ, duplicate items, or a module run which fails.  A failing
+# item then fails on its own, as it would without the action.
+#
+# Modules opt in with a small action plugin that subclasses this one, naming
+# the list option and the keys which make up an entry.
+#
+
+
+class ActionModule(ActionBase):
+
+    BATCH_PARAM = None
+    ENTRY_KEYS = ()
+    UNBATCHED_PARAMS = ()
+
+    def get_templar(self, variables):
+        return Templar(loader=self._loader, variables=variables)
+
+    def get_loop_items(self, task_vars):
+        # with_<lookup> is held in loop_with from 2.5, and in loop along with
+        # its terms in loop_args before that
+        if hasattr(self._task, "loop_with"):
+            loop_with = self._task.loop_with
+            loop_terms = self._task.loop
+        else:
+            loop_with = self._task.loop
+            loop_terms = getattr(self._task, "loop_args", None)
+
+        templar = self.get_templar(task_vars)
+        if loop_with == "items":
+            loop_terms = templar.template(loop_terms)
+            if not isinstance(loop_terms, list):
+                loop_terms = [loop_terms]
+            items_lookup = lookup_loader.get("items",
+                                             loader=self._loader,
+                                             templar=templar)
+            return items_lookup.run(terms=loop_terms, variables=task_vars)
+        elif loop_with is None and loop_terms is not None:
+            items = templar.template(loop_terms)
+            if isinstance(items, list):
+                return items
+        return None
+
+    def get_item_args(self, task_vars):
+        loop_control = self._task.loop_control
+        loop_var = "item"
+        index_var = None
+        if loop_control:
+            loop_var = loop_control.loop_var or loop_var
+            index_var = getattr(loop_control, "index_var", None)
+
+        if "ansible_loop" in task_vars:
+            return None
+
+        items = self.get_loop_items(task_vars)
+        if not items or task_vars.get(loop_var) != items[0]:
+            return None
+
+        raw_args = ModuleArgsParser(task_ds=self._task.get_ds()).parse()[1]
+        omit_token = task_vars.get("omit")
+
+        item_args = []
+        for index, item in enumerate(items):
+            item_vars = dict(task_vars)
+            item_vars[loop_var] = item
+            if index_var:
+                item_vars[index_var] = index
+
+            templar = self.get_templar(item_vars)
+            if not self._task.evaluate_conditional(templar, item_vars):
+                continue
+
+            args = templar.template(raw_args)
+            item_args.append(dict((k, v) for k, v in args.items()
+                                  if v != omit_token))
+
+        # only fold the loop when the arguments worked out for the first item
+        # match the ones the task is actually running with
+        if not item_args or item_args[0] != self._task.args:
+            return None
+        return item_args
+
+    def get_batch_args(self, item_args):
+        if self.BATCH_PARAM in item_args[0] or \
+                any(item_args[0].get(param)
+                    for param in self.UNBATCHED_PARAMS):
+            return None
+
+        shared_args = dict((k, v) for k, v in item_args[0].items()
+                           if k not in self.ENTRY_KEYS)
+
+        entries = []
+        entry_keys = set()
+        for args in item_args:
+            if dict((k, v) for k, v in args.items()
+                    if k not in self.ENTRY_KEYS) != shared_args:
+                return None
+
+            entry = dict((k, v) for k, v in args.items()
+                         if k in self.ENTRY_KEYS)
+            entry_key = json.dumps(entry, sort_keys=True, default=str)
+            if entry_key in entry_keys:
+                return None
+            entry_keys.add(entry_key)
+            entries.append(entry)
+
+        batch_args = dict(shared_args)
+        batch_args[self.BATCH_PARAM] = entries
+        return batch_args
+
+    def get_item_results(self, module_result, item_count):
+        entry_results = module_result.get(self.BATCH_PARAM)
+        if module_result.get("failed") or \
+                not isinstance(entry_results, list) or \
+                len(entry_results) != item_count:
+            return None
+
+        # the module's own invocation has any no_log values masked, which the
+        # per-item task args don't
+        item_results = []
+        for entry_result in entry_results:
+            item_result = dict(entry_result)
+            item_result["state"] = module_result.get("state")
+            if "invocation" in module_result:
+                item_result["invocation"] = module_result["invocation"]
+            item_results.append(item_result)
+        return item_results
+
+    def get_batch_key(self, task_vars):
+        return (self._task.get_path(),
+                self._task.get_name(),
+                task_vars.get("inventory_hostname"))
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        batch_key = self.get_batch_key(task_vars)
+        pending = _batch_results.pop(batch_key, None)
+        if pending:
+            item_args, item_result = pending.pop(0)
+            if item_args == self._task.args:
+                if pending:
+                    _batch_results[batch_key] = pending
+                result.update(item_result)
+                return result
+
+        batch_args = None
+        item_args = None
+        if self._task.loop:
+            try:
+                item_args = self.get_item_args(task_vars)
+            except AnsibleError:
+                item_args = None
+            if item_args is not None and len(item_args) > 1:
+                batch_args = self.get_batch_args(item_args)
+
+        item_results = None
+        if batch_args is not None:
+            module_result = self._execute_module(module_args=batch_args,
+                                                 task_vars=task_vars)
+            item_results = self.get_item_results(module_result,
+                                                 len(item_args))
+
+        if item_results is None:
+            result.update(self._execute_module(task_vars=task_vars))
+            return result
+
+        result.update(item_results[0])
+        _batch_results[batch_key] = list(zip(item_args[1:],
+                                             item_results[1:]))
+        return result
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+try:
+    from ansible.plugins import action_loader
+except ImportError:
+    from ansible.plugins.loader import action_loader
+
+ProxySQLBatchAction = action_loader.get("proxysql_batch", class_only=True)
+
+
+class ActionModule(ProxySQLBatchAction):
+
+    BATCH_PARAM = "users"
+    ENTRY_KEYS = ("username",
+                  "password",
+                  "active",
+                  "use_ssl",
+                  "default_hostgroup",
+                  "default_schema",
+                  "transaction_persistent",
+                  "fast_forward",
+                  "backend",
+                  "frontend",
+                  "max_connections")
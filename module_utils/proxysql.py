@@ -0,0 +1,1268 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import json
+import numbers
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from collections import deque
+
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    mysqldb_found = False
+else:
+    mysqldb_found = True
+
+from ansible.module_utils.mysql import mysql_connect
+from ansible.module_utils.proxysql_broker import broker_connect
+
+BATCH_SIZE = 50
+
+DEFERRED_CONFIG_DIR = "~/.ansible/proxysql"
+
+# Config sections in the order they should be loaded, so that servers exist
+# before the users and query rules that route to their hostgroups.
+CONFIG_SETTINGS_ORDER = ["MYSQL VARIABLES",
+                         "ADMIN VARIABLES",
+                         "MYSQL SERVERS",
+                         "MYSQL USERS",
+                         "MYSQL QUERY RULES",
+                         "SCHEDULER",
+                         "PROXYSQL SERVERS"]
+
+# Names the config sections are checksummed under in runtime_checksums_values
+# and stats_proxysql_servers_checksums.  The scheduler isn't synced between
+# ProxySQL Cluster nodes, so it has no checksum.
+CLUSTER_CHECKSUM_NAMES = {"MYSQL VARIABLES": "mysql_variables",
+                          "ADMIN VARIABLES": "admin_variables",
+                          "MYSQL SERVERS": "mysql_servers",
+                          "MYSQL USERS": "mysql_users",
+                          "MYSQL QUERY RULES": "mysql_query_rules",
+                          "PROXYSQL SERVERS": "proxysql_servers"}
+
+CLUSTER_SYNC_POLL_INTERVAL = 1
+
+# ===========================================
+# proxysql table descriptors.
+#
+# Each descriptor lists the primary key, the columns (with the type used to
+# coerce values supplied by the user) and the config settings used to save
+# and load the table between the config layers.
+#
+
+
+class ProxySQLTable(object):
+
+    def __init__(self, name, primary_key, columns, config_settings):
+        self.name = name
+        self.primary_key = primary_key
+        self.columns = [col for col, col_type in columns]
+        self.column_types = dict(columns)
+        self.config_settings = config_settings
+
+    def get_key(self, row):
+        return tuple(normalise_value(row[col]) for col in self.primary_key)
+
+    def coerce_value(self, module, col, val):
+        if val is None:
+            return None
+        if self.column_types[col] == 'int':
+            return int(val)
+        elif self.column_types[col] == 'bool':
+            return module.boolean(val)
+        else:
+            return str(val)
+
+
+MYSQL_SERVERS = \
+    ProxySQLTable("mysql_servers",
+                  ["hostgroup_id", "hostname", "port"],
+                  [("hostgroup_id", 'int'),
+                   ("hostname", 'str'),
+                   ("port", 'int'),
+                   ("status", 'str'),
+                   ("weight", 'int'),
+                   ("compression", 'int'),
+                   ("max_connections", 'int'),
+                   ("max_replication_lag", 'int'),
+                   ("use_ssl", 'bool'),
+                   ("max_latency_ms", 'int'),
+                   ("comment", 'str')],
+                  "MYSQL SERVERS")
+
+MYSQL_USERS = \
+    ProxySQLTable("mysql_users",
+                  ["username", "backend", "frontend"],
+                  [("username", 'str'),
+                   ("password", 'str'),
+                   ("active", 'bool'),
+                   ("use_ssl", 'bool'),
+                   ("default_hostgroup", 'int'),
+                   ("default_schema", 'str'),
+                   ("transaction_persistent", 'bool'),
+                   ("fast_forward", 'bool'),
+                   ("backend", 'bool'),
+                   ("frontend", 'bool'),
+                   ("max_connections", 'int')],
+                  "MYSQL USERS")
+
+MYSQL_QUERY_RULES = \
+    ProxySQLTable("mysql_query_rules",
+                  ["rule_id"],
+                  [("rule_id", 'int'),
+                   ("active", 'bool'),
+                   ("username", 'str'),
+                   ("schemaname", 'str'),
+                   ("flagIN", 'int'),
+                   ("client_addr", 'str'),
+                   ("proxy_addr", 'str'),
+                   ("proxy_port", 'int'),
+                   ("digest", 'str'),
+                   ("match_digest", 'str'),
+                   ("match_pattern", 'str'),
+                   ("negate_match_pattern", 'bool'),
+                   ("flagOUT", 'int'),
+                   ("replace_pattern", 'str'),
+                   ("destination_hostgroup", 'int'),
+                   ("cache_ttl", 'int'),
+                   ("timeout", 'int'),
+                   ("retries", 'int'),
+                   ("delay", 'int'),
+                   ("mirror_flagOUT", 'int'),
+                   ("mirror_hostgroup", 'int'),
+                   ("error_msg", 'str'),
+                   ("log", 'bool'),
+                   ("apply", 'bool'),
+                   ("comment", 'str')],
+                  "MYSQL QUERY RULES")
+
+MYSQL_QUERY_RULES_FAST_ROUTING = \
+    ProxySQLTable("mysql_query_rules_fast_routing",
+                  ["username", "schemaname", "flagIN"],
+                  [("username", 'str'),
+                   ("schemaname", 'str'),
+                   ("flagIN", 'int'),
+                   ("destination_hostgroup", 'int'),
+                   ("comment", 'str')],
+                  "MYSQL QUERY RULES")
+
+MYSQL_REPLICATION_HOSTGROUPS = \
+    ProxySQLTable("mysql_replication_hostgroups",
+                  ["writer_hostgroup", "reader_hostgroup"],
+                  [("writer_hostgroup", 'int'),
+                   ("reader_hostgroup", 'int'),
+                   ("comment", 'str')],
+                  "MYSQL SERVERS")
+
+SCHEDULER = \
+    ProxySQLTable("scheduler",
+                  ["id"],
+                  [("id", 'int'),
+                   ("active", 'bool'),
+                   ("interval_ms", 'int'),
+                   ("filename", 'str'),
+                   ("arg1", 'str'),
+                   ("arg2", 'str'),
+                   ("arg3", 'str'),
+                   ("arg4", 'str'),
+                   ("arg5", 'str'),
+                   ("comment", 'str')],
+                  "SCHEDULER")
+
+PROXYSQL_SERVERS = \
+    ProxySQLTable("proxysql_servers",
+                  ["hostname", "port"],
+                  [("hostname", 'str'),
+                   ("port", 'int'),
+                   ("weight", 'int'),
+                   ("comment", 'str')],
+                  "PROXYSQL SERVERS")
+
+GLOBAL_VARIABLES = \
+    ProxySQLTable("global_variables",
+                  ["variable_name"],
+                  [("variable_name", 'str'),
+                   ("variable_value", 'str')],
+                  None)
+
+
+CONFIG_SETTINGS_TABLES = {
+    "MYSQL USERS": [MYSQL_USERS],
+    "MYSQL SERVERS": [MYSQL_SERVERS, MYSQL_REPLICATION_HOSTGROUPS],
+    "MYSQL QUERY RULES": [MYSQL_QUERY_RULES,
+                          MYSQL_QUERY_RULES_FAST_ROUTING],
+    "MYSQL VARIABLES": [GLOBAL_VARIABLES],
+    "ADMIN VARIABLES": [GLOBAL_VARIABLES],
+    "SCHEDULER": [SCHEDULER],
+    "PROXYSQL SERVERS": [PROXYSQL_SERVERS]
+}
+
+
+def get_variable_config_settings(variable):
+    if variable.startswith("admin"):
+        return "ADMIN VARIABLES"
+    else:
+        return "MYSQL VARIABLES"
+
+# ===========================================
+# proxysql shared module support methods.
+#
+
+
+def proxysql_common_argument_spec():
+    return dict(
+        login_user=dict(default=None, type='str'),
+        login_password=dict(default=None, no_log=True, type='str'),
+        login_host=dict(default="127.0.0.1"),
+        login_unix_socket=dict(default=None),
+        login_port=dict(default=6032, type='int'),
+        config_file=dict(default="", type='path'),
+        connection_broker=dict(default=False, type='bool'),
+        login_hosts=dict(default=None, type='list'),
+        login_hosts_concurrency=dict(default=10, type='int'),
+        login_hosts_fail_fast=dict(default=False, type='bool'),
+        cluster_apply=dict(default=False, type='bool'),
+        cluster_apply_timeout=dict(default=60, type='int'),
+        snapshot=dict(default=None, type='dict'),
+        snapshot_file=dict(default=None, type='path')
+    )
+
+
+def perform_common_checks(module):
+    if module.params["login_port"] < 0 \
+       or module.params["login_port"] > 65535:
+        module.fail_json(
+            msg="login_port must be a valid unix port number (0-65535)"
+        )
+
+    if module.params.get("login_hosts") is not None:
+        if module.params["login_unix_socket"]:
+            module.fail_json(
+                msg="login_hosts can't be used with login_unix_socket"
+            )
+
+        if module.params["login_hosts_concurrency"] < 1:
+            module.fail_json(
+                msg="login_hosts_concurrency must be at least 1"
+            )
+
+        get_login_hosts(module)
+
+    if module.params.get("snapshot") is not None and \
+            module.params.get("snapshot_file") is not None:
+        module.fail_json(
+            msg="snapshot and snapshot_file are mutually exclusive"
+        )
+
+    if (module.params.get("snapshot") is not None or
+            module.params.get("snapshot_file") is not None) and \
+            module.params.get("login_hosts") is not None:
+        module.fail_json(
+            msg=("a snapshot is of a single admin interface, it can't be" +
+                 " used with login_hosts")
+        )
+
+    if module.params.get("cluster_apply"):
+        if module.params.get("login_hosts") is not None:
+            module.fail_json(
+                msg=("cluster_apply makes the change on a single node, it" +
+                     " can't be used with login_hosts")
+            )
+
+        if module.params["cluster_apply_timeout"] < 0:
+            module.fail_json(
+                msg="cluster_apply_timeout must be 0 or more seconds"
+            )
+
+        if "load_to_runtime" in module.params and \
+                not isinstance(get_config_mode(module, "load_to_runtime"),
+                               ProxySQLClusterApply):
+            module.fail_json(
+                msg=("cluster_apply needs load_to_runtime, to apply deferred" +
+                     " changes across the cluster set cluster_apply on the" +
+                     " proxysql_flush_config task")
+            )
+
+    if not mysqldb_found:
+        module.fail_json(
+            msg="the python mysqldb module is required"
+        )
+
+
+def proxysql_connect(module):
+    cursor = None
+
+    if module.check_mode:
+        snapshot = load_snapshot(module)
+        if snapshot is not None:
+            return ProxySQLSnapshotCursor(snapshot)
+
+    if module.params["connection_broker"]:
+        try:
+            cursor = broker_connect(module)
+        except MySQLdb.Error:
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to connect to ProxySQL Admin Module.. %s" % e
+            )
+        except (IOError, OSError, socket.error):
+            cursor = None
+
+        # fall back to connecting directly when the broker can't be started
+        if cursor is not None:
+            return cursor
+
+    try:
+        cursor = mysql_connect(module,
+                               module.params["login_user"],
+                               module.params["login_password"],
+                               module.params["config_file"],
+                               cursor_class=MySQLdb.cursors.DictCursor)
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to connect to ProxySQL Admin Module.. %s" % e
+        )
+
+    return cursor
+
+
+def get_entry_params(module, table, entry, entry_keys, list_name):
+    if not isinstance(entry, dict):
+        module.fail_json(
+            msg="each entry in %s must be a dict, got %s" % (list_name, entry)
+        )
+
+    unsupported_keys = [k for k in entry if k not in entry_keys]
+    if unsupported_keys:
+        module.fail_json(
+            msg=("unsupported keys in %s entry: %s" %
+                 (list_name, ", ".join(sorted(unsupported_keys))))
+        )
+
+    entry_params = dict((k, module.params[k]) for k in entry_keys)
+
+    for key, val in entry.items():
+        try:
+            entry_params[key] = table.coerce_value(module, key, val)
+        except (TypeError, ValueError):
+            module.fail_json(
+                msg=("%s in %s entry must be of type %s" %
+                     (key, list_name, table.column_types[key]))
+            )
+
+    return entry_params
+
+
+def get_config_mode(module, param):
+    if str(module.params[param]).lower() == "deferred":
+        return "deferred"
+
+    config_mode = module.boolean(module.params[param])
+    if param == "load_to_runtime" and config_mode and \
+            module.params["cluster_apply"]:
+        return get_cluster_apply(module)
+    else:
+        return config_mode
+
+
+def save_config_to_disk(cursor, config_settings):
+    cursor.execute("SAVE %s TO DISK" % config_settings)
+    return True
+
+
+def load_config_to_runtime(cursor, config_settings):
+    cursor.execute("LOAD %s TO RUNTIME" % config_settings)
+    return True
+
+
+def save_and_load_config(cursor, config_settings, save_to_disk,
+                         load_to_runtime, deferred_file=None):
+    deferred_actions = []
+
+    if save_to_disk == "deferred":
+        deferred_actions.append("SAVE")
+    elif save_to_disk:
+        save_config_to_disk(cursor, config_settings)
+
+    if load_to_runtime == "deferred":
+        deferred_actions.append("LOAD")
+    elif load_to_runtime:
+        load_config_to_runtime(cursor, config_settings)
+        if isinstance(load_to_runtime, ProxySQLClusterApply):
+            wait_for_cluster_sync(cursor,
+                                  config_settings,
+                                  load_to_runtime.timeout)
+
+    if deferred_actions:
+        defer_config(deferred_file, config_settings, deferred_actions)
+
+# ===========================================
+# proxysql login hosts fan-out.
+#
+# With login_hosts set, a module's run is repeated against each admin
+# interface in the list from a pool of threads.  Each run gets a stand-in for
+# the AnsibleModule with the login host and port swapped in, whose exit_json
+# and fail_json end that host's run instead of the process, and the results
+# are returned per login host.
+#
+
+
+class ProxySQLLoginHostExit(Exception):
+
+    def __init__(self, result):
+        Exception.__init__(self, result.get("msg"))
+        self.result = result
+
+
+class ProxySQLLoginHostModule(object):
+
+    def __init__(self, module, login_params):
+        self.module = module
+        self.params = dict(module.params)
+        self.params.update(login_params)
+        self.params["login_hosts"] = None
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def exit_json(self, **kwargs):
+        kwargs.setdefault("changed", False)
+        raise ProxySQLLoginHostExit(kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs.setdefault("changed", False)
+        kwargs["failed"] = True
+        raise ProxySQLLoginHostExit(kwargs)
+
+
+def get_login_hosts(module):
+    login_hosts = []
+
+    for login_host in module.params["login_hosts"]:
+        login_host = str(login_host).strip()
+
+        # host, host:port or [ipv6 address]:port
+        if login_host.startswith("["):
+            host, sep, port = login_host[1:].partition("]")
+            port = port[1:] if port.startswith(":") else port
+        elif login_host.count(":") == 1:
+            host, port = login_host.split(":")
+        else:
+            host, port = login_host, ""
+
+        try:
+            port = int(port) if port else module.params["login_port"]
+        except ValueError:
+            port = -1
+
+        if not host or port < 0 or port > 65535:
+            module.fail_json(
+                msg=("each entry in login_hosts must be a host or host:port," +
+                     " got %s") % login_host
+            )
+
+        login_params = {"login_host": host,
+                        "login_port": port,
+                        "login_unix_socket": None}
+        if login_params in login_hosts:
+            module.fail_json(
+                msg="The login host %s:%d appears more than once" % (host,
+                                                                     port)
+            )
+        login_hosts.append(login_params)
+
+    return login_hosts
+
+
+def run_on_login_host(module, run_module, login_params):
+    start_time = time.time()
+
+    try:
+        run_module(ProxySQLLoginHostModule(module, login_params))
+        login_host_result = {"changed": False}
+    except ProxySQLLoginHostExit:
+        login_host_result = sys.exc_info()[1].result
+    except Exception:
+        e = sys.exc_info()[1]
+        login_host_result = {"changed": False,
+                             "failed": True,
+                             "msg": "unexpected error.. %s" % e}
+
+    login_host_result['elapsed'] = round(time.time() - start_time, 4)
+    return login_host_result
+
+
+def get_login_hosts_diff(login_host_results):
+    login_hosts_diff = []
+
+    for login_host_result in login_host_results:
+        diffs = login_host_result.get('diff') or []
+        if not isinstance(diffs, list):
+            diffs = [diffs]
+
+        header = "%s:%d" % (login_host_result['login_host'],
+                            login_host_result['login_port'])
+        for diff in diffs:
+            diff = dict(diff)
+            diff.setdefault('before_header', header)
+            diff.setdefault('after_header', header)
+            login_hosts_diff.append(diff)
+
+    return login_hosts_diff
+
+
+def run_in_threads(func, items, concurrency):
+    pending = deque(enumerate(items))
+    results = [None] * len(items)
+
+    def run_pending():
+        while True:
+            try:
+                index, item = pending.popleft()
+            except IndexError:
+                return
+            results[index] = func(item)
+
+    threads = [threading.Thread(target=run_pending)
+               for i in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def run_on_login_hosts(module, run_module):
+    login_hosts = get_login_hosts(module)
+    stopped = threading.Event()
+
+    def run_login_host(login_params):
+        if stopped.is_set():
+            login_host_result = {"changed": False,
+                                 "skipped": True,
+                                 "msg": ("Skipped after a failure on" +
+                                         " another login host")}
+        else:
+            login_host_result = run_on_login_host(module,
+                                                  run_module,
+                                                  login_params)
+            if login_host_result.get("failed") and \
+                    module.params["login_hosts_fail_fast"]:
+                stopped.set()
+
+        login_host_result['login_host'] = login_params['login_host']
+        login_host_result['login_port'] = login_params['login_port']
+        return login_host_result
+
+    login_host_results = \
+        run_in_threads(run_login_host,
+                       login_hosts,
+                       module.params["login_hosts_concurrency"])
+
+    result = {}
+    result['changed'] = any(login_host_result['changed']
+                            for login_host_result in login_host_results)
+    result['login_hosts'] = login_host_results
+    result['diff'] = get_login_hosts_diff(login_host_results)
+
+    failed = ["%s:%d" % (login_host_result['login_host'],
+                         login_host_result['login_port'])
+              for login_host_result in login_host_results
+              if login_host_result.get("failed")]
+    if failed:
+        result['msg'] = ("Failed on %d of %d login hosts: %s" %
+                         (len(failed), len(login_hosts), ", ".join(failed)))
+        module.fail_json(**result)
+
+    changed = [login_host_result for login_host_result in login_host_results
+               if login_host_result['changed']]
+    if not module.check_mode:
+        result['msg'] = ("Changed %d of %d login hosts" %
+                         (len(changed), len(login_hosts)))
+    else:
+        result['msg'] = ("%d of %d login hosts would have been changed," +
+                         " however check_mode is enabled.") % \
+            (len(changed), len(login_hosts))
+
+    module.exit_json(**result)
+
+# ===========================================
+# proxysql cluster apply.
+#
+# With cluster_apply set, a change is made on the one node the module
+# connects to and ProxySQL Cluster propagates it to the other nodes.  After
+# loading a config section to runtime the module waits until every peer in
+# stats_proxysql_servers_checksums reports the same checksum for the section
+# as this node's runtime_checksums_values, so the task only finishes once the
+# whole cluster is running the change.
+#
+
+
+class ClusterSyncError(Exception):
+    pass
+
+
+class ProxySQLClusterApply(object):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+
+def get_cluster_apply(module):
+    if module.params["cluster_apply"]:
+        return ProxySQLClusterApply(module.params["cluster_apply_timeout"])
+    else:
+        return None
+
+
+def get_runtime_checksum(cursor, checksum_name):
+    query_string = \
+        """SELECT checksum
+           FROM runtime_checksums_values
+           WHERE name = %s"""
+
+    cursor.execute(query_string, [checksum_name])
+    row = cursor.fetchone()
+    return row["checksum"] if row else None
+
+
+def get_peer_checksums(cursor, checksum_name):
+    query_string = \
+        """SELECT hostname, port, checksum
+           FROM stats_proxysql_servers_checksums
+           WHERE name = %s"""
+
+    cursor.execute(query_string, [checksum_name])
+    return cursor.fetchall()
+
+
+def wait_for_cluster_sync(cursor, config_settings, timeout):
+    checksum_name = CLUSTER_CHECKSUM_NAMES.get(config_settings)
+    if checksum_name is None:
+        return True
+
+    checksum = get_runtime_checksum(cursor, checksum_name)
+    deadline = time.time() + timeout
+
+    while True:
+        lagging_peers = ["%s:%s" % (peer["hostname"], peer["port"])
+                         for peer in get_peer_checksums(cursor, checksum_name)
+                         if peer["checksum"] != checksum]
+        if not lagging_peers:
+            return True
+
+        if time.time() >= deadline:
+            raise ClusterSyncError(
+                ("%s wasn't synced to %s within %d seconds of loading it" +
+                 " to runtime") % (config_settings,
+                                   ", ".join(sorted(lagging_peers)),
+                                   timeout))
+
+        time.sleep(CLUSTER_SYNC_POLL_INTERVAL)
+
+# ===========================================
+# proxysql deferred config.
+#
+# Changes made with save_to_disk or load_to_runtime set to "deferred" only
+# record the config section against the admin interface in a local state
+# file.  proxysql_flush_config then issues each pending SAVE / LOAD once,
+# however many tasks marked the section dirty.
+#
+
+
+def get_deferred_config_file(module):
+    if module.params["login_unix_socket"]:
+        target = module.params["login_unix_socket"].strip("/")
+    else:
+        target = "%s_%s" % (module.params["login_host"],
+                            module.params["login_port"])
+
+    return os.path.join(os.path.expanduser(DEFERRED_CONFIG_DIR),
+                        "%s.deferred" % target.replace("/", "_"))
+
+
+def lock_deferred_config(deferred_file):
+    deferred_dir = os.path.dirname(deferred_file)
+    if not os.path.isdir(deferred_dir):
+        os.makedirs(deferred_dir, 0o700)
+
+    lock_file = open(deferred_file + ".lock", "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def read_deferred_config(deferred_file):
+    if not os.path.exists(deferred_file):
+        return {}
+
+    with open(deferred_file) as f:
+        return json.load(f)
+
+
+def write_deferred_config(deferred_file, deferred_config):
+    if not deferred_config:
+        if os.path.exists(deferred_file):
+            os.remove(deferred_file)
+        return
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(deferred_file))
+    with os.fdopen(fd, "w") as f:
+        json.dump(deferred_config, f, sort_keys=True)
+    os.rename(tmp_file, deferred_file)
+
+
+def defer_config(deferred_file, config_settings, actions):
+    lock_file = lock_deferred_config(deferred_file)
+    try:
+        deferred_config = read_deferred_config(deferred_file)
+        deferred_config[config_settings] = \
+            sorted(set(deferred_config.get(config_settings, [])) |
+                   set(actions))
+        write_deferred_config(deferred_file, deferred_config)
+    finally:
+        lock_file.close()
+
+
+def get_deferred_statements(deferred_config):
+    statements = []
+    for config_settings in CONFIG_SETTINGS_ORDER:
+        actions = deferred_config.get(config_settings, [])
+        if "SAVE" in actions:
+            statements.append("SAVE %s TO DISK" % config_settings)
+        if "LOAD" in actions:
+            statements.append("LOAD %s TO RUNTIME" % config_settings)
+    return statements
+
+# ===========================================
+# proxysql config layers.
+#
+# The tables for a config section are read from two layers and compared
+# row by row, so LOAD / SAVE statements which wouldn't change anything can be
+# skipped.  The runtime layer doesn't hold exactly what was loaded into it:
+# users are split into separate frontend and backend rows, passwords may be
+# hashed and the monitor may have shunned servers, so rows from every layer
+# are normalised the same way before comparing.
+#
+
+
+def get_layer_table(table_name, config_layer):
+    if config_layer == "RUNTIME":
+        return "runtime_" + table_name
+    elif config_layer == "DISK":
+        return "disk." + table_name
+    else:
+        return "main." + table_name
+
+
+def get_mysql_password_hash(password):
+    if password is None or password == "" or \
+            (password.startswith("*") and len(password) == 41):
+        return password
+
+    password_hash = hashlib.sha1(hashlib.sha1(
+        password.encode("utf-8")).digest()).hexdigest()
+    return "*" + password_hash.upper()
+
+
+def normalise_layer_rows(table, rows):
+    normalised_rows = []
+
+    for row in rows:
+        row = dict((col, normalise_value(val)) for col, val in row.items())
+
+        if table is MYSQL_USERS:
+            if "password" in row:
+                row["password"] = get_mysql_password_hash(row["password"])
+            if row["frontend"] == "1" and row["backend"] == "1":
+                frontend_row = dict(row, backend="0")
+                backend_row = dict(row, frontend="0")
+                normalised_rows.extend([frontend_row, backend_row])
+                continue
+
+        elif table is MYSQL_SERVERS:
+            if row["status"] == "SHUNNED":
+                row["status"] = "ONLINE"
+
+        normalised_rows.append(row)
+
+    return normalised_rows
+
+
+def get_layer_rows(cursor, config_settings, table, config_layer):
+    query_string = \
+        ("SELECT *\nFROM " +
+         get_layer_table(table.name, config_layer))
+
+    if isinstance(cursor, ProxySQLSnapshotCursor):
+        rows = cursor.get_rows(table, config_layer)
+        if rows is not None:
+            if table is GLOBAL_VARIABLES:
+                prefix = config_settings.split()[0].lower() + "-"
+                rows = [row for row in rows
+                        if row["variable_name"].startswith(prefix)]
+            return normalise_layer_rows(table, rows)
+
+    if table is GLOBAL_VARIABLES:
+        if config_settings == "ADMIN VARIABLES":
+            query_data = ["admin-%"]
+        else:
+            query_data = ["mysql-%"]
+        query_string += "\nWHERE variable_name LIKE %s"
+        cursor.execute(query_string, query_data)
+    else:
+        cursor.execute(query_string)
+
+    return normalise_layer_rows(table, cursor.fetchall())
+
+
+def config_layers_match(cursor, config_settings, source_layer, target_layer):
+    try:
+        for table in CONFIG_SETTINGS_TABLES[config_settings]:
+            source_rows = get_layer_rows(cursor, config_settings, table,
+                                         source_layer)
+            target_rows = get_layer_rows(cursor, config_settings, table,
+                                         target_layer)
+
+            if len(source_rows) != len(target_rows):
+                return False
+            if not source_rows:
+                continue
+
+            cols = sorted(set(source_rows[0]) & set(target_rows[0]))
+            if set(tuple(row[col] for col in cols)
+                   for row in source_rows) != \
+                    set(tuple(row[col] for col in cols)
+                        for row in target_rows):
+                return False
+    except MySQLdb.Error:
+        return False
+
+    return True
+
+# ===========================================
+# proxysql config snapshot.
+#
+# proxysql_facts reads the memory and runtime layers of the admin tables in
+# one session.  Passing those facts back to a module in check mode as its
+# snapshot option stands in for the cursor, so the module's existence checks
+# and diffs are served from the snapshot and it doesn't connect to the admin
+# interface at all.  A snapshot can be out of date, so outside check mode it's
+# ignored and the module reads the admin interface as usual, rather than
+# making changes based on stale rows.
+#
+# The snapshot can also be read from a snapshot_file, either JSON holding the
+# fact (such as an Ansible jsonfile fact cache entry) or an SQLite database
+# with the memory layer tables under their own names and the runtime layer
+# tables prefixed with runtime_.
+#
+
+SNAPSHOT_TABLES = [MYSQL_SERVERS,
+                   MYSQL_USERS,
+                   MYSQL_QUERY_RULES,
+                   MYSQL_REPLICATION_HOSTGROUPS,
+                   SCHEDULER,
+                   GLOBAL_VARIABLES,
+                   PROXYSQL_SERVERS]
+
+SNAPSHOT_LAYERS = ["MEMORY", "RUNTIME"]
+
+
+class ProxySQLSnapshotCursor(object):
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def get_rows(self, table, config_layer):
+        layer_rows = self.snapshot.get(config_layer.lower()) or {}
+        if table.name not in layer_rows:
+            return None
+        return [dict(row) for row in layer_rows[table.name]]
+
+    def execute(self, query, args=None):
+        raise MySQLdb.OperationalError(
+            ("the snapshot doesn't hold what's needed for \"%s\", and" +
+             " check mode with a snapshot doesn't connect to the admin" +
+             " interface") % " ".join(query.split()))
+
+
+def snapshot_row_matches(row, cols, data):
+    return all(not values_differ(data[col], row.get(col)) for col in cols)
+
+
+def read_sqlite_snapshot(snapshot_file):
+    snapshot = {}
+
+    connection = sqlite3.connect(snapshot_file)
+    try:
+        table_names = set(row[0] for row in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"))
+
+        for config_layer in SNAPSHOT_LAYERS:
+            layer_rows = snapshot.setdefault(config_layer.lower(), {})
+            for table in SNAPSHOT_TABLES:
+                if config_layer == "RUNTIME":
+                    table_name = "runtime_" + table.name
+                else:
+                    table_name = table.name
+                if table_name not in table_names:
+                    continue
+
+                sqlite_cursor = connection.execute("SELECT * FROM " +
+                                                   table_name)
+                cols = [col[0] for col in sqlite_cursor.description]
+                layer_rows[table.name] = \
+                    [dict((col, normalise_value(val))
+                          for col, val in zip(cols, row))
+                     for row in sqlite_cursor.fetchall()]
+    finally:
+        connection.close()
+
+    return snapshot
+
+
+def read_snapshot_file(snapshot_file):
+    with open(snapshot_file, "rb") as f:
+        header = f.read(16)
+
+    if header == b"SQLite format 3\x00":
+        return read_sqlite_snapshot(snapshot_file)
+
+    with open(snapshot_file) as f:
+        snapshot = json.load(f)
+
+    # a fact cache entry holds all the host's facts
+    if isinstance(snapshot, dict) and "proxysql" in snapshot:
+        snapshot = snapshot["proxysql"]
+    return snapshot
+
+
+def load_snapshot(module):
+    if module.params.get("snapshot_file") is not None:
+        try:
+            snapshot = read_snapshot_file(module.params["snapshot_file"])
+        except (IOError, OSError, ValueError, sqlite3.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to read snapshot_file.. %s" % e
+            )
+    else:
+        snapshot = module.params.get("snapshot")
+
+    if snapshot is None:
+        return None
+
+    if not isinstance(snapshot, dict) or \
+            not any(isinstance(snapshot.get(config_layer.lower()), dict)
+                    for config_layer in SNAPSHOT_LAYERS):
+        module.fail_json(
+            msg=("the snapshot must be the proxysql fact gathered by" +
+                 " proxysql_facts")
+        )
+    return snapshot
+
+# ===========================================
+# proxysql row store.
+#
+# All of the SQL sent to the admin interface for a table is built here from
+# the table descriptor.  The statement text only depends on the columns
+# involved, so the templates are cached and reused across rows and batches.
+#
+
+_sql_templates = {}
+
+
+class ProxySQLRowStore(object):
+
+    def __init__(self, cursor, table):
+        self.cursor = cursor
+        self.table = table
+
+    def get_cols(self, data, exclude=()):
+        return [col for col in self.table.columns
+                if col not in exclude and data.get(col) is not None]
+
+    def get_sql_template(self, statement, cols=(), where_cols=(), rows=1):
+        template_key = (self.table.name, statement, tuple(cols),
+                        tuple(where_cols), rows)
+
+        if template_key not in _sql_templates:
+            if statement == "select":
+                query_string = "SELECT *\nFROM " + self.table.name
+            elif statement == "insert":
+                query_string = \
+                    ("INSERT INTO " + self.table.name + " (\n" +
+                     ",\n".join(cols) + ")\nVALUES " +
+                     ",\n       ".join(["(" +
+                                        ", ".join(["%s"] * len(cols)) +
+                                        ")"] * rows))
+            elif statement == "update":
+                query_string = \
+                    ("UPDATE " + self.table.name + "\nSET " +
+                     ",\n    ".join([col + " = %s" for col in cols]))
+            else:
+                query_string = "DELETE FROM " + self.table.name
+
+            if statement == "delete_many":
+                key_condition = \
+                    " AND ".join([col + " = %s" for col in where_cols])
+                query_string += \
+                    ("\nWHERE " +
+                     "\n   OR ".join(["(" + key_condition + ")"] * rows))
+            elif where_cols:
+                query_string += \
+                    ("\nWHERE " +
+                     "\n  AND ".join([col + " = %s" for col in where_cols]))
+
+            _sql_templates[template_key] = query_string
+
+        return _sql_templates[template_key]
+
+    def get_snapshot_rows(self):
+        if isinstance(self.cursor, ProxySQLSnapshotCursor):
+            return self.cursor.get_rows(self.table, "MEMORY")
+        return None
+
+    def select(self, where_data=None):
+        where_cols = self.get_cols(where_data or {})
+
+        snapshot_rows = self.get_snapshot_rows()
+        if snapshot_rows is not None:
+            return [row for row in snapshot_rows
+                    if snapshot_row_matches(row, where_cols, where_data)]
+
+        query_string = self.get_sql_template("select",
+                                             where_cols=where_cols)
+
+        if where_cols:
+            self.cursor.execute(query_string,
+                                [where_data[col] for col in where_cols])
+        else:
+            self.cursor.execute(query_string)
+        return self.cursor.fetchall()
+
+    def select_one(self, key_data):
+        key_cols = self.table.primary_key
+
+        snapshot_rows = self.get_snapshot_rows()
+        if snapshot_rows is not None:
+            for row in snapshot_rows:
+                if snapshot_row_matches(row, key_cols, key_data):
+                    return row
+            return None
+
+        query_string = self.get_sql_template("select",
+                                             where_cols=key_cols)
+
+        self.cursor.execute(query_string,
+                            [key_data[col] for col in key_cols])
+        return self.cursor.fetchone()
+
+    def select_all_by_key(self):
+        return dict((self.table.get_key(row), row) for row in self.select())
+
+    def insert(self, row_data):
+        cols = self.get_cols(row_data)
+        query_string = self.get_sql_template("insert", cols=cols)
+
+        self.cursor.execute(query_string, [row_data[col] for col in cols])
+        return self.cursor.lastrowid
+
+    def insert_many(self, rows):
+        row_groups = {}
+        for row_data in rows:
+            row_groups.setdefault(tuple(self.get_cols(row_data)),
+                                  []).append(row_data)
+
+        for cols, grouped_rows in row_groups.items():
+            for i in range(0, len(grouped_rows), BATCH_SIZE):
+                batch = grouped_rows[i:i + BATCH_SIZE]
+                query_string = self.get_sql_template("insert",
+                                                     cols=cols,
+                                                     rows=len(batch))
+
+                query_data = []
+                for row_data in batch:
+                    query_data.extend([row_data[col] for col in cols])
+
+                self.cursor.execute(query_string, query_data)
+        return True
+
+    def update(self, key_data, config_data):
+        cols = self.get_cols(config_data, exclude=self.table.primary_key)
+        if not cols:
+            return False
+
+        key_cols = self.table.primary_key
+        query_string = self.get_sql_template("update",
+                                             cols=cols,
+                                             where_cols=key_cols)
+
+        query_data = [config_data[col] for col in cols]
+        query_data.extend([key_data[col] for col in key_cols])
+
+        self.cursor.execute(query_string, query_data)
+        return True
+
+    def delete(self, where_data):
+        where_cols = self.get_cols(where_data)
+        query_string = self.get_sql_template("delete",
+                                             where_cols=where_cols)
+
+        if where_cols:
+            self.cursor.execute(query_string,
+                                [where_data[col] for col in where_cols])
+        else:
+            self.cursor.execute(query_string)
+        return int(self.cursor.rowcount)
+
+    def delete_many(self, keys):
+        key_cols = self.table.primary_key
+
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i:i + BATCH_SIZE]
+            query_string = self.get_sql_template("delete_many",
+                                                 where_cols=key_cols,
+                                                 rows=len(batch))
+
+            query_data = []
+            for key in batch:
+                query_data.extend(key)
+
+            self.cursor.execute(query_string, query_data)
+        return True
+
+# ===========================================
+# proxysql shared config diff support.
+#
+# The proxysql admin interface returns every column as a string (or None for
+# NULL), whereas the desired config_data built from the module params holds
+# ints, bools and strings.  The helpers below compare the two in python so a
+# module only needs to read the current row(s) once.
+#
+
+
+def normalise_value(val):
+    if val is None:
+        return None
+    if isinstance(val, bool):
+        return str(int(val))
+    if isinstance(val, float) and val.is_integer():
+        return str(int(val))
+    return str(val)
+
+
+def values_differ(desired, current):
+    if desired is None:
+        return False
+    if current is None:
+        return True
+
+    if isinstance(desired, bool):
+        return str(current).lower() not in (str(int(desired)),
+                                            str(desired).lower())
+
+    if isinstance(desired, numbers.Number):
+        try:
+            return float(desired) != float(current)
+        except (TypeError, ValueError):
+            return True
+
+    return str(desired) != str(current)
+
+
+def get_config_changes(current, config_data, full_row=False):
+    changes = {}
+    for col, val in config_data.items():
+        if full_row and val is None:
+            if current.get(col) is not None:
+                changes[col] = (current.get(col), None)
+        elif values_differ(val, current.get(col)):
+            changes[col] = (current.get(col), normalise_value(val))
+    return changes
+
+
+# ConfigDiff compares the current row (None when the row doesn't exist) with
+# the desired config_data, the resulting action is one of "create", "update",
+# "delete" or None when nothing needs to change.  A None in config_data
+# leaves the column as it is, unless full_row is set, in which case
+# config_data is the whole row and the column has to be NULL.
+#
+
+
+class ConfigDiff(object):
+
+    def __init__(self, current, config_data, state="present",
+                 key_data=None, masked_cols=None, full_row=False):
+        self.current = current
+        self.config_data = config_data
+        self.key_data = key_data or {}
+        self.masked_cols = masked_cols or []
+        self.changes = {}
+        self.action = None
+
+        if state == "present":
+            if not current:
+                self.action = "create"
+                self.changes = \
+                    dict((col, (None, normalise_value(val)))
+                         for col, val in config_data.items()
+                         if val is not None)
+            else:
+                self.changes = get_config_changes(current,
+                                                  config_data,
+                                                  full_row)
+                if self.changes:
+                    self.action = "update"
+        elif current:
+            self.action = "delete"
+
+    @property
+    def changed(self):
+        return self.action is not None
+
+    def mask(self, row):
+        for col in self.masked_cols:
+            if row.get(col) is not None:
+                row[col] = "********"
+        return row
+
+    def get_diff(self):
+        before = self.mask(dict(self.current or {}))
+
+        if self.action == "delete":
+            after = {}
+        else:
+            after = dict(self.current or {})
+            after.update(dict((col, normalise_value(val))
+                              for col, val in self.key_data.items()))
+            after.update(dict((col, change[1])
+                              for col, change in self.changes.items()))
+            after = self.mask(after)
+
+        return {'before': before, 'after': after}
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+try:
+    import MySQLdb
+    import MySQLdb.cursors
+except ImportError:
+    pass
+
+BROKER_SOCKET = "~/.ansible/proxysql/broker.sock"
+BROKER_IDLE_TIMEOUT = 600
+
+# MySQL client error raised when a pooled session has been dropped by the
+# server, the statement never reached it so it's safe to reconnect and retry.
+CR_SERVER_GONE_ERROR = 2006
+
+# MySQL client error raised when the connection drops during a statement.
+CR_SERVER_LOST = 2013
+
+# ===========================================
+# proxysql connection broker.
+#
+# The broker is a small daemon, forked from the first module run which asks
+# for it, that keeps authenticated admin interface sessions open and hands
+# them to later module runs over a unix socket.  Each client sends a login
+# line followed by one JSON line per statement, and gets the rows back as
+# JSON.  A session is checked out of the pool for as long as the client stays
+# connected, and the broker exits once it's been idle for
+# BROKER_IDLE_TIMEOUT seconds.
+#
+
+
+def get_broker_login(module):
+    return {"login_host": module.params["login_host"],
+            "login_port": module.params["login_port"],
+            "login_unix_socket": module.params["login_unix_socket"],
+            "login_user": module.params["login_user"],
+            "login_password": module.params["login_password"],
+            "config_file": module.params["config_file"]}
+
+
+def get_session_key(login):
+    login_password = login["login_password"] or ""
+    return (login["login_host"],
+            login["login_port"],
+            login["login_unix_socket"],
+            login["login_user"],
+            login["config_file"],
+            hashlib.sha1(login_password.encode("utf-8")).hexdigest())
+
+
+def connect_session(login):
+    config = {}
+
+    if login["login_unix_socket"]:
+        config["unix_socket"] = login["login_unix_socket"]
+    else:
+        config["host"] = login["login_host"]
+        config["port"] = login["login_port"]
+
+    config_file = os.path.expanduser(login["config_file"] or "")
+    if config_file and os.path.exists(config_file):
+        config["read_default_file"] = config_file
+
+    if login["login_user"] is not None:
+        config["user"] = login["login_user"]
+    if login["login_password"] is not None:
+        config["passwd"] = login["login_password"]
+
+    config["connect_timeout"] = 30
+
+    return MySQLdb.connect(**config)
+
+
+class ProxySQLSessionPool(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def checkout(self, login):
+        session_key = get_session_key(login)
+
+        with self.lock:
+            idle_sessions = self.sessions.get(session_key, [])
+            if idle_sessions:
+                return idle_sessions.pop()
+
+        return connect_session(login)
+
+    def checkin(self, login, session):
+        with self.lock:
+            self.sessions.setdefault(get_session_key(login),
+                                     []).append(session)
+
+    def close(self):
+        with self.lock:
+            for idle_sessions in self.sessions.values():
+                for session in idle_sessions:
+                    try:
+                        session.close()
+                    except MySQLdb.Error:
+                        pass
+            self.sessions = {}
+
+
+def execute_statement(session, request):
+    cursor = session.cursor(MySQLdb.cursors.DictCursor)
+    try:
+        cursor.execute(request["query"], request.get("args"))
+        if cursor.description:
+            rows = list(cursor.fetchall())
+        else:
+            rows = []
+        return {"rows": rows,
+                "rowcount": cursor.rowcount,
+                "lastrowid": cursor.lastrowid}
+    finally:
+        cursor.close()
+
+
+def get_error_response(e):
+    # the class name goes along with the error so that the client raises the
+    # same MySQLdb.Error subclass the session did
+    if len(e.args) > 1:
+        return {"error": [e.args[0], str(e.args[1])],
+                "error_class": e.__class__.__name__}
+    else:
+        return {"error": [0, str(e)],
+                "error_class": e.__class__.__name__}
+
+
+def is_connection_error(e):
+    return bool(e.args) and \
+        e.args[0] in (CR_SERVER_GONE_ERROR, CR_SERVER_LOST)
+
+
+def get_response_error(response):
+    error_class = getattr(MySQLdb, response.get("error_class", "Error"),
+                          MySQLdb.Error)
+    if not isinstance(error_class, type) or \
+            not issubclass(error_class, MySQLdb.Error):
+        error_class = MySQLdb.Error
+    return error_class(*response["error"])
+
+
+class ProxySQLBrokerHandler(socketserver.StreamRequestHandler):
+
+    def write_response(self, response):
+        self.wfile.write((json.dumps(response, default=str) +
+                          "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.session_started()
+        try:
+            login = json.loads(self.rfile.readline().decode("utf-8"))
+            try:
+                session = self.server.pool.checkout(login)
+            except MySQLdb.Error:
+                self.write_response(get_error_response(sys.exc_info()[1]))
+                return
+
+            self.write_response({"connected": True})
+
+            try:
+                for line in self.rfile:
+                    request = json.loads(line.decode("utf-8"))
+                    try:
+                        try:
+                            response = execute_statement(session, request)
+                        except MySQLdb.OperationalError:
+                            e = sys.exc_info()[1]
+                            if e.args[0] != CR_SERVER_GONE_ERROR:
+                                raise
+                            session = connect_session(login)
+                            response = execute_statement(session, request)
+                    except MySQLdb.Error:
+                        # an error in the statement goes back to the client,
+                        # which carries on with the session as it would with
+                        # a direct connection, only a lost connection ends it
+                        e = sys.exc_info()[1]
+                        if is_connection_error(e):
+                            raise
+                        response = get_error_response(e)
+                    self.write_response(response)
+            except MySQLdb.Error:
+                e = sys.exc_info()[1]
+                session.close()
+                self.write_response(get_error_response(e))
+            except (IOError, ValueError, socket.error):
+                # the client went away or sent garbage part way through, so
+                # the state of the session isn't known and it can't go back
+                # in the pool
+                session.close()
+                raise
+            else:
+                self.server.pool.checkin(login, session)
+        except (IOError, ValueError, socket.error):
+            pass
+        finally:
+            self.server.session_finished()
+
+
+class ProxySQLBroker(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        # the socket is created private, there's no window between the bind
+        # and a chmod for other users to connect in
+        old_umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(self,
+                                                   socket_path,
+                                                   ProxySQLBrokerHandler)
+        finally:
+            os.umask(old_umask)
+        self.timeout = 1
+        self.pool = ProxySQLSessionPool()
+        self.active_sessions = 0
+        self.last_active = time.time()
+        self.session_lock = threading.Lock()
+
+    def session_started(self):
+        with self.session_lock:
+            self.active_sessions += 1
+
+    def session_finished(self):
+        with self.session_lock:
+            self.active_sessions -= 1
+            self.last_active = time.time()
+
+    def is_idle(self):
+        with self.session_lock:
+            return (self.active_sessions == 0 and
+                    time.time() - self.last_active > BROKER_IDLE_TIMEOUT)
+
+    def serve_until_idle(self):
+        try:
+            while not self.is_idle():
+                self.handle_request()
+        finally:
+            self.pool.close()
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def start_broker(socket_path, lock_file):
+    ready_r, ready_w = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            # the broker mustn't keep holding the start lock for its whole
+            # life, or clients which can't connect would block on it
+            lock_file.close()
+            os.close(ready_r)
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+
+            broker = ProxySQLBroker(socket_path)
+            os.write(ready_w, b"1")
+            os.close(ready_w)
+            broker.serve_until_idle()
+        finally:
+            os._exit(0)
+
+    os.close(ready_w)
+    os.waitpid(pid, 0)
+    ready = os.read(ready_r, 1)
+    os.close(ready_r)
+    return ready == b"1"
+
+
+def connect_broker(socket_path):
+    broker_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        broker_socket.connect(socket_path)
+    except socket.error:
+        broker_socket.close()
+        return None
+    return broker_socket
+
+
+def get_broker_socket(socket_path):
+    broker_socket = connect_broker(socket_path)
+    if broker_socket is not None:
+        return broker_socket
+
+    socket_dir = os.path.dirname(socket_path)
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir, 0o700)
+
+    lock_file = open(socket_path + ".lock", "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        broker_socket = connect_broker(socket_path)
+        if broker_socket is None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            if start_broker(socket_path, lock_file):
+                broker_socket = connect_broker(socket_path)
+    finally:
+        lock_file.close()
+
+    return broker_socket
+
+
+class ProxySQLBrokerCursor(object):
+
+    def __init__(self, broker_socket):
+        self.broker_socket = broker_socket
+        self.broker_file = broker_socket.makefile("rb")
+        self.rows = []
+        self.rowcount = -1
+        self.lastrowid = None
+
+    def send(self, request):
+        self.broker_socket.sendall((json.dumps(request) +
+                                    "\n").encode("utf-8"))
+        line = self.broker_file.readline()
+        if not line:
+            raise MySQLdb.OperationalError(CR_SERVER_GONE_ERROR,
+                                           "connection broker went away")
+
+        response = json.loads(line.decode("utf-8"))
+        if "error" in response:
+            raise get_response_error(response)
+        return response
+
+    def execute(self, query, args=None):
+        response = self.send({"query": query, "args": args})
+        self.rows = response["rows"]
+        self.rowcount = response["rowcount"]
+        self.lastrowid = response["lastrowid"]
+        return self.rowcount
+
+    def fetchone(self):
+        if self.rows:
+            return self.rows.pop(0)
+        return None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        self.broker_file.close()
+        self.broker_socket.close()
+
+
+def broker_connect(module):
+    socket_path = os.path.expanduser(BROKER_SOCKET)
+
+    broker_socket = get_broker_socket(socket_path)
+    if broker_socket is None:
+        return None
+
+    cursor = ProxySQLBrokerCursor(broker_socket)
+    cursor.send(get_broker_login(module))
+    return cursor
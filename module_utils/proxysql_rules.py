@@ -0,0 +1,853 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import csv
+import json
+import re
+import sys
+import timeit
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from ansible.module_utils.proxysql import ConfigDiff, MYSQL_QUERY_RULES, \
+    ProxySQLRowStore, normalise_value
+
+# ===========================================
+# proxysql query rule analysis.
+#
+# ProxySQL runs each query through the active rules in rule_id order,
+# skipping the rules whose flagIN doesn't match the query's current flag.  A
+# matching rule applies its actions and stops the processing when apply is
+# set.  Otherwise a rule with a flagOUT switches the query to that flag and
+# the processing starts again from the first rule of the new chain.  The
+# helpers below work on rules as read from the admin interface, so every
+# value is a string or None.
+#
+
+# Columns which match a query by plain equality, two rules with a different
+# value in any of them can never match the same query.
+RULE_EXACT_MATCH_COLS = ["username",
+                         "schemaname",
+                         "proxy_addr",
+                         "proxy_port",
+                         "digest"]
+
+
+def rule_flag(rule, col):
+    val = normalise_value(rule.get(col))
+    if val is None and col == "flagIN":
+        return "0"
+    return val
+
+
+def rule_is_active(rule):
+    return str(rule.get("active")).lower() in ("1", "true")
+
+
+def rule_is_terminal(rule):
+    return str(rule.get("apply")).lower() in ("1", "true")
+
+
+def get_rule_id(rule):
+    return int(rule["rule_id"])
+
+
+# The values mysql_query_rules gives the columns an INSERT leaves out.
+RULE_COLUMN_DEFAULTS = {"active": "0",
+                        "flagIN": "0",
+                        "negate_match_pattern": "0",
+                        "apply": "0"}
+
+
+def get_full_rule(rule):
+    # every column of the rule, with the ones it doesn't set at the table
+    # defaults, so that comparing against it picks up columns set by hand and
+    # writing it clears them
+    full_rule = dict((col, RULE_COLUMN_DEFAULTS.get(col))
+                     for col in MYSQL_QUERY_RULES.columns)
+    full_rule.update((col, normalise_value(val)) for col, val in rule.items()
+                     if val is not None)
+    return full_rule
+
+
+def get_rule_id_range(module):
+    # the first and last rule_id owned by the module, the whole table is owned
+    # when there's no rule_id_range
+    if module.params["rule_id_range"] is None:
+        return 0, None
+
+    try:
+        first_rule_id, last_rule_id = \
+            [int(rule_id) for rule_id in module.params["rule_id_range"]]
+    except (TypeError, ValueError):
+        module.fail_json(
+            msg="rule_id_range must be a list of two integers"
+        )
+
+    if first_rule_id < 0 or last_rule_id < first_rule_id:
+        module.fail_json(
+            msg=("rule_id_range must be a first and last rule_id, greater" +
+                 " than or equal to 0")
+        )
+
+    return first_rule_id, last_rule_id
+
+
+def rules_are_exclusive(rule, other_rule):
+    if rule_flag(rule, "flagIN") != rule_flag(other_rule, "flagIN"):
+        return True
+
+    for col in RULE_EXACT_MATCH_COLS:
+        val = normalise_value(rule.get(col))
+        other_val = normalise_value(other_rule.get(col))
+        if val is not None and other_val is not None and val != other_val:
+            return True
+    return False
+
+
+def rules_depend(rule, other_rule):
+    # each chain is processed from its first rule, so only the order of the
+    # rules within a chain matters
+    return not rules_are_exclusive(rule, other_rule)
+
+
+def get_active_rules(rules):
+    return sorted([rule for rule in rules if rule_is_active(rule)],
+                  key=get_rule_id)
+
+
+def get_rules_evaluated(rules, hits, total_queries):
+    # a query stopped by a terminal rule has been through every rule up to
+    # it, anything else goes through all of them
+    if not total_queries:
+        return 0.0
+
+    evaluated = 0
+    stopped = 0
+    for position, rule in enumerate(rules, 1):
+        if rule_is_terminal(rule):
+            rule_hits = hits.get(get_rule_id(rule), 0)
+            evaluated += rule_hits * position
+            stopped += rule_hits
+
+    evaluated += max(total_queries - stopped, 0) * len(rules)
+    return float(evaluated) / total_queries
+
+
+def get_rule_priority(rule, hits):
+    if rule_is_terminal(rule):
+        return hits.get(get_rule_id(rule), 0)
+    return 0
+
+
+def get_reordered_rules(rules, hits):
+    # each rule moves ahead of the colder rules before it, as long as it
+    # doesn't pass a rule it depends on, so any two rules which could both
+    # act on a query stay in the same order
+    reordered_rules = []
+    for rule in rules:
+        priority = get_rule_priority(rule, hits)
+
+        position = len(reordered_rules)
+        while position > 0:
+            prev_rule = reordered_rules[position - 1]
+            if get_rule_priority(prev_rule, hits) >= priority or \
+                    rules_depend(prev_rule, rule):
+                break
+            position -= 1
+
+        reordered_rules.insert(position, rule)
+    return reordered_rules
+
+# ===========================================
+# proxysql query rule simulator.
+#
+# Runs query samples through a set of rules the way the query processor
+# would, without a proxy.  Each sample is a dict which can hold the username,
+# schemaname, client_addr, proxy_addr, proxy_port, digest, digest_text and
+# query of a query, and a count of how many times it was seen.  A rule which
+# matches on a field the sample doesn't have doesn't match it.
+#
+# The regexes are compiled once, case insensitive as in the query
+# processor's default, and identical samples are only evaluated once with
+# their counts added up.
+#
+
+RULE_REGEX_FLAGS = re.IGNORECASE
+
+QUERY_SAMPLE_FIELDS = ["username",
+                       "schemaname",
+                       "client_addr",
+                       "proxy_addr",
+                       "proxy_port",
+                       "digest",
+                       "digest_text",
+                       "query"]
+
+
+def read_query_samples(samples_file):
+    with open(samples_file) as f:
+        first_line = f.readline()
+        f.seek(0)
+
+        # captured samples repeat a lot, so each distinct line is only
+        # parsed once
+        if first_line.lstrip().startswith("{"):
+            line_counts = {}
+            for line in f:
+                line_counts[line] = line_counts.get(line, 0) + 1
+
+            for line, line_count in line_counts.items():
+                if line.strip():
+                    sample = json.loads(line)
+                    sample["count"] = int(sample.get("count", 1)) * line_count
+                    yield sample
+            return
+
+        dialect = "excel-tab" if "\t" in first_line else "excel"
+        for row in csv.DictReader(f, dialect=dialect):
+            if "count_star" in row and "count" not in row:
+                row["count"] = row["count_star"]
+            yield row
+
+
+def compile_rule_regex(rule, col):
+    if rule.get(col) is None:
+        return None
+    return re.compile(rule[col], RULE_REGEX_FLAGS)
+
+
+def client_addr_matches(rule_addr, client_addr):
+    if client_addr is None:
+        return False
+    if rule_addr.endswith("%"):
+        return client_addr.startswith(rule_addr[:-1])
+    return client_addr == rule_addr
+
+
+class ProxySQLRuleSimulator(object):
+
+    def __init__(self, rules):
+        self.rules = get_active_rules(rules)
+
+        self.match_digests = []
+        self.match_patterns = []
+        self.flag_positions = {}
+        for position, rule in enumerate(self.rules):
+            self.match_digests.append(compile_rule_regex(rule,
+                                                         "match_digest"))
+            self.match_patterns.append(compile_rule_regex(rule,
+                                                          "match_pattern"))
+            self.flag_positions.setdefault(rule_flag(rule, "flagIN"),
+                                           []).append(position)
+
+    def rule_matches(self, position, sample, query):
+        rule = self.rules[position]
+        regex_evaluations = 0
+
+        for col in ("username", "schemaname", "proxy_addr", "proxy_port"):
+            if rule.get(col) is not None and \
+                    normalise_value(sample.get(col)) != rule[col]:
+                return False, regex_evaluations
+
+        if rule.get("client_addr") is not None and \
+                not client_addr_matches(rule["client_addr"],
+                                        sample.get("client_addr")):
+            return False, regex_evaluations
+
+        if rule.get("digest") is not None and \
+                str(sample.get("digest")).lower() != rule["digest"].lower():
+            return False, regex_evaluations
+
+        negate = str(rule.get("negate_match_pattern")).lower() in ("1",
+                                                                   "true")
+        for regex, text in ((self.match_digests[position],
+                             sample.get("digest_text") or query),
+                            (self.match_patterns[position],
+                             query)):
+            if regex is None:
+                continue
+            if text is None:
+                return False, regex_evaluations
+
+            regex_evaluations += 1
+            if bool(regex.search(text)) == negate:
+                return False, regex_evaluations
+
+        return True, regex_evaluations
+
+    def evaluate(self, sample):
+        query = sample.get("query") or sample.get("digest_text")
+        flag = "0"
+        position = 0
+
+        rule_ids = []
+        hostgroup = None
+        regex_evaluations = 0
+        rules_evaluated = 0
+        looping = False
+
+        # a query which comes back to a chain it's already been through with
+        # the same text would go round it for ever
+        chain_states = set([(flag, query)])
+
+        while True:
+            positions = self.flag_positions.get(flag, [])
+            i = bisect.bisect_left(positions, position)
+            if i == len(positions):
+                rules_evaluated += len(self.rules)
+                break
+            position = positions[i]
+
+            matched, rule_regex_evaluations = \
+                self.rule_matches(position, sample, query)
+            regex_evaluations += rule_regex_evaluations
+
+            if matched:
+                rule = self.rules[position]
+                rule_ids.append(get_rule_id(rule))
+
+                if rule.get("destination_hostgroup") is not None:
+                    hostgroup = rule["destination_hostgroup"]
+                if rule.get("replace_pattern") is not None and \
+                        self.match_patterns[position] is not None and \
+                        query is not None:
+                    query = self.match_patterns[position].sub(
+                        rule["replace_pattern"], query)
+                if rule_is_terminal(rule):
+                    rules_evaluated += position + 1
+                    break
+                if rule.get("flagOUT") is not None:
+                    rules_evaluated += position + 1
+                    flag = rule_flag(rule, "flagOUT")
+                    position = 0
+
+                    if (flag, query) in chain_states:
+                        looping = True
+                        break
+                    chain_states.add((flag, query))
+                    continue
+
+            position += 1
+
+        return (rule_ids, hostgroup, rules_evaluated, regex_evaluations,
+                looping)
+
+    def simulate(self, samples):
+        sample_counts = {}
+        for sample in samples:
+            sample_key = tuple(normalise_value(sample.get(field))
+                               for field in QUERY_SAMPLE_FIELDS)
+            sample_counts[sample_key] = \
+                sample_counts.get(sample_key, 0) + int(sample.get("count", 1))
+
+        rule_hits = {}
+        hostgroup_queries = {}
+        total_queries = 0
+        rules_evaluated = 0
+        regex_evaluations = 0
+        looping_queries = 0
+
+        for sample_key, count in sample_counts.items():
+            sample = dict(zip(QUERY_SAMPLE_FIELDS, sample_key))
+            rule_ids, hostgroup, sample_rules_evaluated, \
+                sample_regex_evaluations, looping = self.evaluate(sample)
+
+            if looping:
+                looping_queries += count
+
+            for rule_id in rule_ids:
+                rule_hits[rule_id] = rule_hits.get(rule_id, 0) + count
+            hostgroup_queries[hostgroup] = \
+                hostgroup_queries.get(hostgroup, 0) + count
+            total_queries += count
+            rules_evaluated += sample_rules_evaluated * count
+            regex_evaluations += sample_regex_evaluations * count
+
+        return {"unique_samples": len(sample_counts),
+                "total_queries": total_queries,
+                "rule_hits": rule_hits,
+                "hostgroup_queries": hostgroup_queries,
+                "rules_evaluated": rules_evaluated,
+                "regex_evaluations": regex_evaluations,
+                "looping_queries": looping_queries}
+
+# ===========================================
+# proxysql query rule flag chains.
+#
+# The flagOUT of each active rule is an edge from its flagIN chain to
+# another chain.  A query only starts in chain 0, so a chain that can't be
+# reached from it is never processed, and a cycle sends the queries which
+# follow it round the same chains for ever.  A chain is scanned from the
+# first rule of the table, so leaving it by a rule costs every rule up to
+# that one, and a query which ends in a chain goes through the whole table
+# in the worst case.
+#
+
+
+def get_flag_edges(rules):
+    edges = {}
+    for position, rule in enumerate(rules):
+        flag_out = rule_flag(rule, "flagOUT")
+        if flag_out is None or rule_is_terminal(rule):
+            continue
+
+        flag_edges = edges.setdefault(rule_flag(rule, "flagIN"), {})
+        flag_edges[flag_out] = max(flag_edges.get(flag_out, 0), position + 1)
+    return edges
+
+
+def get_reachable_flags(edges):
+    reachable = set(["0"])
+    pending = ["0"]
+    while pending:
+        flag = pending.pop()
+        for flag_out in edges.get(flag, {}):
+            if flag_out not in reachable:
+                reachable.add(flag_out)
+                pending.append(flag_out)
+    return reachable
+
+
+def get_flag_cycles(edges, flags):
+    # Tarjan's strongly connected components, a component is a cycle when
+    # it has more than one chain or a chain which leads back to itself
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    cycles = []
+
+    def visit(flag):
+        index[flag] = lowlink[flag] = len(index)
+        stack.append(flag)
+        on_stack.add(flag)
+
+        for flag_out in edges.get(flag, {}):
+            if flag_out not in index:
+                visit(flag_out)
+                lowlink[flag] = min(lowlink[flag], lowlink[flag_out])
+            elif flag_out in on_stack:
+                lowlink[flag] = min(lowlink[flag], index[flag_out])
+
+        if lowlink[flag] == index[flag]:
+            component = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component.append(member)
+                if member == flag:
+                    break
+            if len(component) > 1 or flag in edges.get(flag, {}):
+                cycles.append(sorted(int(member) for member in component))
+
+    for flag in sorted(flags, key=int):
+        if flag not in index:
+            visit(flag)
+
+    return sorted(cycles)
+
+
+def analyze_flag_chains(rules):
+    rules = get_active_rules(rules)
+    edges = get_flag_edges(rules)
+    reachable = get_reachable_flags(edges)
+
+    analysis = {"cycles": get_flag_cycles(edges, reachable),
+                "unreachable_rules": [get_rule_id(rule) for rule in rules
+                                      if rule_flag(rule, "flagIN")
+                                      not in reachable],
+                "max_chain_depth": None,
+                "worst_case_rules_evaluated": None}
+
+    if analysis["cycles"]:
+        return analysis
+
+    depths = {}
+    costs = {}
+
+    def visit(flag):
+        if flag not in depths:
+            depths[flag] = 0
+            costs[flag] = len(rules)
+            for flag_out, position in edges.get(flag, {}).items():
+                visit(flag_out)
+                depths[flag] = max(depths[flag], depths[flag_out] + 1)
+                costs[flag] = max(costs[flag], position + costs[flag_out])
+
+    visit("0")
+    analysis["max_chain_depth"] = depths["0"]
+    analysis["worst_case_rules_evaluated"] = costs["0"]
+    return analysis
+
+# ===========================================
+# proxysql query rule regex lint.
+#
+# The query processor's default regex engine backtracks, so a pattern with
+# a quantifier nested inside another unbounded one can take exponential
+# time on a query that nearly matches, and a leading .* which isn't
+# anchored is retried from every position of the query.  The patterns are
+# parsed with python's regex parser to look for these, and can be timed
+# against sample queries.  Patterns with nested quantifiers aren't timed,
+# as they could run for as long as the proxy would.
+#
+
+RULE_REGEX_COLS = ["match_digest", "match_pattern"]
+
+REGEX_REPEATS = [op for op in (sre_parse.MAX_REPEAT,
+                               sre_parse.MIN_REPEAT,
+                               getattr(sre_parse, "POSSESSIVE_REPEAT", None))
+                 if op is not None]
+
+
+def get_regex_children(op, av):
+    if op in REGEX_REPEATS:
+        return [av[2]]
+    elif op == sre_parse.SUBPATTERN:
+        return [av[-1]]
+    elif op == sre_parse.BRANCH:
+        return av[1]
+    elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return [av[1]]
+    elif op == getattr(sre_parse, "ATOMIC_GROUP", None):
+        return [av]
+    return []
+
+
+def is_unbounded_repeat(op, av):
+    return op in REGEX_REPEATS and av[1] == sre_parse.MAXREPEAT
+
+
+def has_unbounded_repeat(subpattern):
+    for op, av in subpattern:
+        if is_unbounded_repeat(op, av):
+            return True
+        if any(has_unbounded_repeat(child)
+               for child in get_regex_children(op, av)):
+            return True
+    return False
+
+
+def has_nested_quantifier(subpattern):
+    for op, av in subpattern:
+        if is_unbounded_repeat(op, av) and has_unbounded_repeat(av[2]):
+            return True
+        if any(has_nested_quantifier(child)
+               for child in get_regex_children(op, av)):
+            return True
+    return False
+
+
+def has_leading_wildcard(subpattern):
+    if not len(subpattern):
+        return False
+
+    op, av = subpattern[0]
+    if op == sre_parse.SUBPATTERN:
+        return has_leading_wildcard(av[-1])
+    return is_unbounded_repeat(op, av) and \
+        [child_op for child_op, child_av in av[2]] == [sre_parse.ANY]
+
+
+def get_regex_issues(pattern):
+    parsed = sre_parse.parse(pattern, RULE_REGEX_FLAGS)
+
+    issues = []
+    if has_nested_quantifier(parsed):
+        issues.append("nested quantifier")
+    if has_leading_wildcard(parsed):
+        issues.append("unanchored leading wildcard")
+    return issues
+
+
+def get_replace_pattern_issues(rule, groups):
+    issues = []
+    if rule.get("match_pattern") is None:
+        issues.append("replace_pattern without a match_pattern is ignored")
+
+    # groups is None when the match_pattern couldn't be parsed
+    references = [int(group) for group in
+                  re.findall(r"\\(\d+)", rule["replace_pattern"])]
+    if references and groups is not None and max(references) > groups:
+        issues.append("replace_pattern refers to group %d of %d" %
+                      (max(references), groups))
+    return issues
+
+
+def get_sample_texts(samples):
+    digest_texts = set()
+    queries = set()
+    for sample in samples:
+        if sample.get("digest_text") or sample.get("query"):
+            digest_texts.add(sample.get("digest_text") or sample["query"])
+            queries.add(sample.get("query") or sample["digest_text"])
+
+    return {"match_digest": sorted(digest_texts),
+            "match_pattern": sorted(queries)}
+
+
+def time_regex(regex, texts):
+    start = timeit.default_timer()
+    for text in texts:
+        regex.search(text)
+    return (timeit.default_timer() - start) * 1000000 / len(texts)
+
+
+def lint_rule_regexes(rule, sample_texts=None):
+    lint = []
+
+    groups = 0
+    for col in RULE_REGEX_COLS:
+        if rule.get(col) is None:
+            continue
+
+        pattern = str(rule[col])
+        regex_lint = {"rule_id": rule.get("rule_id"),
+                      "column": col,
+                      "pattern": pattern}
+        lint.append(regex_lint)
+
+        # ProxySQL's PCRE and RE2 take constructs python's re doesn't, such
+        # as named groups without the P or \h, so a pattern re can't parse
+        # is reported as not checked rather than as invalid
+        try:
+            regex = re.compile(pattern, RULE_REGEX_FLAGS)
+            regex_lint["issues"] = get_regex_issues(pattern)
+        except re.error:
+            regex_lint["issues"] = ["not checked, python's re can't parse" +
+                                    " it: %s" % sys.exc_info()[1]]
+            if col == "match_pattern":
+                groups = None
+            continue
+
+        if col == "match_pattern":
+            groups = regex.groups
+
+        if sample_texts and sample_texts[col] and \
+                "nested quantifier" not in regex_lint["issues"]:
+            regex_lint["match_time"] = \
+                round(time_regex(regex, sample_texts[col]), 2)
+
+    if rule.get("replace_pattern") is not None:
+        lint.append({"rule_id": rule.get("rule_id"),
+                     "column": "replace_pattern",
+                     "pattern": str(rule["replace_pattern"]),
+                     "issues": get_replace_pattern_issues(rule, groups)})
+
+    return lint
+
+# ===========================================
+# proxysql query digest classification.
+#
+# A digest is a read when it's a SELECT which can run on a replica.  A SELECT
+# which takes locks, or reads or writes session state such as variables, lock
+# functions or LAST_INSERT_ID(), has to stay on the writer along with the
+# writes and the statements which control transactions.  A WITH is taken as
+# a write, as the common table expressions can lead into an UPDATE or DELETE.
+#
+
+DIGEST_CLASSES = ["read",
+                  "locking_read",
+                  "session_read",
+                  "write",
+                  "transaction",
+                  "other"]
+
+DIGEST_COMMENT_RE = re.compile(r"^\s*(/\*.*?\*/\s*)*", re.S)
+
+DIGEST_TRANSACTION_RE = \
+    re.compile(r"^(BEGIN|START\s+TRANSACTION|COMMIT|ROLLBACK|SAVEPOINT|" +
+               r"RELEASE\s+SAVEPOINT|XA|SET\s+AUTOCOMMIT|" +
+               r"SET\s+((SESSION|GLOBAL|LOCAL)\s+)?TRANSACTION)\b", re.I)
+
+DIGEST_READ_RE = re.compile(r"^[(\s]*SELECT\b", re.I)
+
+DIGEST_LOCKING_READ_RE = \
+    re.compile(r"\bFOR\s+(UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b", re.I)
+
+DIGEST_SESSION_READ_RE = \
+    re.compile(r"@|\bINTO\s+(OUTFILE|DUMPFILE)\b|" +
+               r"\b(GET_LOCK|RELEASE_LOCK|RELEASE_ALL_LOCKS|IS_FREE_LOCK|" +
+               r"IS_USED_LOCK|LAST_INSERT_ID|FOUND_ROWS|ROW_COUNT|NEXTVAL|" +
+               r"SETVAL|LASTVAL|SLEEP|CONNECTION_ID)\s*\(", re.I)
+
+DIGEST_WRITE_RE = \
+    re.compile(r"^(INSERT|UPDATE|DELETE|REPLACE|LOAD|CREATE|ALTER|DROP|" +
+               r"TRUNCATE|RENAME|GRANT|REVOKE|CALL|LOCK|UNLOCK|HANDLER|" +
+               r"DO|WITH)\b", re.I)
+
+
+def get_digest_class(digest_text):
+    text = DIGEST_COMMENT_RE.sub("", digest_text or "", 1)
+
+    if DIGEST_TRANSACTION_RE.match(text):
+        return "transaction"
+    elif DIGEST_READ_RE.match(text):
+        if DIGEST_LOCKING_READ_RE.search(text):
+            return "locking_read"
+        elif DIGEST_SESSION_READ_RE.search(text):
+            return "session_read"
+        return "read"
+    elif DIGEST_WRITE_RE.match(text):
+        return "write"
+    return "other"
+
+
+# ===========================================
+# proxysql digest rules.
+#
+# The rules generated from the digest stats are kept in a rule_id_range
+# owned by the module which generates them.  A digest which already has a
+# rule in the range keeps its rule_id, so the rules don't get renumbered as
+# the ranking shifts between runs, and the rules left in the range for
+# digests which no longer make the cut are removed.
+#
+
+DIGEST_NONDETERMINISTIC_RE = \
+    re.compile(r"\b(CURRENT_DATE|CURRENT_TIME|CURRENT_TIMESTAMP|LOCALTIME|" +
+               r"LOCALTIMESTAMP|CURRENT_USER)\b|" +
+               r"\b(NOW|SYSDATE|CURDATE|CURTIME|UNIX_TIMESTAMP|UTC_DATE|" +
+               r"UTC_TIME|UTC_TIMESTAMP|RAND|UUID|UUID_SHORT|USER|" +
+               r"SESSION_USER|SYSTEM_USER|DATABASE|SCHEMA)\s*\(", re.I)
+
+
+def digest_is_cacheable(digest_text):
+    return get_digest_class(digest_text) == "read" and \
+        not DIGEST_NONDETERMINISTIC_RE.search(digest_text)
+
+
+def get_digest_stats(cursor, where_data):
+    where_cols = [col for col in sorted(where_data)
+                  if where_data[col] is not None]
+
+    query_string = "SELECT *\nFROM stats_mysql_query_digest"
+    if where_cols:
+        query_string += \
+            ("\nWHERE " +
+             "\n  AND ".join([col + " = %s" for col in where_cols]))
+
+    cursor.execute(query_string, [where_data[col] for col in where_cols])
+
+    # the same digest shows up once for each hostgroup, user and schema it
+    # ran for
+    digests = {}
+    for row in cursor.fetchall():
+        digest = digests.setdefault(row["digest"],
+                                    {"digest": row["digest"],
+                                     "digest_text": row["digest_text"],
+                                     "count_star": 0,
+                                     "sum_time": 0,
+                                     "sum_rows_sent": 0,
+                                     "first_seen": int(row["first_seen"]),
+                                     "last_seen": int(row["last_seen"]),
+                                     "usernames": set()})
+        digest["count_star"] += int(row["count_star"])
+        digest["sum_time"] += int(row["sum_time"])
+        digest["sum_rows_sent"] += int(row.get("sum_rows_sent") or 0)
+        digest["first_seen"] = min(digest["first_seen"],
+                                   int(row["first_seen"]))
+        digest["last_seen"] = max(digest["last_seen"], int(row["last_seen"]))
+        digest["usernames"].add(row["username"])
+
+    return list(digests.values())
+
+
+def get_match_digest(digest_text):
+    return "^" + re.sub(r"([\\.^$|?*+()\[\]{}])", r"\\\1", digest_text) + "$"
+
+
+def get_digest_rule_match(digest, match_with):
+    if match_with == "digest":
+        return digest["digest"]
+    return get_match_digest(digest["digest_text"])
+
+
+def digest_has_rule(digest, rule_matches):
+    return digest["digest"] in rule_matches or \
+        get_match_digest(digest["digest_text"]) in rule_matches
+
+
+def get_digest_rule_key(rule, match_with):
+    # the same digest can have a rule for each user it's routed for
+    return (rule.get("username"), rule.get(match_with))
+
+
+def allocate_digest_rule_ids(rules, owned_rules, match_with,
+                             first_rule_id, last_rule_id, rule_id_step):
+    owned_ids = dict((get_digest_rule_key(rule, match_with),
+                      get_rule_id(rule))
+                     for rule in owned_rules)
+    rule_matches = [get_digest_rule_key(rule, match_with) for rule in rules]
+    used_ids = set(owned_ids.get(rule_match) for rule_match in rule_matches)
+
+    free_ids = (rule_id for rule_id in range(first_rule_id,
+                                             last_rule_id + 1,
+                                             rule_id_step)
+                if rule_id not in used_ids)
+
+    rule_ids = []
+    for rule_match in rule_matches:
+        rule_id = owned_ids.get(rule_match)
+        if rule_id is None:
+            rule_id = next(free_ids, None)
+            if rule_id is None:
+                return None
+        rule_ids.append(rule_id)
+    return rule_ids
+
+
+def get_owned_rule_changes(rules, owned_rules):
+    owned_by_id = dict((get_rule_id(rule), rule) for rule in owned_rules)
+
+    rules_to_create = []
+    rules_to_update = []
+    rule_diffs = []
+    for rule in rules:
+        # the whole row is compared, so columns set on an owned rule by hand
+        # show up as changes and are cleared when it's replaced
+        full_rule = get_full_rule(rule)
+        rule_diff = ConfigDiff(owned_by_id.pop(rule["rule_id"], None),
+                               full_rule,
+                               full_row=True)
+        if rule_diff.action == "create":
+            rules_to_create.append(full_rule)
+        elif rule_diff.action == "update":
+            rules_to_update.append(full_rule)
+        if rule_diff.changed:
+            rule_diffs.append(rule_diff.get_diff())
+
+    rules_to_delete = sorted(owned_by_id.values(), key=get_rule_id)
+    rule_diffs.extend({'before': rule, 'after': {}}
+                      for rule in rules_to_delete)
+
+    return rules_to_create, rules_to_update, rules_to_delete, rule_diffs
+
+
+def replace_owned_rules(cursor, rules_to_create, rules_to_update,
+                        rules_to_delete):
+    rule_store = ProxySQLRowStore(cursor, MYSQL_QUERY_RULES)
+
+    # the range is owned by the module, so an updated rule is replaced
+    # outright rather than keeping any columns set on it by hand
+    rule_store.delete_many([(rule["rule_id"],)
+                            for rule in rules_to_update + rules_to_delete])
+    rule_store.insert_many(rules_to_create + rules_to_update)
+    return True
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from ansible.module_utils.proxysql import normalise_value
+
+# ===========================================
+# proxysql global variable types.
+#
+# global_variables holds every value as a string, and ProxySQL accepts a value
+# in more spellings than it shows it back in.  A desired value is compared
+# with the current one by the type of the variable, so that a value which is
+# only spelt differently, such as TRUE for true, 2000.0 for 2000 or a list in
+# another order, isn't written and loaded to runtime again.  Variables
+# missing from the catalogue are compared as strings, except for the ones
+# which hold a boolean.
+#
+
+BOOL_VARIABLES = frozenset([
+    "admin-checksum_admin_variables",
+    "admin-checksum_mysql_query_rules",
+    "admin-checksum_mysql_servers",
+    "admin-checksum_mysql_users",
+    "admin-checksum_mysql_variables",
+    "admin-cluster_mysql_query_rules_save_to_disk",
+    "admin-cluster_mysql_servers_save_to_disk",
+    "admin-cluster_mysql_users_save_to_disk",
+    "admin-cluster_proxysql_servers_save_to_disk",
+    "admin-hash_passwords",
+    "admin-read_only",
+    "admin-web_enabled",
+    "mysql-autocommit_false_is_transaction",
+    "mysql-client_found_rows",
+    "mysql-commands_stats",
+    "mysql-enforce_autocommit_on_reads",
+    "mysql-forward_autocommit",
+    "mysql-have_compress",
+    "mysql-have_ssl",
+    "mysql-kill_backend_connection_when_disconnect",
+    "mysql-log_unhealthy_connections",
+    "mysql-monitor_enabled",
+    "mysql-monitor_wait_timeout",
+    "mysql-monitor_writer_is_also_reader",
+    "mysql-multiplexing",
+    "mysql-query_digests",
+    "mysql-query_digests_lowercase",
+    "mysql-query_digests_no_digits",
+    "mysql-servers_stats",
+    "mysql-sessions_sort",
+    "mysql-stats_time_backend_query",
+    "mysql-stats_time_query_processor",
+    "mysql-verbose_query_error"
+])
+
+INT_VARIABLES = frozenset([
+    "admin-cluster_check_interval_ms",
+    "admin-cluster_check_status_frequency",
+    "admin-cluster_mysql_query_rules_diffs_before_sync",
+    "admin-cluster_mysql_servers_diffs_before_sync",
+    "admin-cluster_mysql_users_diffs_before_sync",
+    "admin-cluster_proxysql_servers_diffs_before_sync",
+    "admin-refresh_interval",
+    "admin-web_port",
+    "mysql-connect_retries_on_failure",
+    "mysql-connect_timeout_server",
+    "mysql-connect_timeout_server_max",
+    "mysql-connection_max_age_ms",
+    "mysql-default_query_delay",
+    "mysql-default_query_timeout",
+    "mysql-eventslog_filesize",
+    "mysql-free_connections_pct",
+    "mysql-long_query_time",
+    "mysql-max_allowed_packet",
+    "mysql-max_connections",
+    "mysql-max_stmts_cache",
+    "mysql-max_stmts_per_connection",
+    "mysql-max_transaction_time",
+    "mysql-monitor_connect_interval",
+    "mysql-monitor_connect_timeout",
+    "mysql-monitor_history",
+    "mysql-monitor_ping_interval",
+    "mysql-monitor_ping_max_failures",
+    "mysql-monitor_ping_timeout",
+    "mysql-monitor_read_only_interval",
+    "mysql-monitor_read_only_timeout",
+    "mysql-monitor_replication_lag_interval",
+    "mysql-monitor_replication_lag_timeout",
+    "mysql-ping_interval_server_msec",
+    "mysql-ping_timeout_server",
+    "mysql-poll_timeout",
+    "mysql-query_cache_size_MB",
+    "mysql-query_digests_max_digest_length",
+    "mysql-query_digests_max_query_length",
+    "mysql-query_processor_iterations",
+    "mysql-query_retries_on_failure",
+    "mysql-session_idle_ms",
+    "mysql-shun_on_failures",
+    "mysql-shun_recovery_time_sec",
+    "mysql-stacksize",
+    "mysql-threads",
+    "mysql-threshold_query_length",
+    "mysql-threshold_resultset_size",
+    "mysql-throttle_connections_per_sec_to_hostgroup",
+    "mysql-wait_timeout"
+])
+
+# The values an enum variable takes, spelt the way ProxySQL shows them.
+ENUM_VARIABLES = {
+    "mysql-default_isolation_level": ["READ UNCOMMITTED",
+                                      "READ COMMITTED",
+                                      "REPEATABLE READ",
+                                      "SERIALIZABLE"],
+    "mysql-default_session_track_gtids": ["OFF",
+                                          "OWN_GTID"],
+    "mysql-default_tx_isolation": ["READ-UNCOMMITTED",
+                                   "READ-COMMITTED",
+                                   "REPEATABLE-READ",
+                                   "SERIALIZABLE"]
+}
+
+# The separator of the items of a list variable, whose order doesn't matter.
+LIST_VARIABLES = {
+    "admin-admin_credentials": ";",
+    "admin-mysql_ifaces": ";",
+    "admin-stats_credentials": ";",
+    "mysql-default_sql_mode": ",",
+    "mysql-interfaces": ";",
+    "mysql-keep_multiplexing_variables": ","
+}
+
+BOOL_TRUE_VALUES = ["1", "true", "yes", "on", "y"]
+BOOL_FALSE_VALUES = ["0", "false", "no", "off", "n"]
+
+
+def get_variable_type(variable, current_value=None):
+    if variable in BOOL_VARIABLES:
+        return "bool"
+    if variable in INT_VARIABLES:
+        return "int"
+    if variable in ENUM_VARIABLES:
+        return "enum"
+    if variable in LIST_VARIABLES:
+        return "list"
+
+    # ProxySQL always shows a boolean as true or false, so a variable which
+    # holds one is a bool even when it's missing from the catalogue
+    if current_value is not None and \
+            str(current_value).lower() in ("true", "false"):
+        return "bool"
+
+    return "str"
+
+
+def parse_bool_value(value):
+    if isinstance(value, bool):
+        return value
+
+    value = str(value).strip().lower()
+    if value in BOOL_TRUE_VALUES:
+        return True
+    if value in BOOL_FALSE_VALUES:
+        return False
+    return None
+
+
+def parse_int_value(value):
+    if isinstance(value, bool):
+        return None
+
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        pass
+
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if value.is_integer():
+        return int(value)
+    return None
+
+
+def get_list_items(variable, value):
+    if isinstance(value, (list, tuple)):
+        items = [normalise_value(item) for item in value]
+    else:
+        items = str(value).split(LIST_VARIABLES[variable])
+    return [item.strip() for item in items if item.strip()]
+
+
+def format_variable_value(variable, value, current_value=None):
+    variable_type = get_variable_type(variable, current_value)
+
+    if variable_type == "bool":
+        bool_value = parse_bool_value(value)
+        if bool_value is not None:
+            return "true" if bool_value else "false"
+
+    elif variable_type == "int":
+        int_value = parse_int_value(value)
+        if int_value is not None:
+            return str(int_value)
+
+    elif variable_type == "enum":
+        for choice in ENUM_VARIABLES[variable]:
+            if str(value).strip().upper() == choice:
+                return choice
+
+    elif variable_type == "list":
+        return LIST_VARIABLES[variable].join(get_list_items(variable, value))
+
+    # a value which doesn't parse as its type is written as supplied, for
+    # ProxySQL to reject
+    return normalise_value(value)
+
+
+def get_variable_value_key(variable, value, current_value=None):
+    value = format_variable_value(variable, value, current_value)
+
+    if get_variable_type(variable, current_value) == "list":
+        return sorted(get_list_items(variable, value))
+    return value
+
+
+def get_variable_value(variable, value, current_value):
+    # The value to write for the variable, which is the current value when the
+    # two only differ in their spelling.
+    if current_value is not None and \
+            get_variable_value_key(variable, value, current_value) == \
+            get_variable_value_key(variable, current_value, current_value):
+        return current_value
+    return format_variable_value(variable, value, current_value)
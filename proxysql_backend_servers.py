@@ -34,7 +34,7 @@ options:
   hostname:
     description:
       - The ip address at which the mysqld instance can be contacted.
-    required: True
+        Required unless I(servers) is supplied.
   port:
     description:
       - The port at which the mysqld instance can be contacted.
@@ -90,6 +90,26 @@ options:
         be a description of what the host stores, a reminder of when the host
         was added or disabled, or a JSON processed by some checker script.
     default: ''
+  servers:
+    description:
+      - A list of servers to be reconciled in a single run. Each entry is a
+        dict which accepts the same keys as the single server options
+        (I(hostgroup_id), I(hostname), I(port), I(status), I(weight),
+        I(compression), I(max_connections), I(max_replication_lag),
+        I(use_ssl), I(max_latency_ms) and I(comment)), any key omitted from
+        an entry falls back to the value of the corresponding module option.
+        The whole list is compared against a single read of mysql_servers,
+        changes are written in batches and the config is saved and loaded
+        once at the end. Mutually exclusive with I(hostname).
+  purge:
+    description:
+      - When C(True) along with I(servers) and I(state=present), any server in
+        mysql_servers which belongs to one of the hostgroups referenced in
+        I(servers) but isn't in the list is removed, so the hostgroups end up
+        containing exactly the supplied servers. When I(servers) is an empty
+        list the hostgroup given by I(hostgroup_id) is emptied. Servers in
+        other hostgroups are left untouched.
+    default: False
   state:
     description:
       - When C(present) - adds the host, when C(absent) - removes the host.
@@ -99,10 +119,16 @@ options:
     description:
       - Save mysql host config to sqlite db on disk to persist the
         configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   load_to_runtime:
     description:
       - Dynamically load mysql host config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   login_user:
     description:
@@ -125,6 +151,63 @@ options:
       - Specify a config file from which login_user and login_password are to
         be read
     default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
 '''
 
 EXAMPLES = '''
@@ -150,6 +233,36 @@ EXAMPLES = '''
     config_file: '~/proxysql.cnf'
     hostname: 'mysql02'
     state: absent
+
+# This example adds several servers to hostgroup 1 in a single run, any server
+# which already exists with a different weight is updated. The mysql server
+# config is saved to disk and loaded to runtime once all of the servers have
+# been written.
+
+- proxysql_backend_servers:
+    login_user: 'admin'
+    login_password: 'admin'
+    hostgroup_id: 1
+    servers:
+      - hostname: 'mysql01'
+        weight: 10
+      - hostname: 'mysql02'
+      - hostname: 'mysql03'
+        port: 3307
+    state: present
+
+# This example makes hostgroup 2 contain exactly the two supplied servers, any
+# other server in hostgroup 2 is deleted within the same run.
+
+- proxysql_backend_servers:
+    login_user: 'admin'
+    login_password: 'admin'
+    hostgroup_id: 2
+    servers:
+      - hostname: 'mysql04'
+      - hostname: 'mysql05'
+    purge: True
+    state: present
 '''
 
 RETURN = '''
@@ -177,17 +290,65 @@ stdout:
         },
         "state": "present"
     }
+servers:
+    description: The per entry results when I(servers) is supplied, each
+                 with the diff of the entry.
+    returned: When I(servers) is supplied, in the same order as the supplied
+              list.
+    type: list
+    "sample": [
+        {
+            "changed": true,
+            "hostgroup_id": 1,
+            "hostname": "192.168.52.1",
+            "msg": "Added server to mysql_hosts",
+            "port": 3306,
+            "server": {
+                "comment": "",
+                "compression": "0",
+                "hostgroup_id": "1",
+                "hostname": "192.168.52.1",
+                "max_connections": "1000",
+                "max_latency_ms": "0",
+                "max_replication_lag": "0",
+                "port": "3306",
+                "status": "ONLINE",
+                "use_ssl": "0",
+                "weight": "1"
+            }
+        }
+    ]
+purged:
+    description: The servers removed from mysql_servers by I(purge).
+    returned: When I(purge) is enabled.
+    type: list
+    "sample": [
+        {
+            "comment": "",
+            "compression": "0",
+            "hostgroup_id": "2",
+            "hostname": "192.168.52.9",
+            "max_connections": "1000",
+            "max_latency_ms": "0",
+            "max_replication_lag": "0",
+            "port": "3306",
+            "status": "ONLINE",
+            "use_ssl": "0",
+            "weight": "1"
+        }
+    ]
 '''
 
 import sys
 
 try:
     import MySQLdb
-    import MySQLdb.cursors
 except ImportError:
-    mysqldb_found = False
-else:
-    mysqldb_found = True
+    pass
+
+SERVER_STATUSES = ['ONLINE',
+                   'OFFLINE_SOFT',
+                   'OFFLINE_HARD']
 
 # ===========================================
 # proxysql module specific support methods.
@@ -195,58 +356,106 @@ else:
 
 
 def perform_checks(module):
-    if module.params["login_port"] < 0 \
-       or module.params["login_port"] > 65535:
-        module.fail_json(
-            msg="login_port must be a valid unix port number (0-65535)"
-        )
+    perform_common_checks(module)
 
-    if module.params["port"] < 0 \
-       or module.params["port"] > 65535:
+    if module.params["purge"]:
+        if module.params["servers"] is None:
+            module.fail_json(
+                msg="purge can only be used along with servers"
+            )
+        if module.params["state"] != "present":
+            module.fail_json(
+                msg="purge can only be used with state present"
+            )
+
+    if module.params["servers"] is not None:
+        server_keys = set()
+        for server in module.params["servers"]:
+            server_params = get_server_params(module, server)
+            check_server_params(module, server_params)
+
+            server_key = (server_params["hostgroup_id"],
+                          server_params["hostname"],
+                          server_params["port"])
+            if server_key in server_keys:
+                module.fail_json(
+                    msg=("The server %s:%s appears more than once in" +
+                         " hostgroup %s") % (server_params["hostname"],
+                                             server_params["port"],
+                                             server_params["hostgroup_id"])
+                )
+            server_keys.add(server_key)
+    else:
+        check_server_params(module, module.params)
+
+
+def check_server_params(module, params):
+    if params["port"] < 0 \
+       or params["port"] > 65535:
         module.fail_json(
             msg="port must be a valid unix port number (0-65535)"
         )
 
-    if module.params["compression"]:
-        if module.params["compression"] < 0 \
-           or module.params["compression"] > 102400:
+    if params["compression"]:
+        if params["compression"] < 0 \
+           or params["compression"] > 102400:
             module.fail_json(
                 msg="compression must be set between 0 and 102400"
             )
 
-    if module.params["max_replication_lag"]:
-        if module.params["max_replication_lag"] < 0 \
-           or module.params["max_replication_lag"] > 126144000:
+    if params["max_replication_lag"]:
+        if params["max_replication_lag"] < 0 \
+           or params["max_replication_lag"] > 126144000:
             module.fail_json(
                 msg="max_replication_lag must be set between 0 and 102400"
             )
 
-    if not mysqldb_found:
+
+def get_server_params(module, server):
+    server_params = get_entry_params(module,
+                                     MYSQL_SERVERS,
+                                     server,
+                                     MYSQL_SERVERS.columns,
+                                     "servers")
+
+    if not server_params["hostname"]:
         module.fail_json(
-            msg="the python mysqldb module is required"
+            msg="hostname is required for each entry in servers"
         )
 
+    if server_params["status"] is not None and \
+            server_params["status"] not in SERVER_STATUSES:
+        module.fail_json(
+            msg=("status in servers entry must be one of: %s" %
+                 ", ".join(SERVER_STATUSES))
+        )
 
-def save_config_to_disk(cursor):
-    cursor.execute("SAVE MYSQL SERVERS TO DISK")
-    return True
+    return server_params
 
 
-def load_config_to_runtime(cursor):
-    cursor.execute("LOAD MYSQL SERVERS TO RUNTIME")
-    return True
+def get_change_msg(check_mode, action, preposition):
+    if not check_mode:
+        return "%s server %s mysql_hosts" % (action.capitalize(),
+                                             preposition)
+    else:
+        return ("Server would have been %s %s mysql_hosts, however" +
+                " check_mode is enabled.") % (action, preposition)
 
 
 class ProxySQLServer(object):
 
-    def __init__(self, module):
+    def __init__(self, module, server_params=None):
         self.state = module.params["state"]
-        self.save_to_disk = module.params["save_to_disk"]
-        self.load_to_runtime = module.params["load_to_runtime"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
 
-        self.hostgroup_id = module.params["hostgroup_id"]
-        self.hostname = module.params["hostname"]
-        self.port = module.params["port"]
+        if server_params is None:
+            server_params = module.params
+
+        self.hostgroup_id = server_params["hostgroup_id"]
+        self.hostname = server_params["hostname"]
+        self.port = server_params["port"]
 
         config_data_keys = ["status",
                             "weight",
@@ -257,142 +466,49 @@ class ProxySQLServer(object):
                             "max_latency_ms",
                             "comment"]
 
-        self.config_data = dict((k, module.params[k])
+        self.config_data = dict((k, server_params[k])
                                 for k in (config_data_keys))
 
-    def check_server_config_exists(self, cursor):
-        query_string = \
-            """SELECT count(*) AS `host_count`
-               FROM mysql_servers
-               WHERE hostgroup_id = %s
-                 AND hostname = %s
-                 AND port = %s"""
-
-        query_data = \
-            [self.hostgroup_id,
-             self.hostname,
-             self.port]
-
-        cursor.execute(query_string, query_data)
-        check_count = cursor.fetchone()
-        return (int(check_count['host_count']) > 0)
-
-    def check_server_config(self, cursor):
-        query_string = \
-            """SELECT count(*) AS `host_count`
-               FROM mysql_servers
-               WHERE hostgroup_id = %s
-                 AND hostname = %s
-                 AND port = %s"""
-
-        query_data = \
-            [self.hostgroup_id,
-             self.hostname,
-             self.port]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                query_data.append(val)
-                query_string += "\n  AND " + col + " = %s"
-
-        cursor.execute(query_string, query_data)
-        check_count = cursor.fetchone()
-        return (int(check_count['host_count']) > 0)
+    def get_key_data(self):
+        return {"hostgroup_id": self.hostgroup_id,
+                "hostname": self.hostname,
+                "port": self.port}
+
+    def server_key(self):
+        return MYSQL_SERVERS.get_key(self.get_key_data())
+
+    def get_server_diff(self, server):
+        return ConfigDiff(server,
+                          self.config_data,
+                          self.state,
+                          key_data=self.get_key_data())
 
     def get_server_config(self, cursor):
-        query_string = \
-            """SELECT *
-               FROM mysql_servers
-               WHERE hostgroup_id = %s
-                 AND hostname = %s
-                 AND port = %s"""
-
-        query_data = \
-            [self.hostgroup_id,
-             self.hostname,
-             self.port]
-
-        cursor.execute(query_string, query_data)
-        server = cursor.fetchone()
-        return server
+        return ProxySQLRowStore(cursor,
+                                MYSQL_SERVERS).select_one(self.get_key_data())
 
     def create_server_config(self, cursor):
-        query_string = \
-            """INSERT INTO mysql_servers (
-               hostgroup_id,
-               hostname,
-               port"""
-
-        cols = 3
-        query_data = \
-            [self.hostgroup_id,
-             self.hostname,
-             self.port]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                query_string += ",\n" + col
-
-        query_string += \
-            (")\n" +
-             "VALUES (" +
-             "%s ," * cols)
-
-        query_string = query_string[:-2]
-        query_string += ")"
-
-        cursor.execute(query_string, query_data)
+        row_data = self.get_key_data()
+        row_data.update(self.config_data)
+        ProxySQLRowStore(cursor, MYSQL_SERVERS).insert(row_data)
         return True
 
     def update_server_config(self, cursor):
-        query_string = """UPDATE mysql_servers"""
-
-        cols = 0
-        query_data = []
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                if cols == 1:
-                    query_string += "\nSET " + col + "= %s,"
-                else:
-                    query_string += "\n    " + col + " = %s,"
-
-        query_string = query_string[:-1]
-        query_string += ("\nWHERE hostgroup_id = %s\n  AND hostname = %s" +
-                         "\n  AND port = %s")
-
-        query_data.append(self.hostgroup_id)
-        query_data.append(self.hostname)
-        query_data.append(self.port)
-
-        cursor.execute(query_string, query_data)
-        return True
+        return ProxySQLRowStore(cursor,
+                                MYSQL_SERVERS).update(self.get_key_data(),
+                                                      self.config_data)
 
     def delete_server_config(self, cursor):
-        query_string = \
-            """DELETE FROM mysql_servers
-               WHERE hostgroup_id = %s
-                 AND hostname = %s
-                 AND port = %s"""
-
-        query_data = \
-            [self.hostgroup_id,
-             self.hostname,
-             self.port]
-
-        cursor.execute(query_string, query_data)
+        ProxySQLRowStore(cursor, MYSQL_SERVERS).delete(self.get_key_data())
         return True
 
     def manage_config(self, cursor, state):
         if state:
-            if self.save_to_disk:
-                save_config_to_disk(cursor)
-            if self.load_to_runtime:
-                load_config_to_runtime(cursor)
+            save_and_load_config(cursor,
+                                 MYSQL_SERVERS.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
 
     def create_server(self, check_mode, result, cursor):
         if not check_mode:
@@ -426,8 +542,6 @@ class ProxySQLServer(object):
 
     def delete_server(self, check_mode, result, cursor):
         if not check_mode:
-            result['server'] = \
-                self.get_server_config(cursor)
             result['changed'] = \
                 self.delete_server_config(cursor)
             result['msg'] = "Deleted server from mysql_hosts"
@@ -439,85 +553,227 @@ class ProxySQLServer(object):
                              " mysql_hosts, however check_mode is" +
                              " enabled.")
 
+
+class ProxySQLServerList(object):
+
+    def __init__(self, module):
+        self.state = module.params["state"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+
+        self.purge = module.params["purge"]
+
+        self.servers = [ProxySQLServer(module,
+                                       get_server_params(module, server))
+                        for server in module.params["servers"]]
+
+        if self.servers:
+            self.purge_hostgroups = \
+                set(str(server.hostgroup_id) for server in self.servers)
+        else:
+            self.purge_hostgroups = \
+                set([str(module.params["hostgroup_id"])])
+
+    def get_all_server_config(self, cursor):
+        return ProxySQLRowStore(cursor, MYSQL_SERVERS).select_all_by_key()
+
+    def create_server_configs(self, cursor, servers):
+        rows = []
+        for server in servers:
+            row_data = server.get_key_data()
+            row_data.update(server.config_data)
+            rows.append(row_data)
+
+        return ProxySQLRowStore(cursor, MYSQL_SERVERS).insert_many(rows)
+
+    def delete_server_configs(self, cursor, server_keys):
+        return ProxySQLRowStore(cursor,
+                                MYSQL_SERVERS).delete_many(server_keys)
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(cursor,
+                                 MYSQL_SERVERS.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
+
+    def manage_servers(self, check_mode, result, cursor):
+        existing_servers = self.get_all_server_config(cursor)
+
+        servers_to_create = []
+        servers_to_update = []
+        servers_to_delete = []
+
+        server_diffs = []
+        entry_diffs = {}
+
+        for server in self.servers:
+            existing_server = existing_servers.get(server.server_key())
+            server_diff = server.get_server_diff(existing_server)
+            entry_diffs[server] = server_diff
+            if server_diff.action == "create":
+                servers_to_create.append(server)
+            elif server_diff.action == "update":
+                servers_to_update.append(server)
+            elif server_diff.action == "delete":
+                servers_to_delete.append(server)
+            if server_diff.changed:
+                server_diffs.append(server_diff.get_diff())
+
+        servers_to_purge = []
+        if self.purge:
+            server_keys = set(server.server_key() for server in self.servers)
+            servers_to_purge = \
+                [server_key for server_key in sorted(existing_servers)
+                 if server_key[0] in self.purge_hostgroups and
+                 server_key not in server_keys]
+
+        result['changed'] = bool(servers_to_create or
+                                 servers_to_update or
+                                 servers_to_delete or
+                                 servers_to_purge)
+
+        created = set(servers_to_create)
+        updated = set(servers_to_update)
+        deleted = set(servers_to_delete)
+
+        if result['changed'] and not check_mode:
+            self.create_server_configs(cursor, servers_to_create)
+            for server in servers_to_update:
+                server.update_server_config(cursor)
+            self.delete_server_configs(cursor,
+                                       [server.server_key()
+                                        for server in servers_to_delete] +
+                                       servers_to_purge)
+            self.manage_config(cursor,
+                               result['changed'])
+            if servers_to_create or servers_to_update:
+                current_servers = self.get_all_server_config(cursor)
+            else:
+                current_servers = existing_servers
+        else:
+            current_servers = existing_servers
+
+        result['servers'] = []
+        for server in self.servers:
+            server_result = {'hostgroup_id': server.hostgroup_id,
+                             'hostname': server.hostname,
+                             'port': server.port,
+                             'changed': True}
+
+            if server in created:
+                server_result['msg'] = \
+                    get_change_msg(check_mode, "added", "to")
+            elif server in updated:
+                server_result['msg'] = \
+                    get_change_msg(check_mode, "updated", "in")
+            elif server in deleted:
+                server_result['msg'] = \
+                    get_change_msg(check_mode, "deleted", "from")
+            elif self.state == "present":
+                server_result['changed'] = False
+                server_result['msg'] = ("The server already exists in" +
+                                        " mysql_hosts and doesn't need to" +
+                                        " be updated.")
+            else:
+                server_result['changed'] = False
+                server_result['msg'] = ("The server is already absent from" +
+                                        " the mysql_hosts memory" +
+                                        " configuration")
+
+            if server in deleted:
+                server_result['server'] = \
+                    existing_servers.get(server.server_key())
+            elif current_servers.get(server.server_key()):
+                server_result['server'] = \
+                    current_servers.get(server.server_key())
+
+            server_result['diff'] = entry_diffs[server].get_diff()
+
+            result['servers'].append(server_result)
+
+        if self.purge:
+            result['purged'] = [existing_servers[server_key]
+                                for server_key in servers_to_purge]
+            server_diffs.extend({'before': existing_servers[server_key],
+                                 'after': {}}
+                                for server_key in servers_to_purge)
+
+        result['diff'] = server_diffs
+
+        summary = (len(servers_to_create),
+                   len(servers_to_update),
+                   len(servers_to_delete) + len(servers_to_purge))
+        if not check_mode:
+            result['msg'] = ("Added %d, updated %d and deleted %d servers" +
+                             " in mysql_hosts") % summary
+        else:
+            result['msg'] = ("%d servers would have been added, %d updated" +
+                             " and %d deleted in mysql_hosts, however" +
+                             " check_mode is enabled.") % summary
+
 # ===========================================
 # Module execution.
 #
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            login_user=dict(default=None, type='str'),
-            login_password=dict(default=None, no_log=True, type='str'),
-            login_host=dict(default='127.0.0.1'),
-            login_unix_socket=dict(default=None),
-            login_port=dict(default=6032, type='int'),
-            config_file=dict(default='', type='path'),
-            hostgroup_id=dict(default=0, type='int'),
-            hostname=dict(required=True, type='str'),
-            port=dict(default=3306, type='int'),
-            status=dict(choices=['ONLINE',
-                                 'OFFLINE_SOFT',
-                                 'OFFLINE_HARD']),
-            weight=dict(type='int'),
-            compression=dict(type='int'),
-            max_connections=dict(type='int'),
-            max_replication_lag=dict(type='int'),
-            use_ssl=dict(type='bool'),
-            max_latency_ms=dict(type='int'),
-            comment=dict(default='', type='str'),
-            state=dict(default='present', choices=['present',
-                                                   'absent']),
-            save_to_disk=dict(default=True, type='bool'),
-            load_to_runtime=dict(default=True, type='bool')
-        ),
-        supports_check_mode=True
-    )
+def run_module(module):
+    cursor = proxysql_connect(module)
 
-    perform_checks(module)
+    result = {}
 
-    login_user = module.params["login_user"]
-    login_password = module.params["login_password"]
-    config_file = module.params["config_file"]
+    if module.params["servers"] is not None:
+        proxysql_servers = ProxySQLServerList(module)
+        result['state'] = proxysql_servers.state
 
-    cursor = None
-    try:
-        cursor = mysql_connect(module,
-                               login_user,
-                               login_password,
-                               config_file,
-                               cursor_class=MySQLdb.cursors.DictCursor)
-    except MySQLdb.Error:
-        e = sys.exc_info()[1]
-        module.fail_json(
-            msg="unable to connect to ProxySQL Admin Module.. %s" % e
-        )
+        try:
+            proxysql_servers.manage_servers(module.check_mode,
+                                            result,
+                                            cursor)
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to modify servers.. %s" % e
+            )
+
+        module.exit_json(**result)
 
     proxysql_server = ProxySQLServer(module)
-    result = {}
 
     result['state'] = proxysql_server.state
     if proxysql_server.hostname:
         result['hostname'] = proxysql_server.hostname
 
+    try:
+        server_diff = \
+            proxysql_server.get_server_diff(
+                proxysql_server.get_server_config(cursor))
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to get server.. %s" % e
+        )
+
+    result['diff'] = server_diff.get_diff()
+
     if proxysql_server.state == "present":
         try:
-            if not proxysql_server.check_server_config_exists(cursor):
-                if not proxysql_server.check_server_config(cursor):
-                    proxysql_server.create_server(module.check_mode,
-                                                  result,
-                                                  cursor)
-                else:
-                    proxysql_server.update_server(module.check_mode,
-                                                  result,
-                                                  cursor)
+            if server_diff.action == "create":
+                proxysql_server.create_server(module.check_mode,
+                                              result,
+                                              cursor)
+            elif server_diff.action == "update":
+                proxysql_server.update_server(module.check_mode,
+                                              result,
+                                              cursor)
             else:
                 result['changed'] = False
                 result['msg'] = ("The server already exists in mysql_hosts" +
                                  " and doesn't need to be updated.")
-                result['server'] = \
-                    proxysql_server.get_server_config(cursor)
-        except MySQLdb.Error:
+                result['server'] = server_diff.current
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to modify server.. %s" % e
@@ -525,7 +781,8 @@ def main():
 
     elif proxysql_server.state == "absent":
         try:
-            if proxysql_server.check_server_config_exists(cursor):
+            if server_diff.action == "delete":
+                result['server'] = server_diff.current
                 proxysql_server.delete_server(module.check_mode,
                                               result,
                                               cursor)
@@ -533,7 +790,7 @@ def main():
                 result['changed'] = False
                 result['msg'] = ("The server is already absent from the" +
                                  " mysql_hosts memory configuration")
-        except MySQLdb.Error:
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to remove server.. %s" % e
@@ -541,7 +798,48 @@ def main():
 
     module.exit_json(**result)
 
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            hostgroup_id=dict(default=0, type='int'),
+            hostname=dict(type='str'),
+            port=dict(default=3306, type='int'),
+            status=dict(choices=['ONLINE',
+                                 'OFFLINE_SOFT',
+                                 'OFFLINE_HARD']),
+            weight=dict(type='int'),
+            compression=dict(type='int'),
+            max_connections=dict(type='int'),
+            max_replication_lag=dict(type='int'),
+            use_ssl=dict(type='bool'),
+            max_latency_ms=dict(type='int'),
+            comment=dict(default='', type='str'),
+            servers=dict(type='list'),
+            purge=dict(default=False, type='bool'),
+            state=dict(default='present', choices=['present',
+                                                   'absent']),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        mutually_exclusive=[['hostname', 'servers']],
+        required_one_of=[['hostname', 'servers']],
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
 from ansible.module_utils.basic import *
-from ansible.module_utils.mysql import *
+from ansible.module_utils.proxysql import *
 if __name__ == '__main__':
     main()
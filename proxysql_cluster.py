@@ -0,0 +1,416 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_cluster
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Adds or removes ProxySQL Cluster nodes from proxysql admin
+                   interface.
+description:
+   - The M(proxysql_cluster) module adds or removes the nodes of a ProxySQL
+     Cluster using the proxysql admin interface.
+     Each row in proxysql_servers is a ProxySQL node which this instance
+     monitors and syncs its config from.
+options:
+  hostname:
+    description:
+      - The hostname or IP of the ProxySQL node.
+    required: True
+  port:
+    description:
+      - The port of the ProxySQL node's admin interface.
+    default: 6032
+  weight:
+    description:
+      - The weight of the node within the cluster.
+        If ommitted the proxysql default for I(weight) is 0.
+  comment:
+    description:
+      - Text field that can be used for any purposed defined by the user.
+  state:
+    description:
+      - When C(present) - adds the node, when C(absent) - removes the node.
+    choices: [ "present", "absent" ]
+    default: present
+  save_to_disk:
+    description:
+      - Save proxysql servers config to sqlite db on disk to persist the
+        configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  load_to_runtime:
+    description:
+      - Dynamically load proxysql servers config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
+'''
+
+EXAMPLES = '''
+---
+# This example adds the three nodes of a ProxySQL Cluster to one of them, it
+# saves the proxysql servers config to disk, and dynamically loads it to
+# runtime.  Once loaded the other nodes pick up the same list from it.
+
+- proxysql_cluster:
+    login_user: 'admin'
+    login_password: 'admin'
+    hostname: "{{ item }}"
+    cluster_apply: True
+    state: present
+  with_items:
+    - 10.0.1.10
+    - 10.0.1.11
+    - 10.0.1.12
+
+# This example removes a node from the cluster.  It uses credentials in a
+# supplied config file to connect to the proxysql admin interface.
+
+- proxysql_cluster:
+    config_file: '~/proxysql.cnf'
+    hostname: 10.0.1.12
+    state: absent
+'''
+
+RETURN = '''
+stdout:
+    description: The ProxySQL node modified or removed from proxysql_servers
+    returned: On create/update will return the newly modified node, on delete
+              it will return the deleted record.
+    type: dict
+    "sample": {
+        "changed": true,
+        "hostname": "10.0.1.10",
+        "msg": "Added node to proxysql_servers",
+        "proxysql_server": {
+            "comment": "",
+            "hostname": "10.0.1.10",
+            "port": "6032",
+            "weight": "0"
+        },
+        "state": "present"
+    }
+'''
+
+import sys
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+    if module.params["port"] < 0 \
+       or module.params["port"] > 65535:
+        module.fail_json(
+            msg="port must be a valid unix port number (0-65535)"
+        )
+
+    if module.params["weight"] is not None and module.params["weight"] < 0:
+        module.fail_json(
+            msg="weight must be a integer greater than or equal to 0"
+        )
+
+
+class ProxySQLClusterNode(object):
+
+    def __init__(self, module):
+        self.state = module.params["state"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+        self.hostname = module.params["hostname"]
+        self.port = module.params["port"]
+
+        config_data_keys = ["weight",
+                            "comment"]
+
+        self.config_data = dict((k, module.params[k])
+                                for k in (config_data_keys))
+
+    def get_key_data(self):
+        return {"hostname": self.hostname,
+                "port": self.port}
+
+    def get_node_diff(self, node):
+        return ConfigDiff(node,
+                          self.config_data,
+                          self.state,
+                          key_data=self.get_key_data())
+
+    def get_node_config(self, cursor):
+        return ProxySQLRowStore(cursor,
+                                PROXYSQL_SERVERS).select_one(
+                                    self.get_key_data())
+
+    def create_node_config(self, cursor):
+        row_data = self.get_key_data()
+        row_data.update(self.config_data)
+        ProxySQLRowStore(cursor, PROXYSQL_SERVERS).insert(row_data)
+        return True
+
+    def update_node_config(self, cursor):
+        return ProxySQLRowStore(cursor,
+                                PROXYSQL_SERVERS).update(self.get_key_data(),
+                                                         self.config_data)
+
+    def delete_node_config(self, cursor):
+        ProxySQLRowStore(cursor, PROXYSQL_SERVERS).delete(self.get_key_data())
+        return True
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(cursor,
+                                 PROXYSQL_SERVERS.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
+
+    def create_node(self, check_mode, result, cursor):
+        if not check_mode:
+            result['changed'] = \
+                self.create_node_config(cursor)
+            result['msg'] = "Added node to proxysql_servers"
+            result['proxysql_server'] = \
+                self.get_node_config(cursor)
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("Node would have been added to" +
+                             " proxysql_servers, however check_mode" +
+                             " is enabled.")
+
+    def update_node(self, check_mode, result, cursor):
+        if not check_mode:
+            result['changed'] = \
+                self.update_node_config(cursor)
+            result['msg'] = "Updated node in proxysql_servers"
+            result['proxysql_server'] = \
+                self.get_node_config(cursor)
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("Node would have been updated in" +
+                             " proxysql_servers, however check_mode" +
+                             " is enabled.")
+
+    def delete_node(self, check_mode, result, cursor):
+        if not check_mode:
+            result['changed'] = \
+                self.delete_node_config(cursor)
+            result['msg'] = "Deleted node from proxysql_servers"
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("Node would have been deleted from" +
+                             " proxysql_servers, however check_mode" +
+                             " is enabled.")
+
+# ===========================================
+# Module execution.
+#
+
+
+def run_module(module):
+    cursor = proxysql_connect(module)
+
+    proxysql_node = ProxySQLClusterNode(module)
+    result = {}
+
+    result['state'] = proxysql_node.state
+    result['hostname'] = proxysql_node.hostname
+
+    try:
+        node_diff = \
+            proxysql_node.get_node_diff(proxysql_node.get_node_config(cursor))
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to get node.. %s" % e
+        )
+
+    result['diff'] = node_diff.get_diff()
+
+    if proxysql_node.state == "present":
+        try:
+            if node_diff.action == "create":
+                proxysql_node.create_node(module.check_mode,
+                                          result,
+                                          cursor)
+            elif node_diff.action == "update":
+                proxysql_node.update_node(module.check_mode,
+                                          result,
+                                          cursor)
+            else:
+                result['changed'] = False
+                result['msg'] = ("The node already exists in" +
+                                 " proxysql_servers and doesn't need to be" +
+                                 " updated.")
+                result['proxysql_server'] = node_diff.current
+
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to modify node.. %s" % e
+            )
+
+    elif proxysql_node.state == "absent":
+        try:
+            if node_diff.action == "delete":
+                result['proxysql_server'] = node_diff.current
+                proxysql_node.delete_node(module.check_mode,
+                                          result,
+                                          cursor)
+            else:
+                result['changed'] = False
+                result['msg'] = ("The node is already absent from the" +
+                                 " proxysql_servers memory configuration")
+
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to remove node.. %s" % e
+            )
+
+    module.exit_json(**result)
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            hostname=dict(required=True, type='str'),
+            port=dict(default=6032, type='int'),
+            weight=dict(type='int'),
+            comment=dict(type='str'),
+            state=dict(default='present', choices=['present',
+                                                   'absent']),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+if __name__ == '__main__':
+    main()
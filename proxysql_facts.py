@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_facts
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Gathers a snapshot of the proxysql admin tables as facts.
+description:
+   - The M(proxysql_facts) module reads mysql_servers, mysql_users,
+     mysql_query_rules, mysql_replication_hostgroups, scheduler,
+     global_variables and proxysql_servers from both the memory and runtime
+     config layers in a single admin interface session, and returns them as
+     the I(proxysql) fact along with the runtime config checksums.
+   - The I(proxysql) fact can be passed as the I(snapshot) option of the
+     other proxysql modules in check mode, which then check for existing
+     config and work out their diffs against the snapshot without connecting
+     to the admin interface.  The snapshot is only as current as the facts,
+     so outside check mode the modules ignore it.
+   - The I(password) column of mysql_users is left out unless
+     I(include_passwords) is set, so a snapshot without it can't show
+     whether a user's password differs.
+options:
+  include_passwords:
+    description:
+      - Return the I(password) column of mysql_users as it's stored by
+        proxysql.  The passwords, or hashes which are enough to log in with,
+        are sensitive, and end up in the fact cache when fact caching is
+        enabled, so only set this where that's acceptable.
+    default: False
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+'''
+
+EXAMPLES = '''
+---
+# This example gathers the admin tables once, and then checks which of a set
+# of users would be added, against the snapshot rather than the admin
+# interface.
+
+- proxysql_facts:
+    login_user: 'admin'
+    login_password: 'admin'
+
+- proxysql_mysql_users:
+    username: "{{ item }}"
+    snapshot: "{{ proxysql }}"
+  with_items:
+    - app_rw
+    - app_ro
+  check_mode: yes
+'''
+
+RETURN = '''
+ansible_facts:
+    description: The proxysql fact, holding the rows of each table by config
+                 layer and the runtime config checksums.
+    returned: On success
+    type: dict
+    "sample": {
+        "proxysql": {
+            "checksums": {
+                "mysql_servers": "0x2A5B94E31F3A9C67"
+            },
+            "login_host": "127.0.0.1",
+            "login_port": 6032,
+            "memory": {
+                "mysql_servers": [
+                    {
+                        "comment": "",
+                        "compression": "0",
+                        "hostgroup_id": "1",
+                        "hostname": "127.0.0.1",
+                        "max_connections": "1000",
+                        "max_latency_ms": "0",
+                        "max_replication_lag": "0",
+                        "port": "21891",
+                        "status": "ONLINE",
+                        "use_ssl": "0",
+                        "weight": "1"
+                    }
+                ]
+            },
+            "runtime": {
+                "mysql_servers": [
+                    {
+                        "comment": "",
+                        "compression": "0",
+                        "hostgroup_id": "1",
+                        "hostname": "127.0.0.1",
+                        "max_connections": "1000",
+                        "max_latency_ms": "0",
+                        "max_replication_lag": "0",
+                        "port": "21891",
+                        "status": "ONLINE",
+                        "use_ssl": "0",
+                        "weight": "1"
+                    }
+                ]
+            }
+        }
+    }
+'''
+
+import sys
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+
+def get_layer_snapshot(cursor, config_layer, include_passwords):
+    layer_snapshot = {}
+
+    for table in SNAPSHOT_TABLES:
+        query_string = \
+            "SELECT *\nFROM " + get_layer_table(table.name, config_layer)
+
+        try:
+            cursor.execute(query_string)
+        except MySQLdb.Error:
+            # tables which this proxysql release doesn't have are left out
+            continue
+        rows = list(cursor.fetchall())
+
+        if table is MYSQL_USERS and not include_passwords:
+            rows = [dict((col, val) for col, val in row.items()
+                         if col != "password")
+                    for row in rows]
+
+        layer_snapshot[table.name] = rows
+
+    return layer_snapshot
+
+
+def get_checksums(cursor):
+    query_string = \
+        """SELECT name, checksum
+           FROM runtime_checksums_values"""
+
+    try:
+        cursor.execute(query_string)
+    except MySQLdb.Error:
+        return {}
+    return dict((row["name"], row["checksum"]) for row in cursor.fetchall())
+
+
+def get_snapshot(module, cursor):
+    snapshot = {"login_host": module.params["login_host"],
+                "login_port": module.params["login_port"],
+                "login_unix_socket": module.params["login_unix_socket"],
+                "checksums": get_checksums(cursor)}
+
+    for config_layer in SNAPSHOT_LAYERS:
+        snapshot[config_layer.lower()] = get_layer_snapshot(
+            cursor,
+            config_layer,
+            module.params["include_passwords"])
+
+    return snapshot
+
+# ===========================================
+# Module execution.
+#
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    for name in ("login_hosts",
+                 "login_hosts_concurrency",
+                 "login_hosts_fail_fast",
+                 "cluster_apply",
+                 "cluster_apply_timeout",
+                 "snapshot",
+                 "snapshot_file"):
+        del argument_spec[name]
+    argument_spec.update(
+        dict(
+            include_passwords=dict(default=False, type='bool')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    cursor = proxysql_connect(module)
+
+    try:
+        snapshot = get_snapshot(module, cursor)
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to read the admin tables.. %s" % e
+        )
+
+    module.exit_json(changed=False,
+                     ansible_facts=dict(proxysql=snapshot))
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+if __name__ == '__main__':
+    main()
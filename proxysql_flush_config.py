@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_flush_config
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Saves and loads deferred proxysql configuration changes.
+description:
+   - The M(proxysql_flush_config) module issues the SAVE ... TO DISK and
+     LOAD ... TO RUNTIME statements recorded by the other proxysql modules
+     when they're run with I(save_to_disk) or I(load_to_runtime) set to
+     C(deferred).  Each config section is saved and loaded once, no matter
+     how many tasks changed it, so it's typically used as a handler.
+   - The pending changes are tracked per admin interface on the host the
+     modules run on, so this module needs to run on the same host and with
+     the same I(login_host), I(login_port) or I(login_unix_socket) as the
+     tasks that deferred the changes.
+options:
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
+'''
+
+EXAMPLES = '''
+---
+# This example adds a set of servers without loading each change to runtime,
+# and then saves and loads MYSQL SERVERS once from a handler.
+
+- proxysql_backend_servers:
+    login_user: 'admin'
+    login_password: 'admin'
+    hostname: "{{ item }}"
+    hostgroup_id: 1
+    save_to_disk: deferred
+    load_to_runtime: deferred
+  with_items:
+    - 192.168.52.1
+    - 192.168.52.2
+  notify: flush proxysql config
+
+# handlers:
+- name: flush proxysql config
+  proxysql_flush_config:
+    login_user: 'admin'
+    login_password: 'admin'
+'''
+
+RETURN = '''
+stdout:
+    description: The statements which were issued to flush the pending
+                 configuration changes.
+    returned: On success
+    type: dict
+    "sample": {
+        "changed": true,
+        "flushed": [
+            "SAVE MYSQL SERVERS TO DISK",
+            "LOAD MYSQL SERVERS TO RUNTIME"
+        ],
+        "msg": "Flushed 2 deferred config statements"
+    }
+'''
+
+import sys
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+
+def flush_config(deferred_file, check_mode, cluster_apply, result, cursor):
+    lock_file = lock_deferred_config(deferred_file)
+    try:
+        deferred_config = read_deferred_config(deferred_file)
+        statements = get_deferred_statements(deferred_config)
+
+        result['changed'] = bool(statements)
+        result['flushed'] = statements
+
+        if not statements:
+            result['msg'] = "There are no deferred config changes to flush"
+        elif not check_mode:
+            for statement in statements:
+                cursor.execute(statement)
+            write_deferred_config(deferred_file, {})
+            if cluster_apply:
+                for config_settings in CONFIG_SETTINGS_ORDER:
+                    if "LOAD" in deferred_config.get(config_settings, []):
+                        wait_for_cluster_sync(cursor,
+                                              config_settings,
+                                              cluster_apply.timeout)
+            result['msg'] = ("Flushed %d deferred config statements" %
+                             len(statements))
+        else:
+            result['msg'] = ("%d deferred config statements would have been" +
+                             " flushed, however check_mode is" +
+                             " enabled.") % len(statements)
+    finally:
+        lock_file.close()
+
+# ===========================================
+# Module execution.
+#
+
+
+def run_module(module):
+    deferred_file = get_deferred_config_file(module)
+
+    cursor = proxysql_connect(module)
+
+    result = {}
+
+    try:
+        flush_config(deferred_file,
+                     module.check_mode,
+                     get_cluster_apply(module),
+                     result,
+                     cursor)
+    except (ClusterSyncError, MySQLdb.Error):
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to flush config.. %s" % e
+        )
+    except (IOError, OSError, ValueError):
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to read deferred config.. %s" % e
+        )
+
+    module.exit_json(**result)
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=proxysql_common_argument_spec(),
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+if __name__ == '__main__':
+    main()
@@ -25,24 +25,41 @@ short_description: Gets or sets the proxysql global variables.
 description:
    - The M(proxysql_global_variables) module gets or sets the proxysql global
      variables.
+   - Values are compared by the type of the variable, so a boolean, number,
+     enum or list value which only differs in its spelling, case or order
+     from the current value isn't set again.  Boolean values are set as
+     C(true) or C(false).
 options:
   variable:
     description:
       - Defines which variable should be returned, or if I(value) is specified
-        which variable should be updated.
-    required: True
+        which variable should be updated.  Either I(variable) or
+        I(variables) is required.
   value:
     description:
       - Defines a value the variable specified using I(variable) should be set
         to.
+  variables:
+    description:
+      - A dict of variables and the values they should be set to, in place of
+        I(variable) and I(value).  The variables are read in one go and only
+        the ones which differ are updated, then the mysql and admin
+        variables are each saved and loaded once.  A variable with a null
+        value is only returned.
   save_to_disk:
     description:
       - Save mysql host config to sqlite db on disk to persist the
         configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   load_to_runtime:
     description:
       - Dynamically load mysql host config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   login_user:
     description:
@@ -65,6 +82,63 @@ options:
       - Specify a config file from which login_user and login_password are to
         be read
     default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
 '''
 
 EXAMPLES = '''
@@ -86,9 +160,28 @@ EXAMPLES = '''
 - proxysql_global_variables:
     config_file: '~/proxysql.cnf'
     variable: 'mysql-default_query_delay'
+
+# This example sets several variables at once.  Only the ones which differ
+# are updated, and the mysql and admin variables are each saved to disk and
+# loaded to runtime once.
+
+- proxysql_global_variables:
+    config_file: '~/proxysql.cnf'
+    variables:
+      mysql-max_connections: 4096
+      mysql-monitor_username: 'monitor'
+      admin-refresh_interval: 2000
 '''
 
 RETURN = '''
+variables:
+    description: The variables supplied in I(variables) with their values.
+    returned: When I(variables) is supplied.
+    type: dict
+    "sample": {
+        "admin-refresh_interval": "2000",
+        "mysql-max_connections": "4096"
+    }
 stdout:
     description: Returns the mysql variable supplied with it's associted value.
     returned: Returns the current variable and value, or the newly set value
@@ -108,11 +201,8 @@ import sys
 
 try:
     import MySQLdb
-    import MySQLdb.cursors
 except ImportError:
-    mysqldb_found = False
-else:
-    mysqldb_found = True
+    pass
 
 # ===========================================
 # proxysql module specific support methods.
@@ -120,183 +210,203 @@ else:
 
 
 def perform_checks(module):
-    if module.params["login_port"] < 0 \
-       or module.params["login_port"] > 65535:
+    perform_common_checks(module)
+
+    if (module.params["variable"] is None) == \
+            (module.params["variables"] is None):
         module.fail_json(
-            msg="login_port must be a valid unix port number (0-65535)"
+            msg="one of variable or variables is required"
         )
 
-    if not mysqldb_found:
+    if module.params["variables"] is not None and \
+            module.params["value"] is not None:
         module.fail_json(
-            msg="the python mysqldb module is required"
+            msg="value can't be used along with variables"
         )
 
 
-def save_config_to_disk(variable, cursor):
-    if variable.startswith("admin"):
-        cursor.execute("SAVE ADMIN VARIABLES TO DISK")
-    else:
-        cursor.execute("SAVE MYSQL VARIABLES TO DISK")
-    return True
-
-
-def load_config_to_runtime(variable, cursor):
-    if variable.startswith("admin"):
-        cursor.execute("LOAD ADMIN VARIABLES TO RUNTIME")
-    else:
-        cursor.execute("LOAD MYSQL VARIABLES TO RUNTIME")
-    return True
-
-
-def check_config(variable, value, cursor):
-    query_string = \
-        """SELECT count(*) AS `variable_count`
-           FROM global_variables
-           WHERE variable_name = %s and variable_value = %s"""
-
-    query_data = \
-        [variable, value]
-
-    cursor.execute(query_string, query_data)
-    check_count = cursor.fetchone()
-    return (int(check_count['variable_count']) > 0)
-
-
 def get_config(variable, cursor):
+    variable_store = ProxySQLRowStore(cursor, GLOBAL_VARIABLES)
+    return variable_store.select_one({"variable_name": variable})
 
-    query_string = \
-        """SELECT *
-           FROM global_variables
-           WHERE variable_name = %s"""
-
-    query_data = \
-        [variable, ]
-
-    cursor.execute(query_string, query_data)
-    row_count = cursor.rowcount
-    resultset = cursor.fetchone()
 
-    if row_count > 0:
-        return resultset
-    else:
-        return False
+def get_all_config(cursor):
+    variable_store = ProxySQLRowStore(cursor, GLOBAL_VARIABLES)
+    return dict((row["variable_name"], row) for row in variable_store.select())
 
 
 def set_config(variable, value, cursor):
+    variable_store = ProxySQLRowStore(cursor, GLOBAL_VARIABLES)
+    return variable_store.update({"variable_name": variable},
+                                 {"variable_value": value})
 
-    query_string = \
-        """UPDATE global_variables
-           SET variable_value = %s
-           WHERE variable_name = %s"""
-
-    query_data = \
-        [value, variable]
-
-    cursor.execute(query_string, query_data)
-    return True
 
-
-def manage_config(variable, save_to_disk, load_to_runtime, cursor, state):
+def manage_config(variable, save_to_disk, load_to_runtime, deferred_file,
+                  cursor, state):
     if state:
-        if save_to_disk:
-            save_config_to_disk(variable, cursor)
-        if load_to_runtime:
-            load_config_to_runtime(variable, cursor)
+        save_and_load_config(cursor,
+                             get_variable_config_settings(variable),
+                             save_to_disk,
+                             load_to_runtime,
+                             deferred_file)
+
+
+def manage_variables(variables, current_configs, check_mode, save_to_disk,
+                     load_to_runtime, deferred_file, cursor, result):
+    changed_variables = []
+    diff = {'before': {}, 'after': {}}
+    for variable, value in sorted(variables.items()):
+        if value is None:
+            continue
+
+        current_value = current_configs[variable]["variable_value"]
+        value = get_variable_value(variable, value, current_value)
+
+        config_diff = ConfigDiff(current_configs[variable],
+                                 {"variable_value": value})
+        if config_diff.changed:
+            changed_variables.append((variable, value))
+            variable_diff = config_diff.get_diff()
+            diff['before'][variable] = \
+                variable_diff['before']['variable_value']
+            diff['after'][variable] = \
+                variable_diff['after']['variable_value']
+    result['diff'] = diff
+
+    result['changed'] = bool(changed_variables)
+    if changed_variables and not check_mode:
+        for variable, value in changed_variables:
+            set_config(variable, value, cursor)
+        current_configs = get_all_config(cursor)
+
+        # one save and load for each of the mysql and admin variables
+        changed_settings = set(get_variable_config_settings(variable)
+                               for variable, value in changed_variables)
+        for config_settings in CONFIG_SETTINGS_ORDER:
+            if config_settings in changed_settings:
+                save_and_load_config(cursor,
+                                     config_settings,
+                                     save_to_disk,
+                                     load_to_runtime,
+                                     deferred_file)
+
+    result['variables'] = \
+        dict((variable, current_configs[variable]["variable_value"])
+             for variable in variables)
+
+    if not changed_variables:
+        result['msg'] = ("The variables are already set to the supplied" +
+                         " values")
+    elif not check_mode:
+        result['msg'] = ("Set %d variables to the supplied values" %
+                         len(changed_variables))
+    else:
+        result['msg'] = ("%d variables would have been set to the" +
+                         " supplied values, however check_mode is" +
+                         " enabled.") % len(changed_variables)
 
 # ===========================================
 # Module execution.
 #
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            login_user=dict(default=None, type='str'),
-            login_password=dict(default=None, no_log=True, type='str'),
-            login_host=dict(default="127.0.0.1"),
-            login_unix_socket=dict(default=None),
-            login_port=dict(default=6032, type='int'),
-            config_file=dict(default="", type='path'),
-            variable=dict(required=True, type='str'),
-            value=dict(),
-            save_to_disk=dict(default=True, type='bool'),
-            load_to_runtime=dict(default=True, type='bool')
-        ),
-        supports_check_mode=True
-    )
-
-    perform_checks(module)
-
-    login_user = module.params["login_user"]
-    login_password = module.params["login_password"]
-    config_file = module.params["config_file"]
+def run_module(module):
     variable = module.params["variable"]
     value = module.params["value"]
-    save_to_disk = module.params["save_to_disk"]
-    load_to_runtime = module.params["load_to_runtime"]
+    save_to_disk = get_config_mode(module, "save_to_disk")
+    load_to_runtime = get_config_mode(module, "load_to_runtime")
+    deferred_file = get_deferred_config_file(module)
 
-    cursor = None
-    try:
-        cursor = mysql_connect(module,
-                               login_user,
-                               login_password,
-                               config_file,
-                               cursor_class=MySQLdb.cursors.DictCursor)
-    except MySQLdb.Error:
-        e = sys.exc_info()[1]
-        module.fail_json(
-            msg="unable to connect to ProxySQL Admin Module.. %s" % e
-        )
+    cursor = proxysql_connect(module)
 
     result = {}
 
-    if not value:
+    if module.params["variables"] is not None:
         try:
-            if get_config(variable, cursor):
-                result['changed'] = False
-                result['msg'] = \
-                    "Returned the variable and it's current value"
-                result['var'] = get_config(variable, cursor)
-            else:
-                module.fail_json(
-                    msg="The variable \"%s\" was not found" % variable
-                )
-
+            current_configs = get_all_config(cursor)
         except MySQLdb.Error:
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to get config.. %s" % e
             )
+
+        missing_variables = [variable for variable in
+                             module.params["variables"]
+                             if variable not in current_configs]
+        if missing_variables:
+            module.fail_json(
+                msg="The variables \"%s\" were not found" %
+                    "\", \"".join(sorted(missing_variables))
+            )
+
+        try:
+            manage_variables(module.params["variables"],
+                             current_configs,
+                             module.check_mode,
+                             save_to_disk,
+                             load_to_runtime,
+                             deferred_file,
+                             cursor,
+                             result)
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to set config.. %s" % e
+            )
+
+        module.exit_json(**result)
+
+    try:
+        current_config = get_config(variable, cursor)
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to get config.. %s" % e
+        )
+
+    if not current_config:
+        module.fail_json(
+            msg="The variable \"%s\" was not found" % variable
+        )
+
+    if value is None:
+        result['changed'] = False
+        result['msg'] = \
+            "Returned the variable and it's current value"
+        result['var'] = current_config
     else:
+        value = get_variable_value(variable,
+                                   value,
+                                   current_config["variable_value"])
+        config_diff = ConfigDiff(current_config,
+                                 {"variable_value": value})
+        result['diff'] = config_diff.get_diff()
+
         try:
-            if get_config(variable, cursor):
-                if not check_config(variable, value, cursor):
-                    if not module.check_mode:
-                        result['changed'] = set_config(variable, value, cursor)
-                        result['msg'] = \
-                            "Set the variable to the supplied value"
-                        result['var'] = get_config(variable, cursor)
-                        manage_config(variable,
-                                      save_to_disk,
-                                      load_to_runtime,
-                                      cursor,
-                                      result['changed'])
-                    else:
-                        result['changed'] = True
-                        result['msg'] = ("Variable would have been set to" +
-                                         " the supplied value, however" +
-                                         " check_mode is enabled.")
-                else:
-                    result['changed'] = False
-                    result['msg'] = ("The variable is already been set to" +
-                                     " the supplied value")
+            if config_diff.changed:
+                if not module.check_mode:
+                    result['changed'] = set_config(variable, value, cursor)
+                    result['msg'] = \
+                        "Set the variable to the supplied value"
                     result['var'] = get_config(variable, cursor)
+                    manage_config(variable,
+                                  save_to_disk,
+                                  load_to_runtime,
+                                  deferred_file,
+                                  cursor,
+                                  result['changed'])
+                else:
+                    result['changed'] = True
+                    result['msg'] = ("Variable would have been set to" +
+                                     " the supplied value, however" +
+                                     " check_mode is enabled.")
             else:
-                module.fail_json(
-                    msg="The variable \"%s\" was not found" % variable
-                )
+                result['changed'] = False
+                result['msg'] = ("The variable is already been set to" +
+                                 " the supplied value")
+                result['var'] = current_config
 
-        except MySQLdb.Error:
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to set config.. %s" % e
@@ -304,7 +414,33 @@ def main():
 
     module.exit_json(**result)
 
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            variable=dict(type='str'),
+            value=dict(),
+            variables=dict(type='dict'),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
 from ansible.module_utils.basic import *
-from ansible.module_utils.mysql import *
+from ansible.module_utils.proxysql import *
+from ansible.module_utils.proxysql_variables import *
 if __name__ == '__main__':
     main()
@@ -24,32 +24,44 @@ author: "Ben Mildren (@bmildren)"
 short_description: Writes the proxysql configuration settings between layers.
 description:
    - The M(proxysql_global_variables) module writes the proxysql configuration
-     settings between layers.  Currently this module will always report a
-     changed state, so should typically be used with WHEN however this will
-     change in a future version when the CHECKSUM table commands are available
-     for all tables in proxysql.
+     settings between layers.  Before writing, the config is compared between
+     the layer being read and the layer being written, and when they already
+     match the statement is skipped and no change is reported.  Writes from
+     the CONFIG layer can't be compared, so they always report a change.
+   - Several I(config_settings) and I(steps) can be written using a single
+     connection.  Each step is applied to every section before moving on to
+     the next step, and the sections are always written in dependency order
+     (variables, servers, users, query rules and then the scheduler).
 options:
   action:
     description:
       - The supplied I(action) combines with the supplied I(direction) to
         provide the semantics of how we want to move the I(config_settings)
         between the I(config_layers).
+      - Required unless I(steps) is supplied.
     choices: [ "LOAD", "SAVE" ]
-    required: True
   config_settings:
     description:
       - The I(config_settings) specifies which configuration we're writing.
+        Either a single section or a list of sections.
     choices: [ "MYSQL USERS", "MYSQL SERVERS", "MYSQL QUERY RULES",
-               "MYSQL VARIABLES", "ADMIN VARIABLES", "SCHEDULER" ]
+               "MYSQL VARIABLES", "ADMIN VARIABLES", "SCHEDULER",
+               "PROXYSQL SERVERS" ]
     required: True
+  steps:
+    description:
+      - A list of dicts each with an I(action), I(direction) and
+        I(config_layer), which are written in the order supplied.  Use this
+        instead of I(action), I(direction) and I(config_layer) to write
+        several layers at once.
   direction:
     description:
       - FROM - denotes we're reading values FROM the supplied I(config_layer)
         and writing to the next layer
         TO - denotes we're reading from the previous layer and writing TO the
         supplied I(config_layer).
+      - Required unless I(steps) is supplied.
     choices: [ "FROM", "TO" ]
-    required: True
   config_layer:
     description:
       - RUNTIME - represents the in-memory data structures of ProxySQL used by
@@ -59,8 +71,8 @@ options:
         DISK - represents the on-disk SQLite3 database.
         CONFIG - is the classical config file.  You can only LOAD FROM the
         config file.
+      - Required unless I(steps) is supplied.
     choices: [ "MEMORY", "DISK", "RUNTIME", "CONFIG" ]
-    required: True
   login_user:
     description:
       - The username used to authenticate to ProxySQL admin interface
@@ -82,6 +94,63 @@ options:
       - Specify a config file from which login_user and login_password are to
         be read
     default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
 '''
 
 EXAMPLES = '''
@@ -106,26 +175,65 @@ EXAMPLES = '''
     config_settings: "MYSQL QUERY RULES"
     direction: "TO"
     config_layer: "RUNTIME"
+
+# This example loads the servers, users and query rules to runtime, and then
+# saves them to disk, all using the one connection.
+
+- proxysql_manage_config:
+    config_file: '~/proxysql.cnf'
+    config_settings:
+      - "MYSQL USERS"
+      - "MYSQL SERVERS"
+      - "MYSQL QUERY RULES"
+    steps:
+      - action: "LOAD"
+        direction: "TO"
+        config_layer: "RUNTIME"
+      - action: "SAVE"
+        direction: "TO"
+        config_layer: "DISK"
 '''
 
 RETURN = '''
 stdout:
-    description: Simply reports whether the action reported a change.
-    returned: Currently the returned value with always be changed=True.
+    description: Reports whether the config needed to be written between the
+                 layers.
+    returned: On success
     type: dict
     "sample": {
-        "changed": true
+        "changed": true,
+        "config": [
+            {
+                "changed": true,
+                "config_settings": "MYSQL USERS",
+                "elapsed": 0.0021,
+                "msg": "LOAD MYSQL USERS TO RUNTIME",
+                "statement": "LOAD MYSQL USERS TO RUNTIME"
+            }
+        ],
+        "msg": "LOAD MYSQL USERS TO RUNTIME"
     }
 '''
 
 import sys
 
+import time
+
 try:
     import MySQLdb
 except ImportError:
-    mysqldb_found = False
-else:
-    mysqldb_found = True
+    pass
+
+ACTIONS = ['LOAD',
+           'SAVE']
+
+DIRECTIONS = ['FROM',
+              'TO']
+
+CONFIG_LAYERS = ['MEMORY',
+                 'DISK',
+                 'RUNTIME',
+                 'CONFIG']
 
 # ===========================================
 # proxysql module specific support methods.
@@ -133,38 +241,90 @@ else:
 
 
 def perform_checks(module):
-    if module.params["login_port"] < 0 \
-       or module.params["login_port"] > 65535:
-        module.fail_json(
-            msg="login_port must be a valid unix port number (0-65535)"
-        )
+    perform_common_checks(module)
 
-    if module.params["config_layer"] == 'CONFIG' and \
-            (module.params["action"] != 'LOAD' or
-             module.params["direction"] != 'FROM'):
+    for config_settings in module.params["config_settings"]:
+        if config_settings not in CONFIG_SETTINGS_ORDER:
+            module.fail_json(
+                msg=("config_settings must be one or more of: %s" %
+                     ", ".join(CONFIG_SETTINGS_ORDER))
+            )
 
-        if (module.params["action"] != 'LOAD' and
-                module.params["direction"] != 'FROM'):
+    for step in get_config_steps(module):
+        check_config_step(module, *step)
+
+
+def check_config_step(module, action, direction, config_layer):
+    if config_layer == 'CONFIG' and \
+            (action != 'LOAD' or direction != 'FROM'):
+
+        if action != 'LOAD' and direction != 'FROM':
             msg_string = ("Neither the action \"%s\" nor the direction" +
                           " \"%s\" are valid combination with the CONFIG" +
                           " config_layer")
-            module.fail_json(msg=msg_string % (module.params["action"],
-                                               module.params["direction"]))
+            module.fail_json(msg=msg_string % (action, direction))
 
-        elif module.params["action"] != 'LOAD':
+        elif action != 'LOAD':
             msg_string = ("The action \"%s\" is not a valid combination" +
                           " with the CONFIG config_layer")
-            module.fail_json(msg=msg_string % module.params["action"])
+            module.fail_json(msg=msg_string % action)
 
         else:
             msg_string = ("The direction \"%s\" is not a valid combination" +
                           " with the CONFIG config_layer")
-            module.fail_json(msg=msg_string % module.params["direction"])
+            module.fail_json(msg=msg_string % direction)
+
+
+def get_config_steps(module):
+    if module.params["steps"] is None:
+        return [(module.params["action"],
+                 module.params["direction"],
+                 module.params["config_layer"])]
+
+    steps = []
+    for step in module.params["steps"]:
+        if not isinstance(step, dict):
+            module.fail_json(
+                msg="each entry in steps must be a dict, got %s" % step
+            )
+
+        for key, choices in (("action", ACTIONS),
+                             ("direction", DIRECTIONS),
+                             ("config_layer", CONFIG_LAYERS)):
+            if step.get(key) not in choices:
+                module.fail_json(
+                    msg=("%s in steps entry must be one of: %s" %
+                         (key, ", ".join(choices)))
+                )
+
+        steps.append((step["action"],
+                      step["direction"],
+                      step["config_layer"]))
+    return steps
+
+
+def get_config_settings(module):
+    return [config_settings for config_settings in CONFIG_SETTINGS_ORDER
+            if config_settings in module.params["config_settings"]]
+
+
+def get_config_layers(action, direction, config_layer):
+    if direction == "TO":
+        target_layer = config_layer
+        if config_layer == "MEMORY":
+            source_layer = "DISK" if action == "LOAD" else "RUNTIME"
+        else:
+            source_layer = "MEMORY"
+    else:
+        source_layer = config_layer
+        if config_layer == "MEMORY":
+            target_layer = "RUNTIME" if action == "LOAD" else "DISK"
+        elif config_layer == "CONFIG":
+            return None
+        else:
+            target_layer = "MEMORY"
 
-    if not mysqldb_found:
-        module.fail_json(
-            msg="the python mysqldb module is required"
-        )
+    return source_layer, target_layer
 
 
 def manage_config(manage_config_settings, cursor):
@@ -174,77 +334,124 @@ def manage_config(manage_config_settings, cursor):
     cursor.execute(query_string)
     return True
 
+
+def manage_config_step(config_settings, step, check_mode, cluster_apply,
+                       cursor):
+    action, direction, config_layer = step
+
+    manage_config_settings = \
+        [action, config_settings, direction, config_layer]
+
+    step_result = {'config_settings': config_settings,
+                   'statement': ' '.join(manage_config_settings)}
+
+    start_time = time.time()
+
+    config_layers = get_config_layers(action, direction, config_layer)
+
+    if config_layers and \
+            config_layers_match(cursor, config_settings, *config_layers):
+        step_result['changed'] = False
+        step_result['msg'] = ("The %s config already matches between the" +
+                              " %s and %s layers") % ((config_settings,) +
+                                                      config_layers)
+    elif not check_mode:
+        step_result['changed'] = manage_config(manage_config_settings,
+                                               cursor)
+        step_result['msg'] = step_result['statement']
+
+        if cluster_apply and config_layers and \
+                config_layers[1] == "RUNTIME":
+            wait_for_cluster_sync(cursor,
+                                  config_settings,
+                                  cluster_apply.timeout)
+    else:
+        step_result['changed'] = True
+        step_result['msg'] = ("Config would have been written with" +
+                              " \"%s\", however check_mode is" +
+                              " enabled.") % step_result['statement']
+
+    step_result['elapsed'] = round(time.time() - start_time, 4)
+    return step_result
+
 # ===========================================
 # Module execution.
 #
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            login_user=dict(default=None, type='str'),
-            login_password=dict(default=None, no_log=True, type='str'),
-            login_host=dict(default="127.0.0.1"),
-            login_unix_socket=dict(default=None),
-            login_port=dict(default=6032, type='int'),
-            config_file=dict(default="", type='path'),
-            action=dict(required=True, choices=['LOAD',
-                                                'SAVE']),
-            config_settings=dict(requirerd=True, choices=['MYSQL USERS',
-                                                          'MYSQL SERVERS',
-                                                          'MYSQL QUERY RULES',
-                                                          'MYSQL VARIABLES',
-                                                          'ADMIN VARIABLES',
-                                                          'SCHEDULER']),
-            direction=dict(required=True, choices=['FROM',
-                                                   'TO']),
-            config_layer=dict(requirerd=True, choices=['MEMORY',
-                                                       'DISK',
-                                                       'RUNTIME',
-                                                       'CONFIG'])
-        ),
-        supports_check_mode=True
-    )
+def run_module(module):
+    config_steps = get_config_steps(module)
+    config_settings_list = get_config_settings(module)
+    cluster_apply = get_cluster_apply(module)
 
-    perform_checks(module)
+    cursor = proxysql_connect(module)
 
-    login_user = module.params["login_user"]
-    login_password = module.params["login_password"]
-    config_file = module.params["config_file"]
-    action = module.params["action"]
-    config_settings = module.params["config_settings"]
-    direction = module.params["direction"]
-    config_layer = module.params["config_layer"]
+    result = {}
+    result['config'] = []
 
-    cursor = None
     try:
-        cursor = mysql_connect(module,
-                               login_user,
-                               login_password,
-                               config_file)
-    except MySQLdb.Error:
+        for step in config_steps:
+            for config_settings in config_settings_list:
+                result['config'].append(
+                    manage_config_step(config_settings,
+                                       step,
+                                       module.check_mode,
+                                       cluster_apply,
+                                       cursor))
+    except (ClusterSyncError, MySQLdb.Error):
         e = sys.exc_info()[1]
         module.fail_json(
-            msg="unable to connect to ProxySQL Admin Module.. %s" % e
+            msg="unable to manage config.. %s" % e
         )
 
-    result = {}
+    written = [step_result for step_result in result['config']
+               if step_result['changed']]
 
-    manage_config_settings = \
-        [action, config_settings, direction, config_layer]
+    result['changed'] = bool(written)
 
-    try:
-        result['changed'] = manage_config(manage_config_settings,
-                                          cursor)
-    except MySQLdb.Error:
-        e = sys.exc_info()[1]
-        module.fail_json(
-            msg="unable to manage config.. %s" % e
-        )
+    if len(result['config']) == 1:
+        result['msg'] = result['config'][0]['msg']
+    elif not module.check_mode:
+        result['msg'] = ("Wrote %d of %d config steps, the rest already" +
+                         " matched") % (len(written), len(result['config']))
+    else:
+        result['msg'] = ("%d of %d config steps would have been written," +
+                         " however check_mode is enabled.") % \
+            (len(written), len(result['config']))
 
     module.exit_json(**result)
 
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            action=dict(choices=ACTIONS),
+            config_settings=dict(required=True, type='list'),
+            direction=dict(choices=DIRECTIONS),
+            config_layer=dict(choices=CONFIG_LAYERS),
+            steps=dict(type='list')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        mutually_exclusive=[['action', 'steps'],
+                            ['direction', 'steps'],
+                            ['config_layer', 'steps']],
+        required_one_of=[['action', 'steps']],
+        required_together=[['action', 'direction', 'config_layer']],
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
 from ansible.module_utils.basic import *
-from ansible.module_utils.mysql import *
+from ansible.module_utils.proxysql import *
 if __name__ == '__main__':
     main()
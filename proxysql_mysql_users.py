@@ -29,7 +29,7 @@ options:
   username:
     description:
       - Name of the user connecting to the mysqld or ProxySQL instance.
-    required: True
+        Required unless I(users) is supplied.
   password:
     description:
       - Password of the user connecting to the mysqld or ProxySQL instance.
@@ -80,6 +80,17 @@ options:
       - The maximum number of connections ProxySQL will open to the backend
         for this user.
         If ommitted the proxysql default for I(max_connections) is 10000.
+  users:
+    description:
+      - A list of users to be reconciled in a single run. Each entry is a dict
+        which accepts the same keys as the single user options (I(username),
+        I(password), I(active), I(use_ssl), I(default_hostgroup),
+        I(default_schema), I(transaction_persistent), I(fast_forward),
+        I(backend), I(frontend) and I(max_connections)), any key omitted from
+        an entry falls back to the value of the corresponding module option.
+        The whole list is compared against a single read of mysql_users,
+        changes are written in batches and the config is saved and loaded
+        once at the end. Mutually exclusive with I(username).
   state:
     description:
       - When C(present) - adds the user, when C(absent) - removes the user.
@@ -89,10 +100,16 @@ options:
     description:
       - Save mysql host config to sqlite db on disk to persist the
         configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   load_to_runtime:
     description:
       - Dynamically load mysql host config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   login_user:
     description:
@@ -115,6 +132,63 @@ options:
       - Specify a config file from which login_user and login_password are to
         be read
     default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
 '''
 
 EXAMPLES = '''
@@ -140,6 +214,19 @@ EXAMPLES = '''
     config_file: '~/proxysql.cnf'
     username: 'mysqlboy'
     state: absent
+
+# This example makes sure a set of users exist in a single run, reading
+# mysql_users once and saving and loading the config once at the end.
+
+- proxysql_mysql_users:
+    config_file: '~/proxysql.cnf'
+    default_hostgroup: 1
+    users:
+      - username: 'app_rw'
+        password: 'app_rw_pass'
+      - username: 'app_ro'
+        password: 'app_ro_pass'
+        default_hostgroup: 2
 '''
 
 RETURN = '''
@@ -168,17 +255,41 @@ stdout:
         },
         "username": "guest_ro"
     }
+users:
+    description: When I(users) is supplied, the result for each entry in the
+                 same order as the list, with the diff of the entry.
+                 Passwords are masked.
+    returned: When I(users) is supplied
+    type: list
+    sample": [
+        {
+            "changed": true,
+            "msg": "Added user to mysql_users",
+            "user": {
+                "active": "1",
+                "backend": "1",
+                "default_hostgroup": "1",
+                "default_schema": null,
+                "fast_forward": "0",
+                "frontend": "1",
+                "max_connections": "10000",
+                "password": "********",
+                "schema_locked": "0",
+                "transaction_persistent": "0",
+                "use_ssl": "0",
+                "username": "app_rw"
+            },
+            "username": "app_rw"
+        }
+    ]
 '''
 
 import sys
 
 try:
     import MySQLdb
-    import MySQLdb.cursors
 except ImportError:
-    mysqldb_found = False
-else:
-    mysqldb_found = True
+    pass
 
 # ===========================================
 # proxysql module specific support methods.
@@ -186,38 +297,68 @@ else:
 
 
 def perform_checks(module):
-    if module.params["login_port"] < 0 \
-       or module.params["login_port"] > 65535:
-        module.fail_json(
-            msg="login_port must be a valid unix port number (0-65535)"
-        )
-
-    if not mysqldb_found:
+    perform_common_checks(module)
+
+    if module.params["users"] is not None:
+        user_keys = set()
+        for user in module.params["users"]:
+            user_params = get_user_params(module, user)
+
+            # keep the passwords out of the output, the same as the password
+            # option's no_log does for a single user
+            if user_params["password"]:
+                module.no_log_values.add(user_params["password"])
+
+            user_key = (user_params["username"],
+                        user_params["backend"],
+                        user_params["frontend"])
+            if user_key in user_keys:
+                module.fail_json(
+                    msg=("The user %s appears more than once with the same" +
+                         " backend and frontend settings") %
+                    user_params["username"]
+                )
+            user_keys.add(user_key)
+
+
+def get_user_params(module, user):
+    user_params = get_entry_params(module,
+                                   MYSQL_USERS,
+                                   user,
+                                   MYSQL_USERS.columns,
+                                   "users")
+
+    if not user_params["username"]:
         module.fail_json(
-            msg="the python mysqldb module is required"
+            msg="username is required for each entry in users"
         )
 
+    return user_params
 
-def save_config_to_disk(cursor):
-    cursor.execute("SAVE MYSQL USERS TO DISK")
-    return True
 
-
-def load_config_to_runtime(cursor):
-    cursor.execute("LOAD MYSQL USERS TO RUNTIME")
-    return True
+def get_change_msg(check_mode, action, preposition):
+    if not check_mode:
+        return "%s user %s mysql_users" % (action.capitalize(),
+                                           preposition)
+    else:
+        return ("User would have been %s %s mysql_users, however" +
+                " check_mode is enabled.") % (action, preposition)
 
 
 class ProxySQLUser(object):
 
-    def __init__(self, module):
+    def __init__(self, module, user_params=None):
         self.state = module.params["state"]
-        self.save_to_disk = module.params["save_to_disk"]
-        self.load_to_runtime = module.params["load_to_runtime"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
 
-        self.username = module.params["username"]
-        self.backend = module.params["backend"]
-        self.frontend = module.params["frontend"]
+        if user_params is None:
+            user_params = module.params
+
+        self.username = user_params["username"]
+        self.backend = user_params["backend"]
+        self.frontend = user_params["frontend"]
 
         config_data_keys = ["password",
                             "active",
@@ -228,142 +369,58 @@ class ProxySQLUser(object):
                             "fast_forward",
                             "max_connections"]
 
-        self.config_data = dict((k, module.params[k])
+        self.config_data = dict((k, user_params[k])
                                 for k in (config_data_keys))
 
-    def check_user_config_exists(self, cursor):
-        query_string = \
-            """SELECT count(*) AS `user_count`
-               FROM mysql_users
-               WHERE username = %s
-                 AND backend = %s
-                 AND frontend = %s"""
-
-        query_data = \
-            [self.username,
-             self.backend,
-             self.frontend]
-
-        cursor.execute(query_string, query_data)
-        check_count = cursor.fetchone()
-        return (int(check_count['user_count']) > 0)
-
-    def check_user_privs(self, cursor):
-        query_string = \
-            """SELECT count(*) AS `user_count`
-               FROM mysql_users
-               WHERE username = %s
-                 AND backend = %s
-                 AND frontend = %s"""
-
-        query_data = \
-            [self.username,
-             self.backend,
-             self.frontend]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                query_data.append(val)
-                query_string += "\n  AND " + col + " = %s"
-
-        cursor.execute(query_string, query_data)
-        check_count = cursor.fetchone()
-        return (int(check_count['user_count']) > 0)
+    def get_key_data(self):
+        return {"username": self.username,
+                "backend": self.backend,
+                "frontend": self.frontend}
 
-    def get_user_config(self, cursor):
-        query_string = \
-            """SELECT *
-               FROM mysql_users
-               WHERE username = %s
-                 AND backend = %s
-                 AND frontend = %s"""
-
-        query_data = \
-            [self.username,
-             self.backend,
-             self.frontend]
-
-        cursor.execute(query_string, query_data)
-        user = cursor.fetchone()
-        return user
+    def user_key(self):
+        return MYSQL_USERS.get_key(self.get_key_data())
 
-    def create_user_config(self, cursor):
-        query_string = \
-            """INSERT INTO mysql_users (
-               username,
-               backend,
-               frontend"""
-
-        cols = 3
-        query_data = \
-            [self.username,
-             self.backend,
-             self.frontend]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                query_string += ",\n" + col
-
-        query_string += \
-            (")\n" +
-             "VALUES (" +
-             "%s ," * cols)
-
-        query_string = query_string[:-2]
-        query_string += ")"
-
-        cursor.execute(query_string, query_data)
-        return True
-
-    def update_user_config(self, cursor):
-        query_string = """UPDATE mysql_users"""
+    def get_user_diff(self, user):
+        config_data = self.config_data
 
-        cols = 0
-        query_data = []
+        # a snapshot gathered without passwords can't tell whether the
+        # password differs, so it's left out of the comparison
+        if user is not None and "password" not in user:
+            config_data = dict((k, v) for k, v in config_data.items()
+                               if k != "password")
 
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                if cols == 1:
-                    query_string += "\nSET " + col + "= %s,"
-                else:
-                    query_string += "\n    " + col + " = %s,"
+        return ConfigDiff(user,
+                          config_data,
+                          self.state,
+                          key_data=self.get_key_data(),
+                          masked_cols=["password"])
 
-        query_string = query_string[:-1]
-        query_string += ("\nWHERE username = %s\n  AND backend = %s" +
-                         "\n  AND frontend = %s")
-
-        query_data.append(self.username)
-        query_data.append(self.backend)
-        query_data.append(self.frontend)
+    def get_user_config(self, cursor):
+        return ProxySQLRowStore(cursor,
+                                MYSQL_USERS).select_one(self.get_key_data())
 
-        cursor.execute(query_string, query_data)
+    def create_user_config(self, cursor):
+        row_data = self.get_key_data()
+        row_data.update(self.config_data)
+        ProxySQLRowStore(cursor, MYSQL_USERS).insert(row_data)
         return True
 
+    def update_user_config(self, cursor):
+        return ProxySQLRowStore(cursor,
+                                MYSQL_USERS).update(self.get_key_data(),
+                                                    self.config_data)
+
     def delete_user_config(self, cursor):
-        query_string = \
-            """DELETE FROM mysql_users
-               WHERE username = %s
-                 AND backend = %s
-                 AND frontend = %s"""
-
-        query_data = \
-            [self.username,
-             self.backend,
-             self.frontend]
-
-        cursor.execute(query_string, query_data)
+        ProxySQLRowStore(cursor, MYSQL_USERS).delete(self.get_key_data())
         return True
 
     def manage_config(self, cursor, state):
         if state:
-            if self.save_to_disk:
-                save_config_to_disk(cursor)
-            if self.load_to_runtime:
-                load_config_to_runtime(cursor)
+            save_and_load_config(cursor,
+                                 MYSQL_USERS.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
 
     def create_user(self, check_mode, result, cursor):
         if not check_mode:
@@ -397,8 +454,6 @@ class ProxySQLUser(object):
 
     def delete_user(self, check_mode, result, cursor):
         if not check_mode:
-            result['user'] = \
-                self.get_user_config(cursor)
             result['changed'] = \
                 self.delete_user_config(cursor)
             result['msg'] = "Deleted user from mysql_users"
@@ -410,57 +465,151 @@ class ProxySQLUser(object):
                              " mysql_users, however check_mode is" +
                              " enabled.")
 
+
+class ProxySQLUserList(object):
+
+    def __init__(self, module):
+        self.state = module.params["state"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+
+        self.users = [ProxySQLUser(module, get_user_params(module, user))
+                      for user in module.params["users"]]
+
+    def get_all_user_config(self, cursor):
+        return ProxySQLRowStore(cursor, MYSQL_USERS).select_all_by_key()
+
+    def create_user_configs(self, cursor, users):
+        rows = []
+        for user in users:
+            row_data = user.get_key_data()
+            row_data.update(user.config_data)
+            rows.append(row_data)
+
+        return ProxySQLRowStore(cursor, MYSQL_USERS).insert_many(rows)
+
+    def delete_user_configs(self, cursor, user_keys):
+        return ProxySQLRowStore(cursor, MYSQL_USERS).delete_many(user_keys)
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(cursor,
+                                 MYSQL_USERS.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
+
+    def manage_users(self, check_mode, result, cursor):
+        existing_users = self.get_all_user_config(cursor)
+
+        users_to_create = []
+        users_to_update = []
+        users_to_delete = []
+
+        user_diffs = {}
+
+        for user in self.users:
+            user_diff = user.get_user_diff(existing_users.get(user.user_key()))
+            if user_diff.action == "create":
+                users_to_create.append(user)
+            elif user_diff.action == "update":
+                users_to_update.append(user)
+            elif user_diff.action == "delete":
+                users_to_delete.append(user)
+            user_diffs[user] = user_diff
+
+        result['changed'] = bool(users_to_create or
+                                 users_to_update or
+                                 users_to_delete)
+
+        if result['changed'] and not check_mode:
+            self.create_user_configs(cursor, users_to_create)
+            for user in users_to_update:
+                user.update_user_config(cursor)
+            self.delete_user_configs(cursor,
+                                     [user.user_key()
+                                      for user in users_to_delete])
+            self.manage_config(cursor,
+                               result['changed'])
+            if users_to_create or users_to_update:
+                current_users = self.get_all_user_config(cursor)
+            else:
+                current_users = existing_users
+        else:
+            current_users = existing_users
+
+        result['users'] = []
+        for user in self.users:
+            user_diff = user_diffs[user]
+            user_result = {'username': user.username,
+                           'changed': user_diff.changed}
+
+            if user_diff.action == "create":
+                user_result['msg'] = \
+                    get_change_msg(check_mode, "added", "to")
+            elif user_diff.action == "update":
+                user_result['msg'] = \
+                    get_change_msg(check_mode, "updated", "in")
+            elif user_diff.action == "delete":
+                user_result['msg'] = \
+                    get_change_msg(check_mode, "deleted", "from")
+            elif self.state == "present":
+                user_result['msg'] = ("The user already exists in" +
+                                      " mysql_users and doesn't need to be" +
+                                      " updated.")
+            else:
+                user_result['msg'] = ("The user is already absent from the" +
+                                      " mysql_users memory configuration")
+
+            if user_diff.action == "delete":
+                user_row = existing_users.get(user.user_key())
+            else:
+                user_row = current_users.get(user.user_key())
+            if user_row:
+                user_result['user'] = user_diff.mask(dict(user_row))
+            user_result['diff'] = user_diff.get_diff()
+
+            result['users'].append(user_result)
+
+        result['diff'] = [user_diffs[user].get_diff() for user in self.users
+                          if user_diffs[user].changed]
+
+        summary = (len(users_to_create),
+                   len(users_to_update),
+                   len(users_to_delete))
+        if not check_mode:
+            result['msg'] = ("Added %d, updated %d and deleted %d users" +
+                             " in mysql_users") % summary
+        else:
+            result['msg'] = ("%d users would have been added, %d updated" +
+                             " and %d deleted in mysql_users, however" +
+                             " check_mode is enabled.") % summary
+
 # ===========================================
 # Module execution.
 #
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            login_user=dict(default=None, type='str'),
-            login_password=dict(default=None, no_log=True, type='str'),
-            login_host=dict(default="127.0.0.1"),
-            login_unix_socket=dict(default=None),
-            login_port=dict(default=6032, type='int'),
-            config_file=dict(default='', type='path'),
-            username=dict(required=True, type='str'),
-            password=dict(no_log=True, type='str'),
-            active=dict(type='bool'),
-            use_ssl=dict(type='bool'),
-            default_hostgroup=dict(type='int'),
-            default_schema=dict(type='str'),
-            transaction_persistent=dict(type='bool'),
-            fast_forward=dict(type='bool'),
-            backend=dict(default=True, type='bool'),
-            frontend=dict(default=True, type='bool'),
-            max_connections=dict(type='int'),
-            state=dict(default='present', choices=['present',
-                                                   'absent']),
-            save_to_disk=dict(default=True, type='bool'),
-            load_to_runtime=dict(default=True, type='bool')
-        ),
-        supports_check_mode=True
-    )
+def run_module(module):
+    cursor = proxysql_connect(module)
 
-    perform_checks(module)
+    if module.params["users"] is not None:
+        proxysql_users = ProxySQLUserList(module)
+        result = {}
+        result['state'] = proxysql_users.state
 
-    login_user = module.params["login_user"]
-    login_password = module.params["login_password"]
-    config_file = module.params["config_file"]
+        try:
+            proxysql_users.manage_users(module.check_mode,
+                                        result,
+                                        cursor)
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to modify users.. %s" % e
+            )
 
-    cursor = None
-    try:
-        cursor = mysql_connect(module,
-                               login_user,
-                               login_password,
-                               config_file,
-                               cursor_class=MySQLdb.cursors.DictCursor)
-    except MySQLdb.Error:
-        e = sys.exc_info()[1]
-        module.fail_json(
-            msg="unable to connect to ProxySQL Admin Module.. %s" % e
-        )
+        module.exit_json(**result)
 
     proxysql_user = ProxySQLUser(module)
     result = {}
@@ -469,24 +618,33 @@ def main():
     if proxysql_user.username:
         result['username'] = proxysql_user.username
 
+    try:
+        user_diff = \
+            proxysql_user.get_user_diff(proxysql_user.get_user_config(cursor))
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to get user.. %s" % e
+        )
+
+    result['diff'] = user_diff.get_diff()
+
     if proxysql_user.state == "present":
         try:
-            if not proxysql_user.check_user_privs(cursor):
-                if not proxysql_user.check_user_config_exists(cursor):
-                    proxysql_user.create_user(module.check_mode,
-                                              result,
-                                              cursor)
-                else:
-                    proxysql_user.update_user(module.check_mode,
-                                              result,
-                                              cursor)
+            if user_diff.action == "create":
+                proxysql_user.create_user(module.check_mode,
+                                          result,
+                                          cursor)
+            elif user_diff.action == "update":
+                proxysql_user.update_user(module.check_mode,
+                                          result,
+                                          cursor)
             else:
                 result['changed'] = False
                 result['msg'] = ("The user already exists in mysql_users" +
                                  " and doesn't need to be updated.")
-                result['user'] = \
-                    proxysql_user.get_user_config(cursor)
-        except MySQLdb.Error:
+                result['user'] = user_diff.current
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to modify user.. %s" % e
@@ -494,7 +652,8 @@ def main():
 
     elif proxysql_user.state == "absent":
         try:
-            if proxysql_user.check_user_config_exists(cursor):
+            if user_diff.action == "delete":
+                result['user'] = user_diff.current
                 proxysql_user.delete_user(module.check_mode,
                                           result,
                                           cursor)
@@ -502,7 +661,7 @@ def main():
                 result['changed'] = False
                 result['msg'] = ("The user is already absent from the" +
                                  " mysql_users memory configuration")
-        except MySQLdb.Error:
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to remove user.. %s" % e
@@ -510,7 +669,45 @@ def main():
 
     module.exit_json(**result)
 
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            username=dict(type='str'),
+            password=dict(no_log=True, type='str'),
+            active=dict(type='bool'),
+            use_ssl=dict(type='bool'),
+            default_hostgroup=dict(type='int'),
+            default_schema=dict(type='str'),
+            transaction_persistent=dict(type='bool'),
+            fast_forward=dict(type='bool'),
+            backend=dict(default=True, type='bool'),
+            frontend=dict(default=True, type='bool'),
+            max_connections=dict(type='int'),
+            users=dict(type='list'),
+            state=dict(default='present', choices=['present',
+                                                   'absent']),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        mutually_exclusive=[['username', 'users']],
+        required_one_of=[['username', 'users']],
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
 from ansible.module_utils.basic import *
-from ansible.module_utils.mysql import *
+from ansible.module_utils.proxysql import *
 if __name__ == '__main__':
     main()
@@ -142,6 +142,35 @@ options:
     description:
       - Free form text field, usable for a descriptive comment of the query
         rule. [string]
+  rules:
+    description:
+      - A list of rules to be reconciled in a single run, in the order they
+        should be processed.  Each entry is a dict which accepts the same keys
+        as the single rule options, any key omitted from an entry falls back
+        to the value of the corresponding module option.
+      - With I(state=present) the list describes every rule in
+        I(rule_id_range), any other rule in the range is removed.  An entry
+        with a I(rule_id) keeps it.  An entry without one takes the
+        I(rule_id) of the rule in the range with the same settings, or is
+        given a new I(rule_id) between those of its neighbours, so adding a
+        rule never renumbers the existing ones.  Each entry describes the
+        whole rule, a column it doesn't set is put back to its default in
+        mysql_query_rules.  Rules are written in batches and the config is
+        saved and loaded once at the end.
+      - With I(state=absent) the listed rules are removed, matched by
+        I(rule_id) or else by their settings.
+      - Mutually exclusive with I(rule_id).
+  rule_id_range:
+    description:
+      - The first and last I(rule_id) owned by I(rules), as a list of two
+        integers.  Rules outside the range are left untouched.  By default
+        the whole of mysql_query_rules is owned.
+    default: None
+  rule_id_step:
+    description:
+      - The gap left between the I(rule_id) given to new entries in I(rules)
+        when there's room for it, so later rules can be added in between.
+    default: 10
   state:
     description:
       - When C(present) - adds the rule, when C(absent) - removes the rule.
@@ -153,14 +182,86 @@ options:
         however if you need this behaviour and you're not concerned about the
         schedules deleted, you can set I(force_delete) to C(True).
     default: False
+  check_flag_chains:
+    description:
+      - Check the I(flagIN)/I(flagOUT) chains of mysql_query_rules as they
+        would be after the change, before writing it, whenever the change
+        adds or updates rules.  The task fails if the
+        chains have a cycle, which would send the queries which follow it
+        round for ever, or go over I(max_chain_depth) or
+        I(max_rules_evaluated).  The outcome is returned in I(flag_chains).
+      - Without I(rules), only a cycle through the flagIN or flagOUT of the
+        rule, or a limit which the change takes the chains over, fails the
+        task.  Problems already in the rest of the table are returned as
+        warnings.
+    default: True
+  max_chain_depth:
+    description:
+      - The most chains a query may be sent through with I(flagOUT) after
+        chain 0.
+    default: None
+  max_rules_evaluated:
+    description:
+      - The most rules a query may be evaluated against in the worst case,
+        counting a pass over every rule in the table for each chain it goes
+        through.
+    default: None
+  check_regexes:
+    description:
+      - Compile the I(match_digest), I(match_pattern) and I(replace_pattern)
+        of the rules being added or updated before writing them, and look
+        for constructs which backtrack badly, a quantifier nested inside
+        another unbounded one, or a leading C(.*) which isn't anchored.  The
+        constructs found are returned in I(regex_lint).  The regexes are
+        compiled with python's C(re), which doesn't know some PCRE and RE2
+        constructs such as possessive quantifiers, atomic groups, C(\\h) or
+        C((?<name>...)), so a regex it can't parse is returned as not checked
+        rather than failing the task.
+    default: False
+  regex_samples_file:
+    description:
+      - Time each regex against the samples in this file as well, and
+        return the average time a sample took in microseconds in
+        I(regex_lint).  The file takes the same formats as the
+        I(samples_file) of M(proxysql_query_rules_simulate), I(match_digest)
+        is timed against the I(digest_text) of the samples and
+        I(match_pattern) against the I(query).  Regexes with a nested
+        quantifier aren't timed.
+    default: None
+  max_regex_match_time:
+    description:
+      - The longest average time in microseconds a regex may take against
+        the samples in I(regex_samples_file).  The task fails if a regex
+        takes longer.
+    default: None
+  return_rules:
+    description:
+      - What to return in I(rules).  C(full) returns the matching rules,
+        C(keys) returns only the I(rule_id) of each of them, and C(none)
+        leaves I(rules) out, which also saves reading the rules back after a
+        change.
+    choices: [ "full", "keys", "none" ]
+    default: full
+  return_rules_limit:
+    description:
+      - The most rules to return in I(rules), and to list in the diff when
+        removing rules.  The number of rules left out is returned in
+        I(rules_omitted).  By default every matching rule is returned.
+    default: None
   save_to_disk:
     description:
       - Save mysql host config to sqlite db on disk to persist the
         configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   load_to_runtime:
     description:
       - Dynamically load mysql host config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   login_user:
     description:
@@ -183,6 +284,63 @@ options:
       - Specify a config file from which login_user and login_password are to
         be read
     default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
 '''
 
 EXAMPLES = '''
@@ -214,6 +372,24 @@ EXAMPLES = '''
     username: 'guest_ro'
     state: absent
     force_delete: true
+
+# This example makes rule_ids 100 to 199 hold exactly the supplied rules in
+# the supplied order, any other rule in the range is deleted.  New rules are
+# given rule_ids 10 apart, and the mysql query rule config is loaded to
+# runtime once.
+
+- proxysql_query_rules:
+    login_user: admin
+    login_password: admin
+    rule_id_range: [100, 199]
+    active: True
+    apply: True
+    rules:
+      - match_digest: '^SELECT .* FOR UPDATE$'
+        destination_hostgroup: 1
+      - match_digest: '^SELECT'
+        destination_hostgroup: 2
+    state: present
 '''
 
 RETURN = '''
@@ -258,53 +434,345 @@ stdout:
         ],
         "state": "present"
     }
+rules:
+    description: The per entry results when I(rules) is supplied, in place
+                 of the matching rules.
+    returned: When I(rules) is supplied and I(return_rules) isn't C(none),
+              in the same order as the supplied list.
+    type: list
+    "sample": [
+        {
+            "changed": true,
+            "msg": "Added rule to mysql_query_rules",
+            "rule": {
+                "active": "1",
+                "apply": "1",
+                "destination_hostgroup": "2",
+                "match_digest": "^SELECT",
+                "rule_id": "110"
+            },
+            "rule_id": 110
+        }
+    ]
+purged:
+    description: The rules in I(rule_id_range) removed because they aren't in
+                 I(rules).
+    returned: When I(rules) is supplied with I(state=present) and
+              I(return_rules) isn't C(none).
+    type: list
+    "sample": [
+        {
+            "rule_id": "120"
+        }
+    ]
+flag_chains:
+    description: The flag chains of the rules as they would be after the
+                 change.  I(max_chain_depth) and
+                 I(worst_case_rules_evaluated) are null when there's a
+                 cycle.
+    returned: When the flag chains were checked.
+    type: dict
+    "sample": {
+        "cycles": [],
+        "max_chain_depth": 2,
+        "unreachable_rules": [
+            300
+        ],
+        "worst_case_rules_evaluated": 140
+    }
+regex_lint:
+    description: The regexes of the rules being added or updated, with the
+                 constructs found which backtrack badly in I(issues), and
+                 the average time in microseconds a sample took in
+                 I(match_time) when I(regex_samples_file) is supplied.
+    returned: When I(check_regexes) is enabled and rules are added or
+              updated.
+    type: list
+    "sample": [
+        {
+            "column": "match_digest",
+            "issues": [
+                "unanchored leading wildcard"
+            ],
+            "match_time": 1.42,
+            "pattern": ".*FOR UPDATE$",
+            "rule_id": "30"
+        }
+    ]
 '''
 
+import csv
 import sys
 
 try:
     import MySQLdb
-    import MySQLdb.cursors
 except ImportError:
-    mysqldb_found = False
-else:
-    mysqldb_found = True
+    pass
 
 # ===========================================
 # proxysql module specific support methods.
 #
 
 
+RULE_ID_STEP = 10
+
+
+class RuleIdAllocationError(Exception):
+    pass
+
+
+class FlagChainError(Exception):
+    pass
+
+
+class RegexLintError(Exception):
+    pass
+
+
 def perform_checks(module):
-    if module.params["login_port"] < 0 \
-       or module.params["login_port"] > 65535:
+    perform_common_checks(module)
+
+    for param in ("max_chain_depth", "max_rules_evaluated"):
+        if module.params[param] is not None and module.params[param] < 0:
+            module.fail_json(
+                msg="%s must be a integer greater than or equal to 0" % param
+            )
+
+    if module.params["return_rules_limit"] is not None and \
+            module.params["return_rules_limit"] < 0:
+        module.fail_json(
+            msg=("return_rules_limit must be a integer greater than or" +
+                 " equal to 0")
+        )
+
+    if module.params["max_regex_match_time"] is not None and \
+            module.params["max_regex_match_time"] <= 0:
+        module.fail_json(
+            msg="max_regex_match_time must be greater than 0"
+        )
+
+    if module.params["regex_samples_file"] is not None and \
+            not module.params["check_regexes"]:
+        module.fail_json(
+            msg="regex_samples_file can only be used along with check_regexes"
+        )
+
+    if module.params["max_regex_match_time"] is not None and \
+            module.params["regex_samples_file"] is None:
+        module.fail_json(
+            msg=("max_regex_match_time can only be used along with" +
+                 " regex_samples_file")
+        )
+
+    if module.params["rule_id_step"] < 1:
+        module.fail_json(
+            msg="rule_id_step must be a integer greater than 0"
+        )
+
+    if module.params["rules"] is not None:
+        if module.params["rule_id"] is not None:
+            module.fail_json(
+                msg=("rule_id can't be used along with rules, set it on the" +
+                     " entries instead")
+            )
+
+        first_rule_id, last_rule_id = get_rule_id_range(module)
+
+        rule_ids = []
+        for rule in module.params["rules"]:
+            rule_id = get_rule_params(module, rule)["rule_id"]
+            if rule_id is None:
+                continue
+            if rule_id < first_rule_id or \
+                    (last_rule_id is not None and rule_id > last_rule_id):
+                module.fail_json(
+                    msg="rule_id %d in rules is outside rule_id_range" %
+                        rule_id
+                )
+            if rule_ids and rule_id <= rule_ids[-1]:
+                module.fail_json(
+                    msg=("the rule_ids in rules must increase in the order" +
+                         " the rules are listed, %d follows %d") %
+                        (rule_id, rule_ids[-1])
+                )
+            rule_ids.append(rule_id)
+    elif module.params["rule_id_range"] is not None:
         module.fail_json(
-            msg="login_port must be a valid unix port number (0-65535)"
+            msg="rule_id_range can only be used along with rules"
         )
 
-    if not mysqldb_found:
+
+def get_rule_params(module, rule):
+    return get_entry_params(module,
+                            MYSQL_QUERY_RULES,
+                            rule,
+                            MYSQL_QUERY_RULES.columns,
+                            "rules")
+
+
+def get_change_msg(check_mode, action, preposition):
+    if not check_mode:
+        return "%s rule %s mysql_query_rules" % (action.capitalize(),
+                                                 preposition)
+    else:
+        return ("Rule would have been %s %s mysql_query_rules, however" +
+                " check_mode is enabled.") % (action, preposition)
+
+
+def limit_result_rules(rules, return_rules_limit, result=None,
+                       omitted_key=None):
+    rules = list(rules or [])
+    if return_rules_limit is not None and \
+            len(rules) > return_rules_limit:
+        if result is not None:
+            result[omitted_key] = len(rules) - return_rules_limit
+        rules = rules[:return_rules_limit]
+    return rules
+
+
+def get_rule_keys(rule):
+    return dict((col, rule[col]) for col in MYSQL_QUERY_RULES.primary_key)
+
+
+def get_desired_rule(current, config_data):
+    rule = dict(current or {})
+    rule.update((col, normalise_value(val))
+                for col, val in config_data.items() if val is not None)
+    return rule
+
+
+def get_cycle_issue(cycles):
+    return ("the flagOUTs would send queries round a cycle of flags %s" %
+            "; ".join(", ".join(str(flag) for flag in cycle)
+                      for cycle in cycles))
+
+
+def get_limit_issues(analysis, max_chain_depth, max_rules_evaluated):
+    # the depth and the worst case aren't known when there's a cycle
+    if analysis["cycles"]:
+        return []
+
+    issues = []
+    if max_chain_depth is not None and \
+            analysis["max_chain_depth"] > max_chain_depth:
+        issues.append((
+            "max_chain_depth",
+            "the flag chains would be %d deep, over max_chain_depth %d" %
+            (analysis["max_chain_depth"], max_chain_depth)))
+
+    if max_rules_evaluated is not None and \
+            analysis["worst_case_rules_evaluated"] > max_rules_evaluated:
+        issues.append((
+            "worst_case_rules_evaluated",
+            ("a query could be evaluated against %d rules, over" +
+             " max_rules_evaluated %d") %
+            (analysis["worst_case_rules_evaluated"], max_rules_evaluated)))
+
+    return issues
+
+
+def check_rule_flag_chains(rules, max_chain_depth, max_rules_evaluated):
+    analysis = analyze_flag_chains(rules)
+
+    if analysis["cycles"]:
+        raise FlagChainError(get_cycle_issue(analysis["cycles"]))
+
+    issues = get_limit_issues(analysis, max_chain_depth, max_rules_evaluated)
+    if issues:
+        raise FlagChainError(issues[0][1])
+
+    return analysis
+
+
+def check_changed_rule_flag_chains(rules, desired_rule, max_chain_depth,
+                                   max_rules_evaluated):
+    # Only the problems the rule has a part in fail the task, which are the
+    # cycles through its flagIN or flagOUT, and limits it takes the chains
+    # over.  The problems already in the rest of the table are returned as
+    # warnings.
+    before = analyze_flag_chains(rules)
+
+    rules = [rule for rule in rules
+             if rule["rule_id"] != desired_rule["rule_id"]]
+    rules.append(desired_rule)
+    analysis = analyze_flag_chains(rules)
+
+    rule_flags = set([rule_flag(desired_rule, "flagIN")])
+    if not rule_is_terminal(desired_rule):
+        rule_flags.add(rule_flag(desired_rule, "flagOUT"))
+    rule_cycles = [cycle for cycle in analysis["cycles"]
+                   if rule_flags & set(str(flag) for flag in cycle)]
+    if rule_cycles:
+        raise FlagChainError(get_cycle_issue(rule_cycles))
+
+    warnings = []
+    other_cycles = [cycle for cycle in analysis["cycles"]
+                    if cycle not in rule_cycles]
+    if other_cycles:
+        warnings.append(get_cycle_issue(other_cycles))
+
+    # a limit the table was already over is only the rule's doing when the
+    # change takes the chains further over it
+    for key, issue in get_limit_issues(analysis,
+                                       max_chain_depth,
+                                       max_rules_evaluated):
+        if before[key] is not None and analysis[key] <= before[key]:
+            warnings.append(issue)
+        else:
+            raise FlagChainError(issue)
+
+    return analysis, warnings
+
+
+def get_regex_sample_texts(module):
+    if module.params["regex_samples_file"] is None:
+        return None
+
+    try:
+        return get_sample_texts(
+            read_query_samples(module.params["regex_samples_file"]))
+    except (IOError, OSError, ValueError, csv.Error):
+        e = sys.exc_info()[1]
         module.fail_json(
-            msg="the python mysqldb module is required"
+            msg="unable to read regex_samples_file.. %s" % e
         )
 
 
-def save_config_to_disk(cursor):
-    cursor.execute("SAVE MYSQL QUERY RULES TO DISK")
-    return True
+def check_rule_regexes(rules, sample_texts, max_regex_match_time):
+    lint = []
+    for rule in rules:
+        lint.extend(lint_rule_regexes(rule, sample_texts))
 
+    for regex_lint in lint:
+        if max_regex_match_time is not None and \
+                regex_lint.get("match_time", 0) > max_regex_match_time:
+            raise RegexLintError(
+                ("%s of rule %s took %sus a query, over" +
+                 " max_regex_match_time %s") %
+                (regex_lint["column"], regex_lint["rule_id"],
+                 regex_lint["match_time"], max_regex_match_time))
 
-def load_config_to_runtime(cursor):
-    cursor.execute("LOAD MYSQL QUERY RULES TO RUNTIME")
-    return True
+    return lint
 
 
 class ProxyQueryRule(object):
 
-    def __init__(self, module):
+    def __init__(self, module, rule_params=None):
         self.state = module.params["state"]
         self.force_delete = module.params["force_delete"]
-        self.save_to_disk = module.params["save_to_disk"]
-        self.load_to_runtime = module.params["load_to_runtime"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+        self.return_rules = module.params["return_rules"]
+        self.return_rules_limit = module.params["return_rules_limit"]
+        self.check_flag_chains = module.params["check_flag_chains"]
+        self.max_chain_depth = module.params["max_chain_depth"]
+        self.max_rules_evaluated = module.params["max_rules_evaluated"]
+        self.check_regexes = module.params["check_regexes"]
+        self.max_regex_match_time = module.params["max_regex_match_time"]
+
+        if rule_params is None:
+            rule_params = module.params
 
         config_data_keys = ["rule_id",
                             "active",
@@ -332,157 +800,111 @@ class ProxyQueryRule(object):
                             "apply",
                             "comment"]
 
-        self.config_data = dict((k, module.params[k])
+        self.config_data = dict((k, rule_params[k])
                                 for k in (config_data_keys))
 
-    def check_rule_pk_exists(self, cursor):
-        query_string = \
-            """SELECT count(*) AS `rule_count`
-               FROM mysql_query_rules
-               WHERE rule_id = %s"""
-
-        query_data = \
-            [self.config_data["rule_id"]]
-
-        cursor.execute(query_string, query_data)
-        check_count = cursor.fetchone()
-        return (int(check_count['rule_count']) > 0)
-
-    def check_rule_cfg_exists(self, cursor):
-        query_string = \
-            """SELECT count(*) AS `rule_count`
-               FROM mysql_query_rules"""
-
-        cols = 0
-        query_data = []
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                if cols == 1:
-                    query_string += "\n WHERE " + col + " = %s"
-                else:
-                    query_string += "\n  AND " + col + " = %s"
+    def get_existing_rules(self, cursor):
+        if self.state == "present" and \
+                self.config_data["rule_id"] is not None:
+            rule = self.get_rule_config(cursor,
+                                        self.config_data["rule_id"])
+            if rule:
+                return [rule]
+            else:
+                return []
+        else:
+            return list(self.get_rule_config(cursor))
 
-        if cols > 0:
-            cursor.execute(query_string, query_data)
+    def get_rule_diff(self, rules):
+        if self.state == "present" and rules:
+            return ConfigDiff(rules[0],
+                              self.config_data,
+                              self.state)
         else:
-            cursor.execute(query_string)
-        check_count = cursor.fetchone()
-        return int(check_count['rule_count'])
+            return ConfigDiff(None,
+                              self.config_data,
+                              self.state)
+
+    def limit_rules(self, rules, result):
+        return limit_result_rules(rules,
+                                  self.return_rules_limit,
+                                  result,
+                                  'rules_omitted')
+
+    def set_result_rules(self, result, rules):
+        if self.return_rules == "none":
+            return
+
+        rules = self.limit_rules(rules, result)
+        if self.return_rules == "keys":
+            rules = [get_rule_keys(rule) for rule in rules]
+        result['rules'] = rules
+
+    def get_flag_chains(self, cursor, current):
+        # the rule can close a cycle through a flagOUT it already has, by
+        # being activated or moved to another flagIN, so the chains are
+        # checked whatever the change
+        if not self.check_flag_chains:
+            return None, []
+
+        rules = ProxySQLRowStore(cursor, MYSQL_QUERY_RULES).select()
+
+        desired_rule = get_desired_rule(current, self.config_data)
+        if desired_rule.get("rule_id") is None:
+            desired_rule["rule_id"] = \
+                str(max([get_rule_id(rule) for rule in rules] + [0]) + 1)
+
+        return check_changed_rule_flag_chains(rules,
+                                              desired_rule,
+                                              self.max_chain_depth,
+                                              self.max_rules_evaluated)
+
+    def get_regex_lint(self, current, sample_texts):
+        if not self.check_regexes:
+            return None
+
+        return check_rule_regexes([get_desired_rule(current,
+                                                    self.config_data)],
+                                  sample_texts,
+                                  self.max_regex_match_time)
+
+    def matches(self, rule):
+        return all(not values_differ(val, rule.get(col))
+                   for col, val in self.config_data.items()
+                   if col != "rule_id")
 
     def get_rule_config(self, cursor, created_rule_id=None):
-        query_string = \
-                    """SELECT *
-                       FROM mysql_query_rules"""
+        rule_store = ProxySQLRowStore(cursor, MYSQL_QUERY_RULES)
 
-        if created_rule_id:
-            query_data = [created_rule_id, ]
-            query_string += "\nWHERE rule_id = %s"
-
-            cursor.execute(query_string, query_data)
-            rule = cursor.fetchone()
+        if created_rule_id is not None:
+            return rule_store.select_one({"rule_id": created_rule_id})
         else:
-            cols = 0
-            query_data = []
-
-            for col, val in self.config_data.iteritems():
-                if val is not None:
-                    cols += 1
-                    query_data.append(val)
-                    if cols == 1:
-                        query_string += "\n WHERE " + col + " = %s"
-                    else:
-                        query_string += "\n  AND " + col + " = %s"
-
-            if cols > 0:
-                cursor.execute(query_string, query_data)
-            else:
-                cursor.execute(query_string)
-            rule = cursor.fetchall()
-
-        return rule
+            return rule_store.select(self.config_data)
 
     def create_rule_config(self, cursor):
-        query_string = \
-            """INSERT INTO mysql_query_rules ("""
-
-        cols = 0
-        query_data = []
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                query_string += "\n" + col + ","
-
-        query_string = query_string[:-1]
-
-        query_string += \
-            (")\n" +
-             "VALUES (" +
-             "%s ," * cols)
-
-        query_string = query_string[:-2]
-        query_string += ")"
-
-        cursor.execute(query_string, query_data)
-        new_rule_id = cursor.lastrowid
+        new_rule_id = \
+            ProxySQLRowStore(cursor,
+                             MYSQL_QUERY_RULES).insert(self.config_data)
         return True, new_rule_id
 
     def update_rule_config(self, cursor):
-        query_string = """UPDATE mysql_query_rules"""
-
-        cols = 0
-        query_data = []
-
-        for col, val in self.config_data.iteritems():
-            if val is not None and col != "rule_id":
-                cols += 1
-                query_data.append(val)
-                if cols == 1:
-                    query_string += "\nSET " + col + "= %s,"
-                else:
-                    query_string += "\n    " + col + " = %s,"
-
-        query_string = query_string[:-1]
-        query_string += "\nWHERE rule_id = %s"
-
-        query_data.append(self.config_data["rule_id"])
-
-        cursor.execute(query_string, query_data)
-        return True
+        return ProxySQLRowStore(cursor,
+                                MYSQL_QUERY_RULES).update(self.config_data,
+                                                          self.config_data)
 
     def delete_rule_config(self, cursor):
-        query_string = \
-            """DELETE FROM mysql_query_rules"""
-
-        cols = 0
-        query_data = []
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                if cols == 1:
-                    query_string += "\n WHERE " + col + " = %s"
-                else:
-                    query_string += "\n  AND " + col + " = %s"
-
-        if cols > 0:
-            cursor.execute(query_string, query_data)
-        else:
-            cursor.execute(query_string)
-        check_count = cursor.rowcount
-        return True, int(check_count)
+        check_count = \
+            ProxySQLRowStore(cursor,
+                             MYSQL_QUERY_RULES).delete(self.config_data)
+        return True, check_count
 
     def manage_config(self, cursor, state):
         if state:
-            if self.save_to_disk:
-                save_config_to_disk(cursor)
-            if self.load_to_runtime:
-                load_config_to_runtime(cursor)
+            save_and_load_config(cursor,
+                                 MYSQL_QUERY_RULES.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
 
     def create_rule(self, check_mode, result, cursor):
         if not check_mode:
@@ -491,8 +913,12 @@ class ProxyQueryRule(object):
             result['msg'] = "Added rule to mysql_query_rules"
             self.manage_config(cursor,
                                result['changed'])
-            result['rules'] = \
-                self.get_rule_config(cursor, new_rule_id)
+            if self.return_rules == "full":
+                self.set_result_rules(
+                    result, [self.get_rule_config(cursor, new_rule_id)])
+            elif self.return_rules == "keys":
+                self.set_result_rules(result,
+                                      [{"rule_id": str(new_rule_id)}])
         else:
             result['changed'] = True
             result['msg'] = ("Rule would have been added to" +
@@ -506,8 +932,8 @@ class ProxyQueryRule(object):
             result['msg'] = "Updated rule in mysql_query_rules"
             self.manage_config(cursor,
                                result['changed'])
-            result['rules'] = \
-                self.get_rule_config(cursor)
+            if self.return_rules != "none":
+                self.set_result_rules(result, self.get_rule_config(cursor))
         else:
             result['changed'] = True
             result['msg'] = ("Rule would have been updated in" +
@@ -516,8 +942,6 @@ class ProxyQueryRule(object):
 
     def delete_rule(self, check_mode, result, cursor):
         if not check_mode:
-            result['rules'] = \
-                self.get_rule_config(cursor)
             result['changed'], result['rows_affected'] = \
                 self.delete_rule_config(cursor)
             result['msg'] = "Deleted rule from mysql_query_rules"
@@ -529,110 +953,402 @@ class ProxyQueryRule(object):
                              " mysql_query_rules, however" +
                              " check_mode is enabled.")
 
+
+class ProxyQueryRuleList(object):
+
+    def __init__(self, module):
+        self.state = module.params["state"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+        self.return_rules = module.params["return_rules"]
+        self.return_rules_limit = module.params["return_rules_limit"]
+        self.check_flag_chains = module.params["check_flag_chains"]
+        self.max_chain_depth = module.params["max_chain_depth"]
+        self.max_rules_evaluated = module.params["max_rules_evaluated"]
+        self.check_regexes = module.params["check_regexes"]
+        self.max_regex_match_time = module.params["max_regex_match_time"]
+
+        self.sample_texts = None
+        if self.check_regexes and module.params["state"] == "present":
+            self.sample_texts = get_regex_sample_texts(module)
+
+        self.first_rule_id, self.last_rule_id = get_rule_id_range(module)
+        self.rule_id_step = module.params["rule_id_step"]
+
+        self.rules = [ProxyQueryRule(module, get_rule_params(module, rule))
+                      for rule in module.params["rules"]]
+
+    def rule_id_owned(self, rule_id):
+        return rule_id >= self.first_rule_id and \
+            (self.last_rule_id is None or rule_id <= self.last_rule_id)
+
+    def get_all_rules(self, cursor):
+        return ProxySQLRowStore(cursor, MYSQL_QUERY_RULES).select()
+
+    def get_owned_rules(self, rules):
+        return sorted([rule for rule in rules
+                       if self.rule_id_owned(get_rule_id(rule))],
+                      key=get_rule_id)
+
+    def get_flag_chains(self, all_rules):
+        if not self.check_flag_chains:
+            return None
+
+        rules = [rule for rule in all_rules
+                 if not self.rule_id_owned(get_rule_id(rule))]
+        rules.extend(get_full_rule(rule.config_data) for rule in self.rules)
+
+        return check_rule_flag_chains(rules,
+                                      self.max_chain_depth,
+                                      self.max_rules_evaluated)
+
+    def get_regex_lint(self, rules):
+        if not self.check_regexes:
+            return None
+
+        return check_rule_regexes(
+            [get_full_rule(rule.config_data) for rule in rules],
+            self.sample_texts,
+            self.max_regex_match_time)
+
+    def match_rules(self, existing_rules):
+        existing_by_id = dict((int(rule["rule_id"]), rule)
+                              for rule in existing_rules)
+
+        matched_ids = [rule.config_data["rule_id"] for rule in self.rules]
+        claimed = set(rule_id for rule_id in matched_ids
+                      if rule_id is not None)
+
+        # an entry without a rule_id takes the first unclaimed rule with the
+        # same settings, when the rules are being put in place that rule also
+        # has to fall between the ones matched to its neighbours
+        floor_id = self.first_rule_id - 1
+        for i, rule in enumerate(self.rules):
+            if matched_ids[i] is not None:
+                floor_id = matched_ids[i]
+                continue
+
+            ceiling_id = None
+            if self.state == "present":
+                for rule_id in matched_ids[i + 1:]:
+                    if rule_id is not None:
+                        ceiling_id = rule_id
+                        break
+            else:
+                floor_id = self.first_rule_id - 1
+
+            for existing_rule in existing_rules:
+                rule_id = int(existing_rule["rule_id"])
+                if rule_id <= floor_id or rule_id in claimed:
+                    continue
+                if ceiling_id is not None and rule_id >= ceiling_id:
+                    break
+                if rule.matches(existing_rule):
+                    matched_ids[i] = rule_id
+                    claimed.add(rule_id)
+                    floor_id = rule_id
+                    break
+
+        return matched_ids, existing_by_id
+
+    def get_gap_rule_ids(self, prev_id, next_id, count):
+        start_id = (prev_id // self.rule_id_step + 1) * self.rule_id_step
+        rule_ids = [start_id + i * self.rule_id_step for i in range(count)]
+        if next_id is None or rule_ids[-1] < next_id:
+            return rule_ids
+
+        # not enough room for the step, so spread them out evenly instead
+        if next_id - prev_id > count:
+            return [prev_id + (next_id - prev_id) * (i + 1) // (count + 1)
+                    for i in range(count)]
+
+        raise RuleIdAllocationError(
+            ("there's no room for %d rules between rule_id %d and %d, give" +
+             " some of the rules a rule_id") % (count, prev_id, next_id))
+
+    def allocate_rule_ids(self, rule_ids):
+        rule_ids = list(rule_ids)
+
+        # a new rule is never given rule_id 0, so without a rule_id_range the
+        # first one gets rule_id_step
+        prev_id = max(self.first_rule_id - 1, 0)
+        i = 0
+        while i < len(rule_ids):
+            if rule_ids[i] is not None:
+                prev_id = rule_ids[i]
+                i += 1
+                continue
+
+            j = i
+            while j < len(rule_ids) and rule_ids[j] is None:
+                j += 1
+
+            if j < len(rule_ids):
+                next_id = rule_ids[j]
+            elif self.last_rule_id is not None:
+                next_id = self.last_rule_id + 1
+            else:
+                next_id = None
+
+            rule_ids[i:j] = self.get_gap_rule_ids(prev_id, next_id, j - i)
+            prev_id = rule_ids[j - 1]
+            i = j
+
+        return rule_ids
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(cursor,
+                                 MYSQL_QUERY_RULES.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
+
+    def manage_rules(self, check_mode, result, cursor):
+        all_rules = self.get_all_rules(cursor)
+        existing_rules = self.get_owned_rules(all_rules)
+        matched_ids, existing_by_id = self.match_rules(existing_rules)
+
+        if self.state == "present":
+            rule_ids = self.allocate_rule_ids(matched_ids)
+        else:
+            rule_ids = matched_ids
+
+        rules_to_create = []
+        rules_to_update = []
+        rules_to_delete = []
+
+        rule_diffs = []
+
+        for rule, rule_id in zip(self.rules, rule_ids):
+            if rule_id is not None:
+                rule.config_data["rule_id"] = rule_id
+            # the rules in the range are owned outright, so the whole row is
+            # compared, and a column left out of an entry is back at its
+            # default
+            rule_diff = ConfigDiff(existing_by_id.get(rule_id),
+                                   get_full_rule(rule.config_data),
+                                   self.state,
+                                   full_row=True)
+            if rule_diff.action == "create":
+                rules_to_create.append(rule)
+            elif rule_diff.action == "update":
+                rules_to_update.append(rule)
+            elif rule_diff.action == "delete":
+                rules_to_delete.append(rule)
+            if rule_diff.changed:
+                rule_diffs.append(rule_diff.get_diff())
+
+        if self.state == "present" and (rules_to_create or rules_to_update):
+            regex_lint = self.get_regex_lint(rules_to_create +
+                                             rules_to_update)
+            if regex_lint is not None:
+                result['regex_lint'] = regex_lint
+
+            flag_chains = self.get_flag_chains(all_rules)
+            if flag_chains is not None:
+                result['flag_chains'] = flag_chains
+
+        rules_to_purge = []
+        if self.state == "present":
+            listed_ids = set(rule_ids)
+            rules_to_purge = [rule for rule in existing_rules
+                              if int(rule["rule_id"]) not in listed_ids]
+
+        result['changed'] = bool(rules_to_create or
+                                 rules_to_update or
+                                 rules_to_delete or
+                                 rules_to_purge)
+
+        created = set(rules_to_create)
+        updated = set(rules_to_update)
+        deleted = set(rules_to_delete)
+
+        current_by_id = existing_by_id
+        if result['changed'] and not check_mode:
+            replace_owned_rules(cursor,
+                                [get_full_rule(rule.config_data)
+                                 for rule in rules_to_create],
+                                [get_full_rule(rule.config_data)
+                                 for rule in rules_to_update],
+                                [rule.config_data
+                                 for rule in rules_to_delete] +
+                                rules_to_purge)
+            self.manage_config(cursor,
+                               result['changed'])
+            if self.return_rules == "full" and \
+                    (rules_to_create or rules_to_update):
+                current_by_id = dict((int(rule["rule_id"]), rule)
+                                     for rule in self.get_owned_rules(
+                                         self.get_all_rules(cursor)))
+
+        rule_results = []
+        for rule in self.rules:
+            rule_id = rule.config_data["rule_id"]
+            rule_result = {'rule_id': rule_id,
+                           'changed': True}
+
+            if rule in created:
+                rule_result['msg'] = \
+                    get_change_msg(check_mode, "added", "to")
+            elif rule in updated:
+                rule_result['msg'] = \
+                    get_change_msg(check_mode, "updated", "in")
+            elif rule in deleted:
+                rule_result['msg'] = \
+                    get_change_msg(check_mode, "deleted", "from")
+            elif self.state == "present":
+                rule_result['changed'] = False
+                rule_result['msg'] = ("The rule already exists in" +
+                                      " mysql_query_rules and doesn't need" +
+                                      " to be updated.")
+            else:
+                rule_result['changed'] = False
+                rule_result['msg'] = ("The rule is already absent from the" +
+                                      " mysql_query_rules memory" +
+                                      " configuration")
+
+            if self.return_rules == "full":
+                if rule in deleted:
+                    rule_result['rule'] = existing_by_id.get(rule_id)
+                elif current_by_id.get(rule_id):
+                    rule_result['rule'] = current_by_id.get(rule_id)
+
+            rule_results.append(rule_result)
+
+        if self.return_rules != "none":
+            result['rules'] = limit_result_rules(rule_results,
+                                                 self.return_rules_limit,
+                                                 result,
+                                                 'rules_omitted')
+            if self.state == "present":
+                purged = limit_result_rules(rules_to_purge,
+                                            self.return_rules_limit,
+                                            result,
+                                            'purged_omitted')
+                if self.return_rules == "keys":
+                    purged = [get_rule_keys(rule) for rule in purged]
+                result['purged'] = purged
+
+        rule_diffs.extend({'before': rule, 'after': {}}
+                          for rule in rules_to_purge)
+        result['diff'] = limit_result_rules(rule_diffs,
+                                            self.return_rules_limit)
+
+        summary = (len(rules_to_create),
+                   len(rules_to_update),
+                   len(rules_to_delete) + len(rules_to_purge))
+        if not check_mode:
+            result['msg'] = ("Added %d, updated %d and deleted %d rules" +
+                             " in mysql_query_rules") % summary
+        else:
+            result['msg'] = ("%d rules would have been added, %d updated" +
+                             " and %d deleted in mysql_query_rules, however" +
+                             " check_mode is enabled.") % summary
+
 # ===========================================
 # Module execution.
 #
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            login_user=dict(default=None, type='str'),
-            login_password=dict(default=None, no_log=True, type='str'),
-            login_host=dict(default="127.0.0.1"),
-            login_unix_socket=dict(default=None),
-            login_port=dict(default=6032, type='int'),
-            config_file=dict(default="", type='path'),
-            rule_id=dict(type='int'),
-            active=dict(type='bool'),
-            username=dict(type='str'),
-            schemaname=dict(type='str'),
-            flagIN=dict(type='int'),
-            client_addr=dict(type='str'),
-            proxy_addr=dict(type='str'),
-            proxy_port=dict(type='int'),
-            digest=dict(type='str'),
-            match_digest=dict(type='str'),
-            match_pattern=dict(type='str'),
-            negate_match_pattern=dict(type='bool'),
-            flagOUT=dict(type='int'),
-            replace_pattern=dict(type='str'),
-            destination_hostgroup=dict(type='int'),
-            cache_ttl=dict(type='int'),
-            timeout=dict(type='int'),
-            retries=dict(type='int'),
-            delay=dict(type='int'),
-            mirror_flagOUT=dict(type='int'),
-            mirror_hostgroup=dict(type='int'),
-            error_msg=dict(type='str'),
-            log=dict(type='bool'),
-            apply=dict(type='bool'),
-            comment=dict(type='str'),
-            state=dict(default='present', choices=['present',
-                                                   'absent']),
-            force_delete=dict(default=False, type='bool'),
-            save_to_disk=dict(default=True, type='bool'),
-            load_to_runtime=dict(default=True, type='bool')
-        ),
-        supports_check_mode=True
-    )
+def run_module(module):
+    cursor = proxysql_connect(module)
 
-    perform_checks(module)
+    result = {}
+
+    if module.params["rules"] is not None:
+        proxysql_query_rules = ProxyQueryRuleList(module)
+        result['state'] = proxysql_query_rules.state
+
+        try:
+            proxysql_query_rules.manage_rules(module.check_mode,
+                                              result,
+                                              cursor)
+        except RuleIdAllocationError:
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to allocate rule_ids.. %s" % e
+            )
+        except (FlagChainError, RegexLintError):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to modify rules.. %s" % e
+            )
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to modify rules.. %s" % e
+            )
 
-    login_user = module.params["login_user"]
-    login_password = module.params["login_password"]
-    config_file = module.params["config_file"]
+        module.exit_json(**result)
+
+    proxysql_query_rule = ProxyQueryRule(module)
+
+    result['state'] = proxysql_query_rule.state
 
-    cursor = None
     try:
-        cursor = mysql_connect(module,
-                               login_user,
-                               login_password,
-                               config_file,
-                               cursor_class=MySQLdb.cursors.DictCursor)
+        existing_rules = proxysql_query_rule.get_existing_rules(cursor)
     except MySQLdb.Error:
         e = sys.exc_info()[1]
         module.fail_json(
-            msg="unable to connect to ProxySQL Admin Module.. %s" % e
+            msg="unable to get rules.. %s" % e
         )
 
-    proxysql_query_rule = ProxyQueryRule(module)
-    result = {}
-
-    result['state'] = proxysql_query_rule.state
-
     if proxysql_query_rule.state == "present":
+        rule_diff = proxysql_query_rule.get_rule_diff(existing_rules)
+        result['diff'] = rule_diff.get_diff()
+
         try:
-            if not proxysql_query_rule.check_rule_cfg_exists(cursor):
-                if proxysql_query_rule.config_data["rule_id"] and \
-                       proxysql_query_rule.check_rule_pk_exists(cursor):
-                    proxysql_query_rule.update_rule(module.check_mode,
-                                                    result,
-                                                    cursor)
-                else:
-                    proxysql_query_rule.create_rule(module.check_mode,
-                                                    result,
-                                                    cursor)
+            if rule_diff.action in ("create", "update"):
+                regex_lint = \
+                    proxysql_query_rule.get_regex_lint(
+                        rule_diff.current, get_regex_sample_texts(module))
+                if regex_lint is not None:
+                    result['regex_lint'] = regex_lint
+
+                flag_chains, warnings = \
+                    proxysql_query_rule.get_flag_chains(cursor,
+                                                        rule_diff.current)
+                if flag_chains is not None:
+                    result['flag_chains'] = flag_chains
+                if warnings:
+                    result['warnings'] = warnings
+
+            if rule_diff.action == "create":
+                proxysql_query_rule.create_rule(module.check_mode,
+                                                result,
+                                                cursor)
+            elif rule_diff.action == "update":
+                proxysql_query_rule.update_rule(module.check_mode,
+                                                result,
+                                                cursor)
             else:
                 result['changed'] = False
                 result['msg'] = ("The rule already exists in" +
                                  " mysql_query_rules and doesn't need to be" +
                                  " updated.")
-                result['rules'] = \
-                    proxysql_query_rule.get_rule_config(cursor)
+                proxysql_query_rule.set_result_rules(result, existing_rules)
 
-        except MySQLdb.Error:
+        except (FlagChainError, RegexLintError, ClusterSyncError,
+                MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to modify rule.. %s" % e
             )
 
     elif proxysql_query_rule.state == "absent":
+        result['diff'] = \
+            [{'before': rule, 'after': {}}
+             for rule in limit_result_rules(
+                 existing_rules, proxysql_query_rule.return_rules_limit)]
+
         try:
-            existing_rules = proxysql_query_rule.check_rule_cfg_exists(cursor)
-            if existing_rules > 0:
-                if existing_rules == 1 or \
+            if len(existing_rules) > 0:
+                if len(existing_rules) == 1 or \
                        proxysql_query_rule.force_delete:
+                    proxysql_query_rule.set_result_rules(result,
+                                                         existing_rules)
                     proxysql_query_rule.delete_rule(module.check_mode,
                                                     result,
                                                     cursor)
@@ -645,7 +1361,7 @@ def main():
                 result['changed'] = False
                 result['msg'] = ("The rule is already absent from the" +
                                  " mysql_query_rules memory configuration")
-        except MySQLdb.Error:
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to remove rule.. %s" % e
@@ -653,7 +1369,71 @@ def main():
 
     module.exit_json(**result)
 
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            rule_id=dict(type='int'),
+            active=dict(type='bool'),
+            username=dict(type='str'),
+            schemaname=dict(type='str'),
+            flagIN=dict(type='int'),
+            client_addr=dict(type='str'),
+            proxy_addr=dict(type='str'),
+            proxy_port=dict(type='int'),
+            digest=dict(type='str'),
+            match_digest=dict(type='str'),
+            match_pattern=dict(type='str'),
+            negate_match_pattern=dict(type='bool'),
+            flagOUT=dict(type='int'),
+            replace_pattern=dict(type='str'),
+            destination_hostgroup=dict(type='int'),
+            cache_ttl=dict(type='int'),
+            timeout=dict(type='int'),
+            retries=dict(type='int'),
+            delay=dict(type='int'),
+            mirror_flagOUT=dict(type='int'),
+            mirror_hostgroup=dict(type='int'),
+            error_msg=dict(type='str'),
+            log=dict(type='bool'),
+            apply=dict(type='bool'),
+            comment=dict(type='str'),
+            state=dict(default='present', choices=['present',
+                                                   'absent']),
+            force_delete=dict(default=False, type='bool'),
+            rules=dict(type='list'),
+            rule_id_range=dict(type='list'),
+            rule_id_step=dict(default=RULE_ID_STEP, type='int'),
+            return_rules=dict(default='full', choices=['full',
+                                                       'keys',
+                                                       'none']),
+            return_rules_limit=dict(type='int'),
+            check_flag_chains=dict(default=True, type='bool'),
+            max_chain_depth=dict(type='int'),
+            max_rules_evaluated=dict(type='int'),
+            check_regexes=dict(default=False, type='bool'),
+            regex_samples_file=dict(type='path'),
+            max_regex_match_time=dict(type='float'),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
 from ansible.module_utils.basic import *
-from ansible.module_utils.mysql import *
+from ansible.module_utils.proxysql import *
+from ansible.module_utils.proxysql_rules import *
 if __name__ == '__main__':
     main()
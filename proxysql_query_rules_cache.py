@@ -0,0 +1,643 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_query_rules_cache
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Proposes query cache rules from the query digest stats
+                   using the proxysql admin interface.
+description:
+   - The M(proxysql_query_rules_cache) module reads the digest stats in
+     stats_mysql_query_digest and the Query_Cache counters in
+     stats_mysql_global, and proposes a query rule with a I(cache_ttl) for
+     each of the frequent, cacheable reads which would save the most
+     backend time, within a share of mysql-query_cache_size_MB.
+   - Only the SELECTs which can run on a replica are cached, leaving out
+     any which use functions whose result changes from one call to the
+     next, such as C(NOW()) or C(RAND()).
+   - A cached result is only reused for the exact same query, so the hit
+     ratio of a digest depends on how many of its queries are distinct.
+     A digest without placeholders always runs the same query, for the
+     others the share of distinct queries is counted from
+     I(samples_file), or taken to be I(distinct_query_share).  Within a
+     I(cache_ttl) a digest then misses once for each distinct query and
+     hits for the rest, and holds a cache entry for each distinct query,
+     of the average rows it sends times I(row_size).
+   - The proposed rules are returned in I(rules), in the form the I(rules)
+     option of M(proxysql_query_rules) takes.  They don't set I(apply), so
+     the queries go on to be routed by the rules which follow.  With
+     I(apply_rules) the module writes them into I(rule_id_range) itself,
+     keeping the rule_id of a digest which already has a rule there and
+     removing the rules in the range for digests which no longer make the
+     cut.
+options:
+  rule_id_range:
+    description:
+      - The first and last rule_id the proposed rules may take.  The range
+        is owned by this module, place it ahead of the rules which route
+        the queries.
+    required: True
+  rule_id_step:
+    description:
+      - The gap to leave between the rule_ids of the proposed rules.
+    default: 10
+  max_rules:
+    description:
+      - The most rules to propose.
+    default: 20
+  cache_ttl:
+    description:
+      - The I(cache_ttl) in milliseconds to give the proposed rules.
+    default: 5000
+  min_count_star:
+    description:
+      - Leave out the digests which ran fewer times than this.
+    default: 1
+  min_hit_ratio:
+    description:
+      - Leave out the digests which would hit the cache for less than this
+        percentage of their queries.
+    default: 50
+  distinct_query_share:
+    description:
+      - The percentage of the queries of a digest with placeholders taken to
+        be distinct, when I(samples_file) doesn't have the digest.
+    default: 10
+  samples_file:
+    description:
+      - A file of query samples with their I(query) text, in the formats the
+        I(samples_file) of M(proxysql_query_rules_simulate) takes, to count
+        the distinct queries of each digest from.  The file is read on the
+        host the module runs on.
+    default: None
+  row_size:
+    description:
+      - The bytes a cached row is taken to hold.
+    default: 256
+  max_memory_share:
+    description:
+      - The percentage of mysql-query_cache_size_MB the proposed rules may
+        fill.
+    default: 80
+  match_with:
+    description:
+      - Match the queries on the I(digest) hash, or on a I(match_digest)
+        regex anchored to both ends of the digest text.
+    choices: [ "digest", "match_digest" ]
+    default: digest
+  username:
+    description:
+      - Only look at the digests of this user, and only cache the queries of
+        this user.
+    default: None
+  schemaname:
+    description:
+      - Only look at the digests run against this schema, and only cache the
+        queries run against it.
+    default: None
+  comment:
+    description:
+      - The comment to give the proposed rules.
+    default: query cache
+  apply_rules:
+    description:
+      - Write the proposed rules into I(rule_id_range), rather than only
+        returning them.
+    default: False
+  save_to_disk:
+    description:
+      - Save mysql query rule config to sqlite db on disk to persist the
+        configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  load_to_runtime:
+    description:
+      - Dynamically load mysql query rule config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+'''
+
+EXAMPLES = '''
+---
+# This example reports the cache rules which would save the most backend
+# time, caching results for two seconds.
+
+- proxysql_query_rules_cache:
+    login_user: 'admin'
+    login_password: 'admin'
+    rule_id_range: [100, 199]
+    cache_ttl: 2000
+
+# This example writes the rules into rule_ids 100 to 199, counting the
+# distinct queries of each digest from a sample of the query log.  It saves
+# the mysql query rules config to disk, and dynamically loads it to runtime.
+
+- proxysql_query_rules_cache:
+    config_file: '~/proxysql.cnf'
+    rule_id_range: [100, 199]
+    samples_file: /tmp/queries.json
+    apply_rules: True
+'''
+
+RETURN = '''
+stdout:
+    description: The proposed rules, the digests they cache and the
+                 predicted effect of caching them.
+    returned: success
+    type: dict
+    "sample": {
+        "backend_qps_saved": 412.5,
+        "changed": false,
+        "digests": [
+            {
+                "count_star": 1650000,
+                "digest": "0x3D4EB0F3A5C28B1E",
+                "digest_text": "SELECT * FROM products WHERE id = ?",
+                "hit_ratio": 90.0,
+                "memory_bytes": 2560000,
+                "rule_id": 100,
+                "sum_time": 412000000
+            }
+        ],
+        "memory_budget_bytes": 214748364,
+        "msg": "Proposed 1 rules caching 1650000 queries",
+        "predicted_cached_share": 18.2,
+        "predicted_hit_ratio": 90.0,
+        "predicted_memory_bytes": 2560000,
+        "query_cache": {
+            "Query_Cache_Entries": 0,
+            "Query_Cache_Memory_bytes": 0,
+            "Query_Cache_count_GET": 0,
+            "Query_Cache_count_GET_OK": 0,
+            "hit_ratio": 0.0
+        },
+        "rules": [
+            {
+                "active": true,
+                "cache_ttl": 5000,
+                "comment": "query cache",
+                "digest": "0x3D4EB0F3A5C28B1E",
+                "rule_id": 100
+            }
+        ]
+    }
+'''
+
+import csv
+import sys
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+DIGEST_RESULT_KEYS = ["digest",
+                      "digest_text",
+                      "count_star",
+                      "sum_time"]
+
+QUERY_CACHE_SIZE_VARIABLE = "mysql-query_cache_size_MB"
+
+
+class QueryCacheError(Exception):
+    pass
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+    get_rule_id_range(module)
+
+    for param in ("rule_id_step", "max_rules", "cache_ttl", "row_size"):
+        if module.params[param] < 1:
+            module.fail_json(
+                msg="%s must be a integer greater than 0" % param
+            )
+
+    if module.params["min_count_star"] < 0:
+        module.fail_json(
+            msg="min_count_star must be a integer greater than or equal to 0"
+        )
+
+    for param in ("min_hit_ratio", "distinct_query_share",
+                  "max_memory_share"):
+        if module.params[param] < 0 or module.params[param] > 100:
+            module.fail_json(
+                msg="%s must be a percentage between 0 and 100" % param
+            )
+
+
+def get_sample_distinct_shares(samples_file):
+    query_counts = {}
+    for sample in read_query_samples(samples_file):
+        digest_key = sample.get("digest") or sample.get("digest_text")
+        if not digest_key or not sample.get("query"):
+            continue
+        counts = query_counts.setdefault(digest_key, {})
+        counts[sample["query"]] = \
+            counts.get(sample["query"], 0) + int(sample.get("count", 1))
+
+    return dict((digest_key, 100.0 * len(counts) / sum(counts.values()))
+                for digest_key, counts in query_counts.items())
+
+
+def get_samples_file_shares(module):
+    if module.params["samples_file"] is None:
+        return {}
+
+    try:
+        return get_sample_distinct_shares(module.params["samples_file"])
+    except (IOError, OSError, ValueError, csv.Error):
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to read samples_file.. %s" % e
+        )
+
+
+class ProxySQLQueryCacheAdvisor(object):
+
+    def __init__(self, module):
+        self.first_rule_id, self.last_rule_id = get_rule_id_range(module)
+        self.rule_id_step = module.params["rule_id_step"]
+        self.max_rules = module.params["max_rules"]
+        self.cache_ttl = module.params["cache_ttl"]
+        self.min_count_star = module.params["min_count_star"]
+        self.min_hit_ratio = module.params["min_hit_ratio"]
+        self.distinct_query_share = module.params["distinct_query_share"]
+        self.sample_distinct_shares = get_samples_file_shares(module)
+        self.row_size = module.params["row_size"]
+        self.max_memory_share = module.params["max_memory_share"]
+        self.match_with = module.params["match_with"]
+        self.username = module.params["username"]
+        self.schemaname = module.params["schemaname"]
+        self.comment = module.params["comment"]
+        self.apply_rules = module.params["apply_rules"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+
+    def get_query_cache_stats(self, cursor):
+        query_string = \
+            """SELECT Variable_Name,
+                      Variable_Value
+               FROM stats_mysql_global
+               WHERE Variable_Name LIKE 'Query_Cache%'"""
+
+        cursor.execute(query_string)
+        query_cache = dict((row["Variable_Name"], int(row["Variable_Value"]))
+                           for row in cursor.fetchall())
+
+        if query_cache.get("Query_Cache_count_GET"):
+            query_cache["hit_ratio"] = \
+                round(100.0 * query_cache.get("Query_Cache_count_GET_OK", 0) /
+                      query_cache["Query_Cache_count_GET"], 2)
+        else:
+            query_cache["hit_ratio"] = 0.0
+        return query_cache
+
+    def get_memory_budget(self, cursor):
+        variable = ProxySQLRowStore(cursor, GLOBAL_VARIABLES).select_one(
+            {"variable_name": QUERY_CACHE_SIZE_VARIABLE})
+        if variable is None:
+            raise QueryCacheError(
+                "%s isn't in global_variables" % QUERY_CACHE_SIZE_VARIABLE)
+
+        return int(int(variable["variable_value"]) * 1024 * 1024 *
+                   self.max_memory_share / 100)
+
+    def get_distinct_share(self, digest, sample_distinct_shares):
+        for digest_key in (digest["digest"], digest["digest_text"]):
+            if digest_key in sample_distinct_shares:
+                return sample_distinct_shares[digest_key]
+
+        if "?" not in digest["digest_text"]:
+            return 0.0
+        return self.distinct_query_share
+
+    def get_digest_estimate(self, digest, window, sample_distinct_shares):
+        # queries run within a cache_ttl, of which the first of each distinct
+        # query misses and is cached
+        ttl_queries = \
+            float(digest["count_star"]) / window * self.cache_ttl / 1000
+        distinct_queries = \
+            min(ttl_queries,
+                max(1.0, ttl_queries *
+                    self.get_distinct_share(digest,
+                                            sample_distinct_shares) / 100))
+
+        if ttl_queries:
+            hit_ratio = 100 * (1 - distinct_queries / ttl_queries)
+        else:
+            hit_ratio = 0.0
+
+        avg_rows = float(digest["sum_rows_sent"]) / digest["count_star"]
+        memory_bytes = \
+            int(distinct_queries * max(1.0, avg_rows) * self.row_size)
+
+        return {"hit_ratio": hit_ratio,
+                "memory_bytes": memory_bytes,
+                "qps_saved": hit_ratio / 100 * digest["count_star"] / window,
+                "time_saved": hit_ratio / 100 * digest["sum_time"] / window}
+
+    def get_rule(self, digest):
+        rule = {"active": True,
+                "username": self.username,
+                "schemaname": self.schemaname,
+                "cache_ttl": self.cache_ttl,
+                "comment": self.comment}
+        rule[self.match_with] = get_digest_rule_match(digest, self.match_with)
+        return dict((col, val) for col, val in rule.items()
+                    if val is not None)
+
+    def get_rules(self, cursor, memory_budget, result):
+        owned_rules = []
+        cached = set()
+        for rule in ProxySQLRowStore(cursor, MYSQL_QUERY_RULES).select():
+            if self.first_rule_id <= get_rule_id(rule) <= self.last_rule_id:
+                owned_rules.append(rule)
+            elif rule_is_active(rule) and rule.get("cache_ttl") is not None:
+                cached.add(rule.get("digest"))
+                cached.add(rule.get("match_digest"))
+
+        digests = get_digest_stats(cursor,
+                                   {"username": self.username,
+                                    "schemaname": self.schemaname})
+        if not digests:
+            window = 1
+        else:
+            window = max(1, max(digest["last_seen"] for digest in digests) -
+                         min(digest["first_seen"] for digest in digests))
+
+        candidates = []
+        for digest in digests:
+            if digest["count_star"] < self.min_count_star or \
+                    not digest_is_cacheable(digest["digest_text"]) or \
+                    digest_has_rule(digest, cached):
+                continue
+
+            digest.update(self.get_digest_estimate(
+                digest, window, self.sample_distinct_shares))
+            if digest["hit_ratio"] >= self.min_hit_ratio and \
+                    digest["time_saved"] > 0:
+                candidates.append(digest)
+
+        # the digests which save the most backend time for the memory they
+        # take are cached first
+        candidates.sort(key=lambda digest: digest["time_saved"] /
+                        max(1, digest["memory_bytes"]),
+                        reverse=True)
+
+        cached_digests = []
+        memory_bytes = 0
+        for digest in candidates:
+            if len(cached_digests) >= self.max_rules:
+                break
+            if memory_bytes + digest["memory_bytes"] > memory_budget:
+                continue
+            cached_digests.append(digest)
+            memory_bytes += digest["memory_bytes"]
+
+        rules = [self.get_rule(digest) for digest in cached_digests]
+        rule_ids = allocate_digest_rule_ids(rules,
+                                            owned_rules,
+                                            self.match_with,
+                                            self.first_rule_id,
+                                            self.last_rule_id,
+                                            self.rule_id_step)
+        if rule_ids is None:
+            raise QueryCacheError(
+                "there's no room for %d rules %d apart in rule_id_range" %
+                (len(cached_digests), self.rule_id_step))
+        for rule, rule_id in zip(rules, rule_ids):
+            rule["rule_id"] = rule_id
+
+        cached_queries = sum(digest["count_star"]
+                             for digest in cached_digests)
+        cache_hits = sum(digest["hit_ratio"] / 100 * digest["count_star"]
+                         for digest in cached_digests)
+        total_queries = sum(digest["count_star"] for digest in digests)
+
+        result['predicted_hit_ratio'] = 0.0
+        if cached_queries:
+            result['predicted_hit_ratio'] = \
+                round(100 * cache_hits / cached_queries, 2)
+        result['predicted_cached_share'] = 0.0
+        if total_queries:
+            result['predicted_cached_share'] = \
+                round(100 * cache_hits / total_queries, 2)
+        result['backend_qps_saved'] = \
+            round(sum(digest["qps_saved"] for digest in cached_digests), 2)
+        result['predicted_memory_bytes'] = memory_bytes
+        result['digests'] = \
+            [dict([(key, digest[key]) for key in DIGEST_RESULT_KEYS] +
+                  [("hit_ratio", round(digest["hit_ratio"], 2)),
+                   ("memory_bytes", digest["memory_bytes"]),
+                   ("rule_id", rule_id)])
+             for digest, rule_id in zip(cached_digests, rule_ids)]
+
+        return rules, owned_rules
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(cursor,
+                                 MYSQL_QUERY_RULES.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
+
+    def advise(self, check_mode, result, cursor):
+        result['query_cache'] = self.get_query_cache_stats(cursor)
+        memory_budget = self.get_memory_budget(cursor)
+        result['memory_budget_bytes'] = memory_budget
+
+        rules, owned_rules = self.get_rules(cursor, memory_budget, result)
+        result['rules'] = rules
+
+        rules_to_create, rules_to_update, rules_to_delete, rule_diffs = \
+            get_owned_rule_changes(rules, owned_rules)
+
+        summary = (len(rules_to_create),
+                   len(rules_to_update),
+                   len(rules_to_delete))
+
+        result['changed'] = False
+        if not self.apply_rules:
+            result['msg'] = ("Proposed %d rules caching %d queries" %
+                             (len(rules),
+                              sum(digest["count_star"]
+                                  for digest in result['digests'])))
+            return
+
+        result['diff'] = rule_diffs
+        if not any(summary):
+            result['msg'] = ("The rules in rule_id_range are already the" +
+                             " proposed rules")
+        elif not check_mode:
+            result['changed'] = replace_owned_rules(cursor,
+                                                    rules_to_create,
+                                                    rules_to_update,
+                                                    rules_to_delete)
+            result['msg'] = ("Added %d, updated %d and deleted %d rules" +
+                             " in mysql_query_rules") % summary
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("%d rules would have been added, %d updated" +
+                             " and %d deleted in mysql_query_rules, however" +
+                             " check_mode is enabled.") % summary
+
+# ===========================================
+# Module execution.
+#
+
+
+def run_module(module):
+    cursor = proxysql_connect(module)
+
+    proxysql_query_cache = ProxySQLQueryCacheAdvisor(module)
+    result = {}
+
+    try:
+        proxysql_query_cache.advise(module.check_mode,
+                                    result,
+                                    cursor)
+    except (QueryCacheError, ClusterSyncError, MySQLdb.Error):
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to propose query cache rules.. %s" % e
+        )
+
+    module.exit_json(**result)
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    for name in ("snapshot",
+                 "snapshot_file"):
+        del argument_spec[name]
+    argument_spec.update(
+        dict(
+            rule_id_range=dict(required=True, type='list'),
+            rule_id_step=dict(default=10, type='int'),
+            max_rules=dict(default=20, type='int'),
+            cache_ttl=dict(default=5000, type='int'),
+            min_count_star=dict(default=1, type='int'),
+            min_hit_ratio=dict(default=50, type='float'),
+            distinct_query_share=dict(default=10, type='float'),
+            samples_file=dict(type='path'),
+            row_size=dict(default=256, type='int'),
+            max_memory_share=dict(default=80, type='float'),
+            match_with=dict(default='digest', choices=['digest',
+                                                       'match_digest']),
+            username=dict(type='str'),
+            schemaname=dict(type='str'),
+            comment=dict(default='query cache', type='str'),
+            apply_rules=dict(default=False, type='bool'),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+from ansible.module_utils.proxysql_rules import *
+if __name__ == '__main__':
+    main()
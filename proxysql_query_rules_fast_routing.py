@@ -0,0 +1,666 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_query_rules_fast_routing
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Adds or removes fast routing rules from proxysql admin
+                   interface.
+description:
+   - The M(proxysql_query_rules_fast_routing) module adds or removes the
+     rules of mysql_query_rules_fast_routing using the proxysql admin
+     interface.  Each rule routes the queries of a I(username) and
+     I(schemaname) with a I(flagIN) to a I(destination_hostgroup), and is
+     looked up in a hash table rather than being evaluated in turn like the
+     rules in mysql_query_rules, so it suits thousands of mappings such as
+     a schema per tenant.
+   - With I(mappings_file) the module streams a file of rules instead,
+     comparing each of them with the rules in the table as it goes, and
+     writes the changes with multi-row statements.  The whole file is
+     checked before anything is written.
+options:
+  username:
+    description:
+      - Filtering criteria matching username.  Required unless
+        I(mappings_file) is supplied.
+  schemaname:
+    description:
+      - Filtering criteria matching schemaname.  Required unless
+        I(mappings_file) is supplied.
+  flagIN:
+    description:
+      - Filtering criteria matching flagIN.
+    default: 0
+  destination_hostgroup:
+    description:
+      - Route matched queries to this hostgroup.  Required with
+        I(state=present) unless I(mappings_file) is supplied.
+  comment:
+    description:
+      - Free form text field, usable for a descriptive comment.  A rule
+        added without one gets an empty comment.
+  mappings_file:
+    description:
+      - A file of rules to add or remove, either JSON with a rule on each
+        line, or CSV with a header row naming the columns, tab separated
+        when the header holds a tab.  The columns are the same as the
+        options of a single rule, and a column that's missing or empty in
+        the file takes the value of the option.  The file is read on the
+        host the module runs on.
+    default: None
+  purge:
+    description:
+      - With I(mappings_file) and I(state=present), remove the rules in
+        the table which aren't in the file, so the table ends up holding
+        exactly the rules in the file.  Can't be used with I(state=absent)
+        or without I(mappings_file).
+    default: False
+  diff_limit:
+    description:
+      - The most changed rules to list in the diff with I(mappings_file).
+        The number of rules left out is returned in I(diff_omitted).  Must
+        be 0 or more, C(0) leaves every rule out of the diff.
+    default: 100
+  state:
+    description:
+      - When C(present) - adds the rule, when C(absent) - removes the rule.
+    choices: [ "present", "absent" ]
+    default: present
+  save_to_disk:
+    description:
+      - Save mysql query rule config to sqlite db on disk to persist the
+        configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  load_to_runtime:
+    description:
+      - Dynamically load mysql query rule config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+'''
+
+EXAMPLES = '''
+---
+# This example routes the queries of the app user against the tenant_42
+# schema to hostgroup 12, it saves the mysql query rules config to disk, and
+# dynamically loads it to runtime.
+
+- proxysql_query_rules_fast_routing:
+    login_user: 'admin'
+    login_password: 'admin'
+    username: app
+    schemaname: tenant_42
+    destination_hostgroup: 12
+    state: present
+
+# This example makes mysql_query_rules_fast_routing hold exactly the rules
+# in a CSV file with username, schemaname and destination_hostgroup
+# columns.  It uses credentials in a supplied config file to connect to the
+# proxysql admin interface.
+
+- proxysql_query_rules_fast_routing:
+    config_file: '~/proxysql.cnf'
+    mappings_file: /etc/proxysql/tenants.csv
+    purge: True
+    state: present
+'''
+
+RETURN = '''
+stdout:
+    description: The fast routing rule modified or removed, or with
+                 I(mappings_file) the number of rules added, updated,
+                 deleted and left unchanged.
+    returned: On create/update will return the newly modified rule, on
+              delete it will return the deleted record.
+    type: dict
+    "sample": {
+        "changed": true,
+        "msg": "Added rule to mysql_query_rules_fast_routing",
+        "rule": {
+            "comment": "",
+            "destination_hostgroup": "12",
+            "flagIN": "0",
+            "schemaname": "tenant_42",
+            "username": "app"
+        },
+        "state": "present"
+    }
+'''
+
+import csv
+import json
+import sys
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+class MappingsFileError(Exception):
+    pass
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+    if module.params["mappings_file"] is None:
+        if module.params["username"] is None or \
+                module.params["schemaname"] is None:
+            module.fail_json(
+                msg=("username and schemaname are required unless" +
+                     " mappings_file is supplied")
+            )
+
+        if module.params["state"] == "present" and \
+                module.params["destination_hostgroup"] is None:
+            module.fail_json(
+                msg="destination_hostgroup is required with state=present"
+            )
+
+    if module.params["purge"] and \
+            (module.params["mappings_file"] is None or
+             module.params["state"] != "present"):
+        module.fail_json(
+            msg=("purge can only be used along with mappings_file and" +
+                 " state=present")
+        )
+
+    if module.params["destination_hostgroup"] is not None and \
+            module.params["destination_hostgroup"] < 0:
+        module.fail_json(
+            msg=("destination_hostgroup must be a integer greater than or" +
+                 " equal to 0")
+        )
+
+    if module.params["diff_limit"] < 0:
+        module.fail_json(
+            msg="diff_limit must be a integer greater than or equal to 0"
+        )
+
+
+def read_mappings(mappings_file):
+    with open(mappings_file) as f:
+        first_line = f.readline()
+        f.seek(0)
+
+        if first_line.lstrip().startswith("{"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        dialect = "excel-tab" if "\t" in first_line else "excel"
+        for row in csv.DictReader(f, dialect=dialect):
+            yield dict((k, v) for k, v in row.items() if v != "")
+
+
+class ProxySQLFastRoutingRule(object):
+
+    def __init__(self, module, rule_params=None):
+        self.state = module.params["state"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+
+        if rule_params is None:
+            rule_params = module.params
+
+        self.username = rule_params["username"]
+        self.schemaname = rule_params["schemaname"]
+        self.flagIN = rule_params["flagIN"]
+
+        config_data_keys = ["destination_hostgroup",
+                            "comment"]
+
+        self.config_data = dict((k, rule_params[k])
+                                for k in (config_data_keys))
+
+    def get_key_data(self):
+        return {"username": self.username,
+                "schemaname": self.schemaname,
+                "flagIN": self.flagIN}
+
+    def get_row_data(self, current=None):
+        row_data = dict(current or {})
+        row_data.update(self.get_key_data())
+        row_data.update((col, val) for col, val in self.config_data.items()
+                        if val is not None)
+
+        # comment is NOT NULL without a default in this table
+        if row_data.get("comment") is None:
+            row_data["comment"] = ""
+        return row_data
+
+    def get_rule_diff(self, rule):
+        return ConfigDiff(rule,
+                          self.config_data,
+                          self.state,
+                          key_data=self.get_key_data())
+
+    def get_rule_config(self, cursor):
+        return ProxySQLRowStore(cursor,
+                                MYSQL_QUERY_RULES_FAST_ROUTING).select_one(
+                                    self.get_key_data())
+
+    def create_rule_config(self, cursor):
+        ProxySQLRowStore(cursor,
+                         MYSQL_QUERY_RULES_FAST_ROUTING).insert(
+                             self.get_row_data())
+        return True
+
+    def update_rule_config(self, cursor):
+        return ProxySQLRowStore(cursor,
+                                MYSQL_QUERY_RULES_FAST_ROUTING).update(
+                                    self.get_key_data(),
+                                    self.config_data)
+
+    def delete_rule_config(self, cursor):
+        ProxySQLRowStore(cursor,
+                         MYSQL_QUERY_RULES_FAST_ROUTING).delete(
+                             self.get_key_data())
+        return True
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(
+                cursor,
+                MYSQL_QUERY_RULES_FAST_ROUTING.config_settings,
+                self.save_to_disk,
+                self.load_to_runtime,
+                self.deferred_file)
+
+    def create_rule(self, check_mode, result, cursor):
+        if not check_mode:
+            result['changed'] = \
+                self.create_rule_config(cursor)
+            result['msg'] = "Added rule to mysql_query_rules_fast_routing"
+            result['rule'] = \
+                self.get_rule_config(cursor)
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("Rule would have been added to" +
+                             " mysql_query_rules_fast_routing, however" +
+                             " check_mode is enabled.")
+
+    def update_rule(self, check_mode, result, cursor):
+        if not check_mode:
+            result['changed'] = \
+                self.update_rule_config(cursor)
+            result['msg'] = "Updated rule in mysql_query_rules_fast_routing"
+            result['rule'] = \
+                self.get_rule_config(cursor)
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("Rule would have been updated in" +
+                             " mysql_query_rules_fast_routing, however" +
+                             " check_mode is enabled.")
+
+    def delete_rule(self, check_mode, result, cursor):
+        if not check_mode:
+            result['changed'] = \
+                self.delete_rule_config(cursor)
+            result['msg'] = ("Deleted rule from" +
+                             " mysql_query_rules_fast_routing")
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("Rule would have been deleted from" +
+                             " mysql_query_rules_fast_routing, however" +
+                             " check_mode is enabled.")
+
+
+# The rules in a mappings file are compared with the existing rules one at a
+# time as the file is read, so only the table and the rules which need to
+# change are held in memory, never the whole file.  The existing rules are
+# popped as they're matched, which leaves the ones the file doesn't list.
+#
+
+
+class ProxySQLFastRoutingRuleFile(object):
+
+    def __init__(self, module):
+        self.module = module
+        self.state = module.params["state"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+        self.mappings_file = module.params["mappings_file"]
+        self.purge = module.params["purge"]
+        self.diff_limit = module.params["diff_limit"]
+
+    def get_rule(self, mapping, entry):
+        rule_params = get_entry_params(self.module,
+                                       MYSQL_QUERY_RULES_FAST_ROUTING,
+                                       mapping,
+                                       MYSQL_QUERY_RULES_FAST_ROUTING.columns,
+                                       "mappings_file")
+
+        required_cols = ["username", "schemaname"]
+        if self.state == "present":
+            required_cols.append("destination_hostgroup")
+
+        missing_cols = [col for col in required_cols
+                        if rule_params[col] is None]
+        if missing_cols:
+            raise MappingsFileError(
+                "entry %d in mappings_file has no %s" %
+                (entry, ", ".join(missing_cols)))
+
+        return ProxySQLFastRoutingRule(self.module, rule_params)
+
+    def get_existing_rules(self, cursor):
+        rule_store = ProxySQLRowStore(cursor, MYSQL_QUERY_RULES_FAST_ROUTING)
+        return dict((MYSQL_QUERY_RULES_FAST_ROUTING.get_key(row), row)
+                    for row in rule_store.select())
+
+    def get_changes(self, existing_rules):
+        rows_to_create = []
+        rows_to_update = []
+        rows_to_delete = []
+        rule_diffs = []
+        unchanged = 0
+
+        listed = set()
+        for entry, mapping in enumerate(read_mappings(self.mappings_file), 1):
+            rule = self.get_rule(mapping, entry)
+            key = MYSQL_QUERY_RULES_FAST_ROUTING.get_key(rule.get_key_data())
+            if key in listed:
+                raise MappingsFileError(
+                    "entry %d in mappings_file repeats the rule for %s" %
+                    (entry, ", ".join(key)))
+            listed.add(key)
+
+            current = existing_rules.pop(key, None)
+            rule_diff = rule.get_rule_diff(current)
+            if rule_diff.action == "create":
+                rows_to_create.append(rule.get_row_data())
+            elif rule_diff.action == "update":
+                rows_to_update.append(rule.get_row_data(current))
+            elif rule_diff.action == "delete":
+                rows_to_delete.append(current)
+            else:
+                unchanged += 1
+
+            if rule_diff.changed and len(rule_diffs) < self.diff_limit:
+                rule_diffs.append(rule_diff.get_diff())
+
+        if self.purge:
+            rows_to_delete.extend(existing_rules.values())
+            rule_diffs.extend({'before': row, 'after': {}}
+                              for row in list(existing_rules.values())[
+                                  :self.diff_limit - len(rule_diffs)])
+
+        return rows_to_create, rows_to_update, rows_to_delete, rule_diffs, \
+            unchanged
+
+    def write_changes(self, cursor, rows_to_create, rows_to_update,
+                      rows_to_delete):
+        rule_store = ProxySQLRowStore(cursor, MYSQL_QUERY_RULES_FAST_ROUTING)
+
+        # an updated rule is replaced, so its new values go in along with the
+        # added rules in the same multi-row INSERTs
+        rule_store.delete_many([MYSQL_QUERY_RULES_FAST_ROUTING.get_key(row)
+                                for row in rows_to_update + rows_to_delete])
+        rule_store.insert_many(rows_to_create + rows_to_update)
+        return True
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(
+                cursor,
+                MYSQL_QUERY_RULES_FAST_ROUTING.config_settings,
+                self.save_to_disk,
+                self.load_to_runtime,
+                self.deferred_file)
+
+    def manage_rules(self, check_mode, result, cursor):
+        rows_to_create, rows_to_update, rows_to_delete, rule_diffs, \
+            unchanged = self.get_changes(self.get_existing_rules(cursor))
+
+        summary = (len(rows_to_create),
+                   len(rows_to_update),
+                   len(rows_to_delete))
+        result['added'], result['updated'], result['deleted'] = summary
+        result['unchanged'] = unchanged
+        result['changed'] = any(summary)
+
+        result['diff'] = rule_diffs
+        if sum(summary) > len(rule_diffs):
+            result['diff_omitted'] = sum(summary) - len(rule_diffs)
+
+        if not result['changed']:
+            result['msg'] = ("The rules in mappings_file don't need any" +
+                             " change to mysql_query_rules_fast_routing")
+        elif not check_mode:
+            self.write_changes(cursor,
+                               rows_to_create,
+                               rows_to_update,
+                               rows_to_delete)
+            self.manage_config(cursor,
+                               result['changed'])
+            result['msg'] = ("Added %d, updated %d and deleted %d rules" +
+                             " in mysql_query_rules_fast_routing") % summary
+        else:
+            result['msg'] = ("%d rules would have been added, %d updated" +
+                             " and %d deleted in" +
+                             " mysql_query_rules_fast_routing, however" +
+                             " check_mode is enabled.") % summary
+
+# ===========================================
+# Module execution.
+#
+
+
+def run_module(module):
+    cursor = proxysql_connect(module)
+
+    result = {}
+    result['state'] = module.params["state"]
+
+    if module.params["mappings_file"] is not None:
+        proxysql_fast_routing_rules = ProxySQLFastRoutingRuleFile(module)
+
+        try:
+            proxysql_fast_routing_rules.manage_rules(module.check_mode,
+                                                     result,
+                                                     cursor)
+        except (IOError, OSError, ValueError, csv.Error, MappingsFileError):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to read mappings_file.. %s" % e
+            )
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to modify rules.. %s" % e
+            )
+
+        module.exit_json(**result)
+
+    proxysql_fast_routing_rule = ProxySQLFastRoutingRule(module)
+
+    try:
+        rule_diff = proxysql_fast_routing_rule.get_rule_diff(
+            proxysql_fast_routing_rule.get_rule_config(cursor))
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to get rule.. %s" % e
+        )
+
+    result['diff'] = rule_diff.get_diff()
+
+    if proxysql_fast_routing_rule.state == "present":
+        try:
+            if rule_diff.action == "create":
+                proxysql_fast_routing_rule.create_rule(module.check_mode,
+                                                       result,
+                                                       cursor)
+            elif rule_diff.action == "update":
+                proxysql_fast_routing_rule.update_rule(module.check_mode,
+                                                       result,
+                                                       cursor)
+            else:
+                result['changed'] = False
+                result['msg'] = ("The rule already exists in" +
+                                 " mysql_query_rules_fast_routing and" +
+                                 " doesn't need to be updated.")
+                result['rule'] = rule_diff.current
+
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to modify rule.. %s" % e
+            )
+
+    elif proxysql_fast_routing_rule.state == "absent":
+        try:
+            if rule_diff.action == "delete":
+                result['rule'] = rule_diff.current
+                proxysql_fast_routing_rule.delete_rule(module.check_mode,
+                                                       result,
+                                                       cursor)
+            else:
+                result['changed'] = False
+                result['msg'] = ("The rule is already absent from the" +
+                                 " mysql_query_rules_fast_routing memory" +
+                                 " configuration")
+
+        except (ClusterSyncError, MySQLdb.Error):
+            e = sys.exc_info()[1]
+            module.fail_json(
+                msg="unable to remove rule.. %s" % e
+            )
+
+    module.exit_json(**result)
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    for name in ("snapshot",
+                 "snapshot_file"):
+        del argument_spec[name]
+    argument_spec.update(
+        dict(
+            username=dict(type='str'),
+            schemaname=dict(type='str'),
+            flagIN=dict(default=0, type='int'),
+            destination_hostgroup=dict(type='int'),
+            comment=dict(type='str'),
+            mappings_file=dict(type='path'),
+            purge=dict(default=False, type='bool'),
+            diff_limit=dict(default=100, type='int'),
+            state=dict(default='present', choices=['present',
+                                                   'absent']),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+if __name__ == '__main__':
+    main()
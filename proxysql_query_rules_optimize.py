@@ -0,0 +1,444 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_query_rules_optimize
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Reorders query rules by their hit counts using the
+                   proxysql admin interface.
+description:
+   - The M(proxysql_query_rules_optimize) module reads the hit counters in
+     stats_mysql_query_rules and works out an order for the active query
+     rules which gets the busiest terminal (I(apply)) rules evaluated
+     sooner, and reports the active rules which haven't been hit.
+   - A rule only moves ahead of the rules it can't interfere with, which
+     are the rules with a different I(flagIN), or a different value in one
+     of I(username), I(schemaname), I(proxy_addr), I(proxy_port) or
+     I(digest).  Any two rules which could both act on the same query stay
+     in the same order.
+   - The rules evaluated per query are estimated from the hit counters,
+     with the queries which don't hit a terminal rule counted as going
+     through every active rule.
+options:
+  reorder:
+    description:
+      - Apply the new order by swapping the rule_ids of the active rules
+        around, rather than only reporting it.  The memory config has to
+        match runtime, as the hit counters are for the runtime rules.
+        Loading the rules to runtime resets the hit counters.
+    default: False
+  rule_id_range:
+    description:
+      - The first and last rule_id of the rules which may be reordered, as a
+        list of two integers.  Only the rules inside the range swap their
+        rule_ids, the rest keep their place, so the rule_id ranges owned by
+        other modules or tasks aren't renumbered.  By default every active
+        rule may be reordered.
+    default: None
+  sample_interval:
+    description:
+      - Read the hit counters twice, this many seconds apart, and work from
+        the hits in between.  By default the counters are used as they are,
+        which covers the time since the rules were last loaded to runtime.
+    default: 0
+  save_to_disk:
+    description:
+      - Save mysql query rule config to sqlite db on disk to persist the
+        configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  load_to_runtime:
+    description:
+      - Dynamically load mysql query rule config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+'''
+
+EXAMPLES = '''
+---
+# This example reports how the query rules could be reordered, going by the
+# rule hits over the next five minutes.  It uses supplied credentials to
+# connect to the proxysql admin interface.
+
+- proxysql_query_rules_optimize:
+    login_user: 'admin'
+    login_password: 'admin'
+    sample_interval: 300
+
+# This example reorders the query rules between rule_id 100 and 199, saves
+# the mysql query rule config to disk, and dynamically loads it to runtime.
+# It uses credentials in a supplied config file to connect to the proxysql
+# admin interface.
+
+- proxysql_query_rules_optimize:
+    config_file: '~/proxysql.cnf'
+    rule_id_range: [100, 199]
+    reorder: True
+'''
+
+RETURN = '''
+stdout:
+    description: The proposed order of the query rules and its estimated
+                 effect.
+    returned: success
+    type: dict
+    "sample": {
+        "changed": false,
+        "estimated_reduction": 62.5,
+        "moves": [
+            {
+                "hits": 9000,
+                "new_rule_id": 10,
+                "rule_id": 30
+            },
+            {
+                "hits": 0,
+                "new_rule_id": 20,
+                "rule_id": 10
+            },
+            {
+                "hits": 1000,
+                "new_rule_id": 30,
+                "rule_id": 20
+            }
+        ],
+        "msg": "Reordering 3 rules would cut the rules evaluated per query
+                from 2.80 to 1.20",
+        "proposed_rules_evaluated": 1.2,
+        "rules_evaluated": 2.8,
+        "total_queries": 10000,
+        "unused_rules": [
+            10
+        ]
+    }
+'''
+
+import sys
+import time
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+class RuleOrderError(Exception):
+    pass
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+    get_rule_id_range(module)
+
+    if module.params["sample_interval"] < 0:
+        module.fail_json(
+            msg="sample_interval must be a integer greater than or equal to 0"
+        )
+
+
+class ProxySQLQueryRuleOptimizer(object):
+
+    def __init__(self, module):
+        self.reorder = module.params["reorder"]
+        self.first_rule_id, self.last_rule_id = get_rule_id_range(module)
+        self.sample_interval = module.params["sample_interval"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+
+    def get_rule_hits(self, cursor):
+        query_string = \
+            """SELECT rule_id,
+                      hits
+               FROM stats_mysql_query_rules"""
+
+        cursor.execute(query_string)
+        return dict((int(row["rule_id"]), int(row["hits"]))
+                    for row in cursor.fetchall())
+
+    def get_total_queries(self, cursor):
+        query_string = \
+            """SELECT Variable_Value
+               FROM stats_mysql_global
+               WHERE Variable_Name = 'Questions'"""
+
+        cursor.execute(query_string)
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return int(row["Variable_Value"])
+
+    def sample_hits(self, cursor):
+        hits = self.get_rule_hits(cursor)
+        total_queries = self.get_total_queries(cursor)
+
+        if self.sample_interval:
+            time.sleep(self.sample_interval)
+
+            first_hits = hits
+            first_total_queries = total_queries
+            hits = self.get_rule_hits(cursor)
+            total_queries = self.get_total_queries(cursor)
+
+            # the hit counters start again when the rules are loaded to
+            # runtime, in which case the second reading covers the window
+            if all(hits.get(rule_id, 0) >= rule_hits
+                   for rule_id, rule_hits in first_hits.items()):
+                hits = dict((rule_id, rule_hits - first_hits.get(rule_id, 0))
+                            for rule_id, rule_hits in hits.items())
+            if total_queries is not None and \
+                    first_total_queries is not None:
+                total_queries -= first_total_queries
+
+        return hits, total_queries
+
+    def rule_in_range(self, rule):
+        return get_rule_id(rule) >= self.first_rule_id and \
+            (self.last_rule_id is None or
+             get_rule_id(rule) <= self.last_rule_id)
+
+    def get_range_reordered_rules(self, rules, hits):
+        # the rules in rule_id_range are next to each other in the order the
+        # rules are evaluated, so they're reordered among themselves and put
+        # back in their place
+        range_rules = [rule for rule in rules if self.rule_in_range(rule)]
+        if not range_rules:
+            return rules
+
+        first = rules.index(range_rules[0])
+        return (rules[:first] +
+                get_reordered_rules(range_rules, hits) +
+                rules[first + len(range_rules):])
+
+    def get_moves(self, rules, reordered_rules, hits):
+        rule_ids = [get_rule_id(rule) for rule in rules]
+
+        moves = []
+        for new_rule_id, rule in zip(rule_ids, reordered_rules):
+            if get_rule_id(rule) != new_rule_id:
+                moves.append({"rule_id": get_rule_id(rule),
+                              "new_rule_id": new_rule_id,
+                              "hits": hits.get(get_rule_id(rule), 0)})
+        return moves
+
+    def reorder_rules(self, cursor, moves):
+        rule_store = ProxySQLRowStore(cursor, MYSQL_QUERY_RULES)
+        rules = dict((get_rule_id(rule), rule) for rule in rule_store.select()
+                     if self.rule_in_range(rule))
+
+        rule_store.delete_many([(move["rule_id"],) for move in moves])
+        rule_store.insert_many([dict(rules[move["rule_id"]],
+                                     rule_id=move["new_rule_id"])
+                                for move in moves])
+        return True
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(cursor,
+                                 MYSQL_QUERY_RULES.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
+
+    def optimize(self, check_mode, result, cursor):
+        rules = get_active_rules(get_layer_rows(cursor,
+                                                "MYSQL QUERY RULES",
+                                                MYSQL_QUERY_RULES,
+                                                "RUNTIME"))
+        hits, total_queries = self.sample_hits(cursor)
+
+        # a query hits at most one terminal rule, so without the query count
+        # every query is taken to have hit one
+        if total_queries is None:
+            total_queries = sum(hits.get(get_rule_id(rule), 0)
+                                for rule in rules if rule_is_terminal(rule))
+
+        reordered_rules = self.get_range_reordered_rules(rules, hits)
+        moves = self.get_moves(rules, reordered_rules, hits)
+
+        result['total_queries'] = total_queries
+        result['rules_evaluated'] = \
+            round(get_rules_evaluated(rules, hits, total_queries), 2)
+        result['proposed_rules_evaluated'] = \
+            round(get_rules_evaluated(reordered_rules, hits, total_queries), 2)
+        if result['rules_evaluated']:
+            result['estimated_reduction'] = \
+                round(100 * (1 - result['proposed_rules_evaluated'] /
+                             result['rules_evaluated']), 2)
+        else:
+            result['estimated_reduction'] = 0.0
+        result['moves'] = moves
+        result['unused_rules'] = [get_rule_id(rule) for rule in rules
+                                  if not hits.get(get_rule_id(rule))]
+
+        result['changed'] = False
+        if not moves:
+            result['msg'] = ("The query rules are already in the best order" +
+                             " the rules they depend on allow")
+        elif not self.reorder:
+            result['msg'] = ("Reordering %d rules would cut the rules" +
+                             " evaluated per query from %.2f to %.2f") % \
+                (len(moves),
+                 result['rules_evaluated'],
+                 result['proposed_rules_evaluated'])
+        elif not config_layers_match(cursor,
+                                     MYSQL_QUERY_RULES.config_settings,
+                                     "MEMORY",
+                                     "RUNTIME"):
+            raise RuleOrderError(
+                ("the mysql query rules in memory don't match runtime, load" +
+                 " or discard the changes before reordering them"))
+        elif not check_mode:
+            result['changed'] = self.reorder_rules(cursor, moves)
+            result['msg'] = ("Reordered %d rules in mysql_query_rules" %
+                             len(moves))
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("%d rules would have been reordered in" +
+                             " mysql_query_rules, however check_mode" +
+                             " is enabled.") % len(moves)
+
+# ===========================================
+# Module execution.
+#
+
+
+def run_module(module):
+    cursor = proxysql_connect(module)
+
+    proxysql_optimizer = ProxySQLQueryRuleOptimizer(module)
+    result = {}
+
+    try:
+        proxysql_optimizer.optimize(module.check_mode,
+                                    result,
+                                    cursor)
+    except (RuleOrderError, ClusterSyncError, MySQLdb.Error):
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to optimize query rules.. %s" % e
+        )
+
+    module.exit_json(**result)
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    for name in ("snapshot",
+                 "snapshot_file"):
+        del argument_spec[name]
+    argument_spec.update(
+        dict(
+            reorder=dict(default=False, type='bool'),
+            rule_id_range=dict(type='list'),
+            sample_interval=dict(default=0, type='int'),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+from ansible.module_utils.proxysql_rules import *
+if __name__ == '__main__':
+    main()
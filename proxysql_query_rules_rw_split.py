@@ -0,0 +1,577 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_query_rules_rw_split
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Generates read/write split query rules from the query
+                   digest stats using the proxysql admin interface.
+description:
+   - The M(proxysql_query_rules_rw_split) module reads the digests of the
+     queries run on a writer hostgroup from stats_mysql_query_digest, ranks
+     them by I(count_star) or I(sum_time), and generates a query rule for
+     each of the busiest reads which routes it to the reader hostgroup
+     paired with the writer in mysql_replication_hostgroups.
+   - Each rule is scoped to a user, so that a digest which also runs for
+     the users of another cluster isn't routed to this reader hostgroup.
+     Without I(username) a digest gets a rule for each of the users which
+     ran it and whose I(default_hostgroup) is the writer hostgroup, and a
+     digest without any such user is skipped with C(no_writer_users).
+   - A digest is only taken as a read when it's a SELECT which can run on a
+     replica.  Locking reads (C(FOR UPDATE), C(FOR SHARE) and
+     C(LOCK IN SHARE MODE)) and SELECTs which depend on the session, such
+     as ones using variables, lock functions or C(LAST_INSERT_ID()), stay
+     on the writer, as do the digests of users without
+     I(transaction_persistent), whose SELECTs inside a transaction would
+     otherwise leave it.
+   - The generated rules are returned in I(rules), in the form the I(rules)
+     option of M(proxysql_query_rules) takes.  With I(apply_rules) the
+     module writes them into I(rule_id_range) itself, keeping the rule_id
+     of a digest which already has a rule there and removing the rules in
+     the range for digests which no longer make the cut.
+options:
+  writer_hostgroup:
+    description:
+      - The writer hostgroup of the mysql_replication_hostgroups entry to
+        offload.  Can be left out when there's only one entry.
+    default: None
+  rule_id_range:
+    description:
+      - The first and last rule_id the generated rules may take.  The range
+        is owned by this module, place it ahead of any catch-all rules which
+        route to the writer hostgroup.
+    required: True
+  rule_id_step:
+    description:
+      - The gap to leave between the rule_ids of the generated rules.
+    default: 10
+  max_rules:
+    description:
+      - The most rules to generate.
+    default: 20
+  rank_by:
+    description:
+      - Rank the digests by the number of times they ran, or by the total
+        time they took.
+    choices: [ "count_star", "sum_time" ]
+    default: sum_time
+  min_count_star:
+    description:
+      - Leave out the digests which ran fewer times than this.
+    default: 1
+  match_with:
+    description:
+      - Match the queries on the I(digest) hash, or on a I(match_digest)
+        regex anchored to both ends of the digest text.  The hash is cheaper
+        to match, the regex carries over to ProxySQL instances which
+        compute different hashes.
+    choices: [ "digest", "match_digest" ]
+    default: digest
+  username:
+    description:
+      - Only look at the digests of this user, and only route the queries of
+        this user.  By default the rules are generated for the users whose
+        I(default_hostgroup) is the writer hostgroup.
+    default: None
+  schemaname:
+    description:
+      - Only look at the digests run against this schema, and only route the
+        queries run against it.
+    default: None
+  comment:
+    description:
+      - The comment to give the generated rules.
+    default: read/write split
+  apply_rules:
+    description:
+      - Write the generated rules into I(rule_id_range), rather than only
+        returning them.
+    default: False
+  save_to_disk:
+    description:
+      - Save mysql query rule config to sqlite db on disk to persist the
+        configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  load_to_runtime:
+    description:
+      - Dynamically load mysql query rule config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
+    default: True
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+'''
+
+EXAMPLES = '''
+---
+# This example reports the rules which would route the ten busiest reads on
+# hostgroup 1 to its reader hostgroup.
+
+- proxysql_query_rules_rw_split:
+    login_user: 'admin'
+    login_password: 'admin'
+    writer_hostgroup: 1
+    rule_id_range: [1000, 1999]
+    max_rules: 10
+
+# This example writes the rules into rule_ids 1000 to 1999, saves the mysql
+# query rules config to disk, and dynamically loads it to runtime.  It uses
+# credentials in a supplied config file to connect to the proxysql admin
+# interface.
+
+- proxysql_query_rules_rw_split:
+    config_file: '~/proxysql.cnf'
+    writer_hostgroup: 1
+    rule_id_range: [1000, 1999]
+    max_rules: 10
+    apply_rules: True
+'''
+
+RETURN = '''
+stdout:
+    description: The generated rules, the digests they route and the busiest
+                 reads which were left on the writer.
+    returned: success
+    type: dict
+    "sample": {
+        "changed": true,
+        "digests": [
+            {
+                "count_star": 18422,
+                "digest": "0x3D4EB0F3A5C28B1E",
+                "digest_text": "SELECT * FROM orders WHERE id = ?",
+                "rule_id": 1000,
+                "sum_time": 9211000,
+                "username": "app"
+            }
+        ],
+        "msg": "Added 1, updated 0 and deleted 0 rules in mysql_query_rules",
+        "offloaded_share": 41.7,
+        "reader_hostgroup": 2,
+        "rules": [
+            {
+                "active": true,
+                "apply": true,
+                "comment": "read/write split",
+                "destination_hostgroup": 2,
+                "digest": "0x3D4EB0F3A5C28B1E",
+                "rule_id": 1000,
+                "username": "app"
+            }
+        ],
+        "skipped": [
+            {
+                "count_star": 5120,
+                "digest": "0x9A1B7C2D3E4F5061",
+                "digest_text": "SELECT * FROM orders WHERE id = ? FOR UPDATE",
+                "reason": "locking_read",
+                "sum_time": 3010000
+            }
+        ],
+        "writer_hostgroup": 1
+    }
+'''
+
+import sys
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+DIGEST_RESULT_KEYS = ["digest",
+                      "digest_text",
+                      "count_star",
+                      "sum_time"]
+
+
+class RWSplitError(Exception):
+    pass
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+    get_rule_id_range(module)
+
+    for param in ("rule_id_step", "max_rules"):
+        if module.params[param] < 1:
+            module.fail_json(
+                msg="%s must be a integer greater than 0" % param
+            )
+
+    if module.params["min_count_star"] < 0:
+        module.fail_json(
+            msg="min_count_star must be a integer greater than or equal to 0"
+        )
+
+
+class ProxySQLReadWriteSplit(object):
+
+    def __init__(self, module):
+        self.writer_hostgroup = module.params["writer_hostgroup"]
+        self.first_rule_id, self.last_rule_id = get_rule_id_range(module)
+        self.rule_id_step = module.params["rule_id_step"]
+        self.max_rules = module.params["max_rules"]
+        self.rank_by = module.params["rank_by"]
+        self.min_count_star = module.params["min_count_star"]
+        self.match_with = module.params["match_with"]
+        self.username = module.params["username"]
+        self.schemaname = module.params["schemaname"]
+        self.comment = module.params["comment"]
+        self.apply_rules = module.params["apply_rules"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
+
+    def get_hostgroups(self, cursor):
+        replication_hostgroups = \
+            ProxySQLRowStore(cursor, MYSQL_REPLICATION_HOSTGROUPS).select()
+
+        if not replication_hostgroups:
+            raise RWSplitError(
+                "there are no entries in mysql_replication_hostgroups")
+        elif self.writer_hostgroup is None:
+            if len(replication_hostgroups) != 1:
+                raise RWSplitError(
+                    ("there are %d entries in mysql_replication_hostgroups," +
+                     " pick one with writer_hostgroup") %
+                    len(replication_hostgroups))
+            hostgroups = replication_hostgroups[0]
+        else:
+            hostgroups = None
+            for row in replication_hostgroups:
+                if int(row["writer_hostgroup"]) == self.writer_hostgroup:
+                    hostgroups = row
+            if hostgroups is None:
+                raise RWSplitError(
+                    ("writer_hostgroup %d isn't in" +
+                     " mysql_replication_hostgroups") % self.writer_hostgroup)
+
+        return (int(hostgroups["writer_hostgroup"]),
+                int(hostgroups["reader_hostgroup"]))
+
+    def get_writer_users(self, cursor, writer_hostgroup):
+        return set(row["username"] for row in
+                   ProxySQLRowStore(cursor, MYSQL_USERS).select(
+                       {"frontend": True})
+                   if int(row["default_hostgroup"]) == writer_hostgroup)
+
+    def get_rule_usernames(self, digest, writer_users):
+        # without a username each rule is scoped to one of the users whose
+        # default_hostgroup is the writer, so queries which reach the writer
+        # hostgroup for another cluster's users aren't routed to its reader
+        if self.username is not None:
+            return [self.username]
+        return sorted(digest["usernames"] & writer_users)
+
+    def get_non_persistent_users(self, cursor):
+        return set(row["username"] for row in
+                   ProxySQLRowStore(cursor, MYSQL_USERS).select(
+                       {"frontend": True})
+                   if normalise_value(row["transaction_persistent"]) == "0")
+
+    def get_skip_reason(self, digest, usernames, non_persistent_users,
+                        routed):
+        digest_class = get_digest_class(digest["digest_text"])
+        if digest_class != "read":
+            return digest_class
+        elif digest["usernames"] & non_persistent_users:
+            return "not_transaction_persistent"
+        elif digest_has_rule(digest, routed):
+            return "routed_by_rule"
+        elif not usernames:
+            return "no_writer_users"
+        return None
+
+    def get_rule(self, digest, username, reader_hostgroup):
+        rule = {"active": True,
+                "username": username,
+                "schemaname": self.schemaname,
+                "destination_hostgroup": reader_hostgroup,
+                "apply": True,
+                "comment": self.comment}
+        rule[self.match_with] = get_digest_rule_match(digest, self.match_with)
+        return dict((col, val) for col, val in rule.items()
+                    if val is not None)
+
+    def get_rules(self, cursor, writer_hostgroup, reader_hostgroup, result):
+        owned_rules = []
+        routed = set()
+        for rule in ProxySQLRowStore(cursor, MYSQL_QUERY_RULES).select():
+            if self.first_rule_id <= get_rule_id(rule) <= self.last_rule_id:
+                owned_rules.append(rule)
+            elif rule_is_active(rule):
+                routed.add(rule.get("digest"))
+                routed.add(rule.get("match_digest"))
+
+        digests = sorted(get_digest_stats(cursor,
+                                          {"hostgroup": writer_hostgroup,
+                                           "username": self.username,
+                                           "schemaname": self.schemaname}),
+                         key=lambda digest: digest[self.rank_by],
+                         reverse=True)
+        writer_users = self.get_writer_users(cursor, writer_hostgroup)
+        non_persistent_users = self.get_non_persistent_users(cursor)
+
+        routed_digests = []
+        rule_digests = []
+        rules = []
+        skipped = []
+        for digest in digests:
+            if len(rules) >= self.max_rules:
+                break
+            if digest["count_star"] < self.min_count_star:
+                continue
+
+            usernames = self.get_rule_usernames(digest, writer_users)
+            reason = self.get_skip_reason(digest,
+                                          usernames,
+                                          non_persistent_users,
+                                          routed)
+            if reason is None:
+                routed_digests.append(digest)
+                for username in usernames[:self.max_rules - len(rules)]:
+                    rule_digests.append(digest)
+                    rules.append(self.get_rule(digest,
+                                               username,
+                                               reader_hostgroup))
+            elif reason not in ("write", "transaction", "other") and \
+                    len(skipped) < self.max_rules:
+                skipped.append(dict([(key, digest[key])
+                                     for key in DIGEST_RESULT_KEYS] +
+                                    [("reason", reason)]))
+
+        rule_ids = allocate_digest_rule_ids(rules,
+                                            owned_rules,
+                                            self.match_with,
+                                            self.first_rule_id,
+                                            self.last_rule_id,
+                                            self.rule_id_step)
+        if rule_ids is None:
+            raise RWSplitError(
+                "there's no room for %d rules %d apart in rule_id_range" %
+                (len(rules), self.rule_id_step))
+        for rule, rule_id in zip(rules, rule_ids):
+            rule["rule_id"] = rule_id
+
+        total = sum(digest[self.rank_by] for digest in digests)
+        if total:
+            result['offloaded_share'] = \
+                round(100.0 * sum(digest[self.rank_by]
+                                  for digest in routed_digests) / total, 2)
+        else:
+            result['offloaded_share'] = 0.0
+
+        result['digests'] = [dict([(key, digest[key])
+                                   for key in DIGEST_RESULT_KEYS] +
+                                  [("username", rule["username"]),
+                                   ("rule_id", rule["rule_id"])])
+                             for digest, rule in zip(rule_digests, rules)]
+        result['skipped'] = skipped
+
+        return rules, owned_rules
+
+    def manage_config(self, cursor, state):
+        if state:
+            save_and_load_config(cursor,
+                                 MYSQL_QUERY_RULES.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
+
+    def split(self, check_mode, result, cursor):
+        writer_hostgroup, reader_hostgroup = self.get_hostgroups(cursor)
+        result['writer_hostgroup'] = writer_hostgroup
+        result['reader_hostgroup'] = reader_hostgroup
+
+        rules, owned_rules = self.get_rules(cursor,
+                                            writer_hostgroup,
+                                            reader_hostgroup,
+                                            result)
+        result['rules'] = rules
+
+        rules_to_create, rules_to_update, rules_to_delete, rule_diffs = \
+            get_owned_rule_changes(rules, owned_rules)
+
+        summary = (len(rules_to_create),
+                   len(rules_to_update),
+                   len(rules_to_delete))
+
+        result['changed'] = False
+        if not self.apply_rules:
+            result['msg'] = ("Generated %d rules routing reads from" +
+                             " hostgroup %d to %d") % (len(rules),
+                                                       writer_hostgroup,
+                                                       reader_hostgroup)
+            return
+
+        result['diff'] = rule_diffs
+        if not any(summary):
+            result['msg'] = ("The rules in rule_id_range are already the" +
+                             " generated rules")
+        elif not check_mode:
+            result['changed'] = replace_owned_rules(cursor,
+                                                    rules_to_create,
+                                                    rules_to_update,
+                                                    rules_to_delete)
+            result['msg'] = ("Added %d, updated %d and deleted %d rules" +
+                             " in mysql_query_rules") % summary
+            self.manage_config(cursor,
+                               result['changed'])
+        else:
+            result['changed'] = True
+            result['msg'] = ("%d rules would have been added, %d updated" +
+                             " and %d deleted in mysql_query_rules, however" +
+                             " check_mode is enabled.") % summary
+
+# ===========================================
+# Module execution.
+#
+
+
+def run_module(module):
+    cursor = proxysql_connect(module)
+
+    proxysql_rw_split = ProxySQLReadWriteSplit(module)
+    result = {}
+
+    try:
+        proxysql_rw_split.split(module.check_mode,
+                                result,
+                                cursor)
+    except (RWSplitError, ClusterSyncError, MySQLdb.Error):
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to generate read/write split rules.. %s" % e
+        )
+
+    module.exit_json(**result)
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    for name in ("snapshot",
+                 "snapshot_file"):
+        del argument_spec[name]
+    argument_spec.update(
+        dict(
+            writer_hostgroup=dict(type='int'),
+            rule_id_range=dict(required=True, type='list'),
+            rule_id_step=dict(default=10, type='int'),
+            max_rules=dict(default=20, type='int'),
+            rank_by=dict(default='sum_time', choices=['count_star',
+                                                      'sum_time']),
+            min_count_star=dict(default=1, type='int'),
+            match_with=dict(default='digest', choices=['digest',
+                                                       'match_digest']),
+            username=dict(type='str'),
+            schemaname=dict(type='str'),
+            comment=dict(default='read/write split', type='str'),
+            apply_rules=dict(default=False, type='bool'),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+from ansible.module_utils.proxysql_rules import *
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_query_rules_simulate
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Simulates query rules against captured query samples.
+description:
+   - The M(proxysql_query_rules_simulate) module runs a file of query
+     samples through a set of query rules the way the ProxySQL query
+     processor would, and reports which rules they hit, where they would be
+     routed, and how many rules and regexes they go through.  Nothing is
+     changed.
+   - The active rules are processed in rule_id order, rewriting the query
+     with I(replace_pattern) and stopping at the first matching rule with
+     I(apply) set.  A matching rule with a I(flagOUT) starts the processing
+     again from the first rule of that chain, and a query which comes back
+     to a chain it has been through unchanged is counted as looping.
+     I(match_digest) and I(match_pattern) are matched case insensitively
+     with python regexes, which cover the syntax the query processor
+     supports in practice.
+options:
+  samples_file:
+    description:
+      - The file of query samples, on the host the module runs on.  Either
+        one JSON object per line, or a comma or tab separated file with a
+        header row, such as a dump of stats_mysql_query_digest.
+      - The fields used are I(username), I(schemaname), I(client_addr),
+        I(proxy_addr), I(proxy_port), I(digest), I(digest_text), I(query),
+        and I(count) or I(count_star) for the number of times the query was
+        seen.  A rule which matches on a field a sample doesn't have doesn't
+        match it, and I(match_digest) falls back to I(query) and
+        I(match_pattern) to I(digest_text) when only one of them is given.
+    required: True
+  rules:
+    description:
+      - The rules to simulate, as a list of dicts with the same keys as the
+        options of M(proxysql_query_rules), each with a I(rule_id).  As in
+        mysql_query_rules, only the rules with I(active) set are processed.
+        When given the module doesn't connect to the admin interface.
+  config_layer:
+    description:
+      - The config layer to read the rules from when I(rules) isn't given.
+    choices: [ "memory", "runtime", "disk" ]
+    default: memory
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  The rules are read from the snapshot, without
+        connecting to the admin interface.  Can't be used with
+        I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
+'''
+
+EXAMPLES = '''
+---
+# This example dumps the query digests seen by a proxy, and simulates the
+# query rules in memory against them before they're loaded to runtime.
+
+- shell: mysql -h 127.0.0.1 -P 6032 -u admin -padmin -B -e
+         'SELECT * FROM stats_mysql_query_digest' > /tmp/digests.tsv
+
+- proxysql_query_rules_simulate:
+    login_user: 'admin'
+    login_password: 'admin'
+    samples_file: /tmp/digests.tsv
+
+# This example simulates a planned set of rules, without connecting to the
+# proxysql admin interface.
+
+- proxysql_query_rules_simulate:
+    samples_file: /tmp/samples.json
+    rules:
+      - rule_id: 10
+        active: True
+        match_digest: '^SELECT .* FOR UPDATE$'
+        destination_hostgroup: 1
+        apply: True
+      - rule_id: 20
+        active: True
+        match_digest: '^SELECT'
+        destination_hostgroup: 2
+        apply: True
+'''
+
+RETURN = '''
+stdout:
+    description: The outcome of running the samples through the rules.
+    returned: success
+    type: dict
+    "sample": {
+        "changed": false,
+        "hostgroups": [
+            {
+                "hostgroup": "2",
+                "queries": 7500,
+                "share": 75.0
+            },
+            {
+                "hostgroup": null,
+                "queries": 2000,
+                "share": 20.0
+            },
+            {
+                "hostgroup": "1",
+                "queries": 500,
+                "share": 5.0
+            }
+        ],
+        "looping_queries": 0,
+        "msg": "Simulated 10000 queries against 2 active rules",
+        "regex_evaluated": 1.95,
+        "rule_hits": [
+            {
+                "hits": 500,
+                "rule_id": 10
+            },
+            {
+                "hits": 7500,
+                "rule_id": 20
+            }
+        ],
+        "rules_evaluated": 1.95,
+        "total_queries": 10000,
+        "unique_samples": 182,
+        "unused_rules": []
+    }
+'''
+
+import csv
+import re
+import sys
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+    if module.params["rules"] is not None:
+        for rule in module.params["rules"]:
+            if get_rule_params(module, rule)["rule_id"] is None:
+                module.fail_json(
+                    msg="rule_id is required for each entry in rules"
+                )
+
+
+def get_rule_params(module, rule):
+    if not isinstance(rule, dict):
+        module.fail_json(
+            msg="each entry in rules must be a dict, got %s" % rule
+        )
+
+    unsupported_keys = [k for k in rule if k not in MYSQL_QUERY_RULES.columns]
+    if unsupported_keys:
+        module.fail_json(
+            msg=("unsupported keys in rules entry: %s" %
+                 ", ".join(sorted(unsupported_keys)))
+        )
+
+    rule_params = dict((col, None) for col in MYSQL_QUERY_RULES.columns)
+    for key, val in rule.items():
+        try:
+            rule_params[key] = \
+                MYSQL_QUERY_RULES.coerce_value(module, key, val)
+        except (TypeError, ValueError):
+            module.fail_json(
+                msg=("%s in rules entry must be of type %s" %
+                     (key, MYSQL_QUERY_RULES.column_types[key]))
+            )
+
+    return rule_params
+
+
+class ProxySQLQueryRuleSimulation(object):
+
+    def __init__(self, module):
+        self.samples_file = module.params["samples_file"]
+        self.config_layer = module.params["config_layer"].upper()
+
+        self.rules = None
+        if module.params["rules"] is not None:
+            self.rules = \
+                [dict((col, normalise_value(val))
+                      for col, val in get_rule_params(module, rule).items())
+                 for rule in module.params["rules"]]
+
+    def get_rules(self, module):
+        if self.rules is not None:
+            return self.rules
+
+        # nothing is written, so a snapshot holds all that's needed
+        snapshot = load_snapshot(module)
+        if snapshot is not None:
+            cursor = ProxySQLSnapshotCursor(snapshot)
+        else:
+            cursor = proxysql_connect(module)
+
+        return get_layer_rows(cursor,
+                              MYSQL_QUERY_RULES.config_settings,
+                              MYSQL_QUERY_RULES,
+                              self.config_layer)
+
+    def simulate(self, rules, result):
+        simulator = ProxySQLRuleSimulator(rules)
+        simulation = simulator.simulate(read_query_samples(self.samples_file))
+
+        total_queries = simulation["total_queries"]
+        result['total_queries'] = total_queries
+        result['unique_samples'] = simulation["unique_samples"]
+        result['looping_queries'] = simulation["looping_queries"]
+
+        result['rule_hits'] = \
+            [{"rule_id": rule_id, "hits": hits}
+             for rule_id, hits in sorted(simulation["rule_hits"].items())]
+        result['unused_rules'] = \
+            [get_rule_id(rule) for rule in simulator.rules
+             if get_rule_id(rule) not in simulation["rule_hits"]]
+
+        result['hostgroups'] = []
+        for hostgroup, queries in \
+                sorted(simulation["hostgroup_queries"].items(),
+                       key=lambda h: h[1], reverse=True):
+            result['hostgroups'].append(
+                {"hostgroup": hostgroup,
+                 "queries": queries,
+                 "share": round(100.0 * queries / total_queries, 2)})
+
+        if total_queries:
+            result['rules_evaluated'] = \
+                round(float(simulation["rules_evaluated"]) / total_queries, 2)
+            result['regex_evaluated'] = \
+                round(float(simulation["regex_evaluations"]) /
+                      total_queries, 2)
+        else:
+            result['rules_evaluated'] = 0.0
+            result['regex_evaluated'] = 0.0
+
+        result['changed'] = False
+        result['msg'] = ("Simulated %d queries against %d active rules" %
+                         (total_queries, len(simulator.rules)))
+
+# ===========================================
+# Module execution.
+#
+
+
+def run_module(module):
+    proxysql_simulation = ProxySQLQueryRuleSimulation(module)
+    result = {}
+
+    try:
+        rules = proxysql_simulation.get_rules(module)
+    except MySQLdb.Error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to get rules.. %s" % e
+        )
+
+    try:
+        proxysql_simulation.simulate(rules, result)
+    except re.error:
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to compile rule regex.. %s" % e
+        )
+    except (IOError, OSError, ValueError, csv.Error):
+        e = sys.exc_info()[1]
+        module.fail_json(
+            msg="unable to read samples_file.. %s" % e
+        )
+
+    module.exit_json(**result)
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    for name in ("cluster_apply",
+                 "cluster_apply_timeout"):
+        del argument_spec[name]
+    argument_spec.update(
+        dict(
+            samples_file=dict(required=True, type='path'),
+            rules=dict(type='list'),
+            config_layer=dict(default='memory', choices=['memory',
+                                                         'runtime',
+                                                         'disk'])
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+from ansible.module_utils.proxysql_rules import *
+if __name__ == '__main__':
+    main()
@@ -51,10 +51,16 @@ options:
     description:
       - Save mysql host config to sqlite db on disk to persist the
         configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   load_to_runtime:
     description:
       - Dynamically load mysql host config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   login_user:
     description:
@@ -77,6 +83,63 @@ options:
       - Specify a config file from which login_user and login_password are to
         be read
     default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
 '''
 
 EXAMPLES = '''
@@ -130,11 +193,8 @@ import sys
 
 try:
     import MySQLdb
-    import MySQLdb.cursors
 except ImportError:
-    mysqldb_found = False
-else:
-    mysqldb_found = True
+    pass
 
 # ===========================================
 # proxysql module specific support methods.
@@ -142,11 +202,7 @@ else:
 
 
 def perform_checks(module):
-    if module.params["login_port"] < 0 \
-       or module.params["login_port"] > 65535:
-        module.fail_json(
-            msg="login_port must be a valid unix port number (0-65535)"
-        )
+    perform_common_checks(module)
 
     if not module.params["writer_hostgroup"] >= 0:
         module.fail_json(
@@ -165,116 +221,60 @@ def perform_checks(module):
             msg="reader_hostgroup cannot equal writer_hostgroup"
         )
 
-    if not mysqldb_found:
-        module.fail_json(
-            msg="the python mysqldb module is required"
-        )
-
-
-def save_config_to_disk(cursor):
-    cursor.execute("SAVE MYSQL SERVERS TO DISK")
-    return True
-
-
-def load_config_to_runtime(cursor):
-    cursor.execute("LOAD MYSQL SERVERS TO RUNTIME")
-    return True
-
 
 class ProxySQLReplicationHostgroup(object):
 
     def __init__(self, module):
         self.state = module.params["state"]
-        self.save_to_disk = module.params["save_to_disk"]
-        self.load_to_runtime = module.params["load_to_runtime"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
         self.writer_hostgroup = module.params["writer_hostgroup"]
         self.reader_hostgroup = module.params["reader_hostgroup"]
         self.comment = module.params["comment"]
 
-    def check_repl_group_config(self, cursor, keys):
-        query_string = \
-            """SELECT count(*) AS `repl_groups`
-               FROM mysql_replication_hostgroups
-               WHERE writer_hostgroup = %s
-                 AND reader_hostgroup = %s"""
-
-        query_data = \
-            [self.writer_hostgroup,
-             self.reader_hostgroup]
-
-        if self.comment and not keys:
-            query_string += "\n  AND comment = %s"
-            query_data.append(self.comment)
+    def get_key_data(self):
+        return {"writer_hostgroup": self.writer_hostgroup,
+                "reader_hostgroup": self.reader_hostgroup}
 
-        cursor.execute(query_string, query_data)
-        check_count = cursor.fetchone()
-        return (int(check_count['repl_groups']) > 0)
+    def get_repl_group_diff(self, repl_group):
+        return ConfigDiff(repl_group,
+                          {"comment": self.comment or None},
+                          self.state,
+                          key_data=self.get_key_data())
 
     def get_repl_group_config(self, cursor):
-        query_string = \
-            """SELECT *
-               FROM mysql_replication_hostgroups
-               WHERE writer_hostgroup = %s
-                 AND reader_hostgroup = %s"""
-
-        query_data = \
-            [self.writer_hostgroup,
-             self.reader_hostgroup]
-
-        cursor.execute(query_string, query_data)
-        repl_group = cursor.fetchone()
-        return repl_group
+        repl_group_store = \
+            ProxySQLRowStore(cursor, MYSQL_REPLICATION_HOSTGROUPS)
+        return repl_group_store.select_one(self.get_key_data())
 
     def create_repl_group_config(self, cursor):
-        query_string = \
-            """INSERT INTO mysql_replication_hostgroups (
-               writer_hostgroup,
-               reader_hostgroup,
-               comment)
-               VALUES (%s, %s, %s)"""
-
-        query_data = \
-            [self.writer_hostgroup,
-             self.reader_hostgroup,
-             self.comment or '']
-
-        cursor.execute(query_string, query_data)
+        row_data = self.get_key_data()
+        row_data["comment"] = self.comment or ''
+        repl_group_store = \
+            ProxySQLRowStore(cursor, MYSQL_REPLICATION_HOSTGROUPS)
+        repl_group_store.insert(row_data)
         return True
 
     def update_repl_group_config(self, cursor):
-        query_string = \
-            """UPDATE mysql_replication_hostgroups
-               SET comment = %s
-               WHERE writer_hostgroup = %s
-                 AND reader_hostgroup = %s"""
-
-        query_data = \
-            [self.comment,
-             self.writer_hostgroup,
-             self.reader_hostgroup]
-
-        cursor.execute(query_string, query_data)
-        return True
+        repl_group_store = \
+            ProxySQLRowStore(cursor, MYSQL_REPLICATION_HOSTGROUPS)
+        return repl_group_store.update(self.get_key_data(),
+                                       {"comment": self.comment})
 
     def delete_repl_group_config(self, cursor):
-        query_string = \
-            """DELETE FROM mysql_replication_hostgroups
-               WHERE writer_hostgroup = %s
-                 AND reader_hostgroup = %s"""
-
-        query_data = \
-            [self.writer_hostgroup,
-             self.reader_hostgroup]
-
-        cursor.execute(query_string, query_data)
+        repl_group_store = \
+            ProxySQLRowStore(cursor, MYSQL_REPLICATION_HOSTGROUPS)
+        repl_group_store.delete(self.get_key_data())
         return True
 
     def manage_config(self, cursor, state):
         if state:
-            if self.save_to_disk:
-                save_config_to_disk(cursor)
-            if self.load_to_runtime:
-                load_config_to_runtime(cursor)
+            save_and_load_config(cursor,
+                                 MYSQL_REPLICATION_HOSTGROUPS.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
 
     def create_repl_group(self, check_mode, result, cursor):
         if not check_mode:
@@ -308,8 +308,6 @@ class ProxySQLReplicationHostgroup(object):
 
     def delete_repl_group(self, check_mode, result, cursor):
         if not check_mode:
-            result['repl_group'] = \
-                self.get_repl_group_config(cursor)
             result['changed'] = \
                 self.delete_repl_group_config(cursor)
             result['msg'] = "Deleted server from mysql_hosts"
@@ -326,72 +324,44 @@ class ProxySQLReplicationHostgroup(object):
 #
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            login_user=dict(default=None, type='str'),
-            login_password=dict(default=None, no_log=True, type='str'),
-            login_host=dict(default="127.0.0.1"),
-            login_unix_socket=dict(default=None),
-            login_port=dict(default=6032, type='int'),
-            config_file=dict(default="", type='path'),
-            writer_hostgroup=dict(required=True, type='int'),
-            reader_hostgroup=dict(required=True, type='int'),
-            comment=dict(type='str'),
-            state=dict(default='present', choices=['present',
-                                                   'absent']),
-            save_to_disk=dict(default=True, type='bool'),
-            load_to_runtime=dict(default=True, type='bool')
-        ),
-        supports_check_mode=True
-    )
+def run_module(module):
+    cursor = proxysql_connect(module)
 
-    perform_checks(module)
+    proxysql_repl_group = ProxySQLReplicationHostgroup(module)
+    result = {}
 
-    login_user = module.params["login_user"]
-    login_password = module.params["login_password"]
-    config_file = module.params["config_file"]
+    result['state'] = proxysql_repl_group.state
 
-    cursor = None
     try:
-        cursor = mysql_connect(module,
-                               login_user,
-                               login_password,
-                               config_file,
-                               cursor_class=MySQLdb.cursors.DictCursor)
+        repl_group_diff = \
+            proxysql_repl_group.get_repl_group_diff(
+                proxysql_repl_group.get_repl_group_config(cursor))
     except MySQLdb.Error:
         e = sys.exc_info()[1]
         module.fail_json(
-            msg="unable to connect to ProxySQL Admin Module.. %s" % e
+            msg="unable to get replication hostgroup.. %s" % e
         )
 
-    proxysql_repl_group = ProxySQLReplicationHostgroup(module)
-    result = {}
-
-    result['state'] = proxysql_repl_group.state
+    result['diff'] = repl_group_diff.get_diff()
 
     if proxysql_repl_group.state == "present":
         try:
-            if not proxysql_repl_group.check_repl_group_config(cursor,
-                                                               keys=True):
+            if repl_group_diff.action == "create":
                 proxysql_repl_group.create_repl_group(module.check_mode,
                                                       result,
                                                       cursor)
+            elif repl_group_diff.action == "update":
+                proxysql_repl_group.update_repl_group(module.check_mode,
+                                                      result,
+                                                      cursor)
             else:
-                if not proxysql_repl_group.check_repl_group_config(cursor,
-                                                                   keys=False):
-                    proxysql_repl_group.update_repl_group(module.check_mode,
-                                                          result,
-                                                          cursor)
-                else:
-                    result['changed'] = False
-                    result['msg'] = ("The repl group already exists in" +
-                                     " mysql_replication_hostgroups and" +
-                                     " doesn't need to be updated.")
-                    result['repl_group'] = \
-                        proxysql_repl_group.get_repl_group_config(cursor)
-
-        except MySQLdb.Error:
+                result['changed'] = False
+                result['msg'] = ("The repl group already exists in" +
+                                 " mysql_replication_hostgroups and" +
+                                 " doesn't need to be updated.")
+                result['repl_group'] = repl_group_diff.current
+
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to modify replication hostgroup.. %s" % e
@@ -399,8 +369,8 @@ def main():
 
     elif proxysql_repl_group.state == "absent":
         try:
-            if proxysql_repl_group.check_repl_group_config(cursor,
-                                                           keys=True):
+            if repl_group_diff.action == "delete":
+                result['repl_group'] = repl_group_diff.current
                 proxysql_repl_group.delete_repl_group(module.check_mode,
                                                       result,
                                                       cursor)
@@ -410,7 +380,7 @@ def main():
                                  " mysql_replication_hostgroups memory" +
                                  " configuration")
 
-        except MySQLdb.Error:
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to delete replication hostgroup.. %s" % e
@@ -418,7 +388,34 @@ def main():
 
     module.exit_json(**result)
 
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            writer_hostgroup=dict(required=True, type='int'),
+            reader_hostgroup=dict(required=True, type='int'),
+            comment=dict(type='str'),
+            state=dict(default='present', choices=['present',
+                                                   'absent']),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
 from ansible.module_utils.basic import *
-from ansible.module_utils.mysql import *
+from ansible.module_utils.proxysql import *
 if __name__ == '__main__':
     main()
@@ -74,10 +74,16 @@ options:
     description:
       - Save mysql host config to sqlite db on disk to persist the
         configuration.
+      - Set to C(deferred) to only record that the config needs saving, and
+        save it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   load_to_runtime:
     description:
       - Dynamically load mysql host config to runtime memory.
+      - Set to C(deferred) to only record that the config needs loading, and
+        load it once from a M(proxysql_flush_config) task.
+    choices: [ "yes", "no", "deferred" ]
     default: True
   login_user:
     description:
@@ -100,6 +106,63 @@ options:
       - Specify a config file from which login_user and login_password are to
         be read
     default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to make
+        the same change on.  The module runs against each of them
+        concurrently in place of I(login_host) and I(login_port), and returns
+        the result for each one in I(login_hosts).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to run against at once.
+    default: 10
+  login_hosts_fail_fast:
+    description:
+      - Stop starting runs against the remaining I(login_hosts) once one of
+        them has failed, rather than carrying on with the rest.  Either way
+        the module fails if any of them failed.
+    default: False
+  cluster_apply:
+    description:
+      - Make the change on this ProxySQL Cluster node only, and once it's
+        loaded to runtime wait until every peer listed in
+        stats_proxysql_servers_checksums reports the same checksum for the
+        config section, so the cluster's own sync propagates the change to
+        the other nodes.  Can't be used with I(login_hosts).
+    default: False
+  cluster_apply_timeout:
+    description:
+      - How many seconds to wait for the peers to sync with I(cluster_apply)
+        before failing.
+    default: 60
+  snapshot:
+    description:
+      - The I(proxysql) fact gathered by M(proxysql_facts) from the same
+        admin interface.  Only used in check mode, where existing config is
+        looked up in the snapshot instead of being queried and the module
+        doesn't connect to the admin interface at all.  Outside check mode
+        the snapshot is ignored, as it may be out of date.  Can't be used
+        with I(login_hosts).
+    default: None
+  snapshot_file:
+    description:
+      - Read the I(snapshot) from a file instead, either JSON holding the
+        I(proxysql) fact (such as an Ansible jsonfile fact cache entry), or
+        an SQLite database with the memory layer tables under their own
+        names and the runtime layer tables prefixed with C(runtime_).  The
+        file is read on the host the module runs on.  Mutually exclusive
+        with I(snapshot).
+    default: None
 '''
 
 EXAMPLES = '''
@@ -160,11 +223,8 @@ import sys
 
 try:
     import MySQLdb
-    import MySQLdb.cursors
 except ImportError:
-    mysqldb_found = False
-else:
-    mysqldb_found = True
+    pass
 
 # ===========================================
 # proxysql module specific support methods.
@@ -172,11 +232,7 @@ else:
 
 
 def perform_checks(module):
-    if module.params["login_port"] < 0 \
-       or module.params["login_port"] > 65535:
-        module.fail_json(
-            msg="login_port must be a valid unix port number (0-65535)"
-        )
+    perform_common_checks(module)
 
     if module.params["interval_ms"] < 100 \
        or module.params["interval_ms"] > 100000000:
@@ -184,29 +240,15 @@ def perform_checks(module):
             msg="interval_ms must between 100ms & 100000000ms"
         )
 
-    if not mysqldb_found:
-        module.fail_json(
-            msg="the python mysqldb module is required"
-        )
-
-
-def save_config_to_disk(cursor):
-    cursor.execute("SAVE SCHEDULER TO DISK")
-    return True
-
-
-def load_config_to_runtime(cursor):
-    cursor.execute("LOAD SCHEDULER TO RUNTIME")
-    return True
-
 
 class ProxySQLSchedule(object):
 
     def __init__(self, module):
         self.state = module.params["state"]
         self.force_delete = module.params["force_delete"]
-        self.save_to_disk = module.params["save_to_disk"]
-        self.load_to_runtime = module.params["load_to_runtime"]
+        self.save_to_disk = get_config_mode(module, "save_to_disk")
+        self.load_to_runtime = get_config_mode(module, "load_to_runtime")
+        self.deferred_file = get_deferred_config_file(module)
         self.active = module.params["active"]
         self.interval_ms = module.params["interval_ms"]
         self.filename = module.params["filename"]
@@ -221,105 +263,44 @@ class ProxySQLSchedule(object):
         self.config_data = dict((k, module.params[k])
                                 for k in (config_data_keys))
 
-    def check_schedule_config(self, cursor):
-        query_string = \
-            """SELECT count(*) AS `schedule_count`
-               FROM scheduler
-               WHERE active = %s
-                 AND interval_ms = %s
-                 AND filename = %s"""
-
-        query_data = \
-            [self.active,
-             self.interval_ms,
-             self.filename]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                query_data.append(val)
-                query_string += "\n  AND " + col + " = %s"
-
-        cursor.execute(query_string, query_data)
-        check_count = cursor.fetchone()
-        return int(check_count['schedule_count'])
+    def get_schedule_data(self):
+        schedule_data = dict(self.config_data)
+        schedule_data.update({"active": self.active,
+                              "interval_ms": self.interval_ms,
+                              "filename": self.filename})
+        return schedule_data
+
+    def get_schedule_diff(self, schedules):
+        if schedules:
+            return ConfigDiff(schedules[0],
+                              self.get_schedule_data(),
+                              self.state)
+        else:
+            return ConfigDiff(None,
+                              self.get_schedule_data(),
+                              self.state)
 
     def get_schedule_config(self, cursor):
-        query_string = \
-            """SELECT *
-               FROM scheduler
-               WHERE active = %s
-                 AND interval_ms = %s
-                 AND filename = %s"""
-
-        query_data = \
-            [self.active,
-             self.interval_ms,
-             self.filename]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                query_data.append(val)
-                query_string += "\n  AND " + col + " = %s"
-
-        cursor.execute(query_string, query_data)
-        schedule = cursor.fetchall()
-        return schedule
+        return ProxySQLRowStore(cursor,
+                                SCHEDULER).select(self.get_schedule_data())
 
     def create_schedule_config(self, cursor):
-        query_string = \
-            """INSERT INTO scheduler (
-               active,
-               interval_ms,
-               filename"""
-
-        cols = 0
-        query_data = \
-            [self.active,
-             self.interval_ms,
-             self.filename]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                cols += 1
-                query_data.append(val)
-                query_string += ",\n" + col
-
-        query_string += \
-            (")\n" +
-             "VALUES (%s, %s, %s" +
-             ", %s" * cols +
-             ")")
-
-        cursor.execute(query_string, query_data)
+        ProxySQLRowStore(cursor, SCHEDULER).insert(self.get_schedule_data())
         return True
 
     def delete_schedule_config(self, cursor):
-        query_string = \
-            """DELETE FROM scheduler
-               WHERE active = %s
-                 AND interval_ms = %s
-                 AND filename = %s"""
-
-        query_data = \
-            [self.active,
-             self.interval_ms,
-             self.filename]
-
-        for col, val in self.config_data.iteritems():
-            if val is not None:
-                query_data.append(val)
-                query_string += "\n  AND " + col + " = %s"
-
-        cursor.execute(query_string, query_data)
-        check_count = cursor.rowcount
-        return True, int(check_count)
+        check_count = \
+            ProxySQLRowStore(cursor,
+                             SCHEDULER).delete(self.get_schedule_data())
+        return True, check_count
 
     def manage_config(self, cursor, state):
         if state:
-            if self.save_to_disk:
-                save_config_to_disk(cursor)
-            if self.load_to_runtime:
-                load_config_to_runtime(cursor)
+            save_and_load_config(cursor,
+                                 SCHEDULER.config_settings,
+                                 self.save_to_disk,
+                                 self.load_to_runtime,
+                                 self.deferred_file)
 
     def create_schedule(self, check_mode, result, cursor):
         if not check_mode:
@@ -338,9 +319,7 @@ class ProxySQLSchedule(object):
 
     def delete_schedule(self, check_mode, result, cursor):
         if not check_mode:
-            result['schedules'] = \
-                self.get_schedule_config(cursor)
-            result['changed'] = \
+            result['changed'], result['rows_affected'] = \
                 self.delete_schedule_config(cursor)
             result['msg'] = "Deleted schedule from scheduler"
             self.manage_config(cursor,
@@ -356,61 +335,30 @@ class ProxySQLSchedule(object):
 #
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            login_user=dict(default=None, type='str'),
-            login_password=dict(default=None, no_log=True, type='str'),
-            login_host=dict(default="127.0.0.1"),
-            login_unix_socket=dict(default=None),
-            login_port=dict(default=6032, type='int'),
-            config_file=dict(default="", type='path'),
-            active=dict(default=True, type='bool'),
-            interval_ms=dict(default=10000, type='int'),
-            filename=dict(required=True, type='str'),
-            arg1=dict(type='str'),
-            arg2=dict(type='str'),
-            arg3=dict(type='str'),
-            arg4=dict(type='str'),
-            arg5=dict(type='str'),
-            comment=dict(type='str'),
-            state=dict(default='present', choices=['present',
-                                                   'absent']),
-            force_delete=dict(default=False, type='bool'),
-            save_to_disk=dict(default=True, type='bool'),
-            load_to_runtime=dict(default=True, type='bool')
-        ),
-        supports_check_mode=True
-    )
+def run_module(module):
+    cursor = proxysql_connect(module)
 
-    perform_checks(module)
+    proxysql_schedule = ProxySQLSchedule(module)
+    result = {}
 
-    login_user = module.params["login_user"]
-    login_password = module.params["login_password"]
-    config_file = module.params["config_file"]
+    result['state'] = proxysql_schedule.state
+    result['filename'] = proxysql_schedule.filename
 
-    cursor = None
     try:
-        cursor = mysql_connect(module,
-                               login_user,
-                               login_password,
-                               config_file,
-                               cursor_class=MySQLdb.cursors.DictCursor)
+        existing_schedules = \
+            list(proxysql_schedule.get_schedule_config(cursor))
     except MySQLdb.Error:
         e = sys.exc_info()[1]
         module.fail_json(
-            msg="unable to connect to ProxySQL Admin Module.. %s" % e
+            msg="unable to get schedules.. %s" % e
         )
 
-    proxysql_schedule = ProxySQLSchedule(module)
-    result = {}
-
-    result['state'] = proxysql_schedule.state
-    result['filename'] = proxysql_schedule.filename
-
     if proxysql_schedule.state == "present":
+        result['diff'] = \
+            proxysql_schedule.get_schedule_diff(existing_schedules).get_diff()
+
         try:
-            if not proxysql_schedule.check_schedule_config(cursor) > 0:
+            if not existing_schedules:
                 proxysql_schedule.create_schedule(module.check_mode,
                                                   result,
                                                   cursor)
@@ -418,20 +366,22 @@ def main():
                 result['changed'] = False
                 result['msg'] = ("The schedule already exists and doesn't" +
                                  " need to be updated.")
-                result['schedules'] = \
-                    proxysql_schedule.get_schedule_config(cursor)
-        except MySQLdb.Error:
+                result['schedules'] = existing_schedules
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to modify schedule.. %s" % e
             )
 
     elif proxysql_schedule.state == "absent":
+        result['diff'] = [{'before': schedule, 'after': {}}
+                          for schedule in existing_schedules]
+
         try:
-            existing_schedules = \
-                proxysql_schedule.check_schedule_config(cursor)
-            if existing_schedules > 0:
-                if existing_schedules == 1 or proxysql_schedule.force_delete:
+            if len(existing_schedules) > 0:
+                if len(existing_schedules) == 1 or \
+                        proxysql_schedule.force_delete:
+                    result['schedules'] = existing_schedules
                     proxysql_schedule.delete_schedule(module.check_mode,
                                                       result,
                                                       cursor)
@@ -444,7 +394,7 @@ def main():
                 result['changed'] = False
                 result['msg'] = ("The schedule is already absent from the" +
                                  " memory configuration")
-        except MySQLdb.Error:
+        except (ClusterSyncError, MySQLdb.Error):
             e = sys.exc_info()[1]
             module.fail_json(
                 msg="unable to remove schedule.. %s" % e
@@ -452,7 +402,41 @@ def main():
 
     module.exit_json(**result)
 
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    argument_spec.update(
+        dict(
+            active=dict(default=True, type='bool'),
+            interval_ms=dict(default=10000, type='int'),
+            filename=dict(required=True, type='str'),
+            arg1=dict(type='str'),
+            arg2=dict(type='str'),
+            arg3=dict(type='str'),
+            arg4=dict(type='str'),
+            arg5=dict(type='str'),
+            comment=dict(type='str'),
+            state=dict(default='present', choices=['present',
+                                                   'absent']),
+            force_delete=dict(default=False, type='bool'),
+            save_to_disk=dict(default='yes', type='str'),
+            load_to_runtime=dict(default='yes', type='str')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    if module.params["login_hosts"]:
+        run_on_login_hosts(module, run_module)
+    else:
+        run_module(module)
+
 from ansible.module_utils.basic import *
-from ansible.module_utils.mysql import *
+from ansible.module_utils.proxysql import *
 if __name__ == '__main__':
     main()
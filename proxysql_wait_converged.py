@@ -0,0 +1,470 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+DOCUMENTATION = '''
+---
+module: proxysql_wait_converged
+version_added: "2.2"
+author: "Ben Mildren (@bmildren)"
+short_description: Waits until ProxySQL nodes are running the same config.
+description:
+   - The M(proxysql_wait_converged) module polls the runtime config checksums
+     of a set of ProxySQL nodes until they all match, or fails once
+     I(timeout) has passed.
+   - The first admin interface, I(login_host) or the first of
+     I(login_hosts), is the reference which the other nodes are compared
+     against, so it should be the node the config was pushed to.  Its
+     stats_proxysql_servers_checksums are checked as well where available,
+     so with ProxySQL Cluster the peers it knows of are waited for without
+     having to be listed.
+   - The nodes are polled concurrently.  The wait between polls starts
+     short and doubles while none of the checksums change, dropping back
+     whenever one does.
+options:
+  config_settings:
+    description:
+      - The config sections which need to match, either a single section or
+        a list of sections.  Defaults to every section ProxySQL keeps a
+        checksum for.
+    choices: [ "MYSQL USERS", "MYSQL SERVERS", "MYSQL QUERY RULES",
+               "MYSQL VARIABLES", "ADMIN VARIABLES", "PROXYSQL SERVERS" ]
+  timeout:
+    description:
+      - How many seconds to wait for the nodes to converge before failing.
+    default: 60
+  max_poll_interval:
+    description:
+      - The longest wait, in seconds, between polls of the nodes.
+    default: 5
+  login_user:
+    description:
+      - The username used to authenticate to ProxySQL admin interface
+    default: None
+  login_password:
+    description:
+      - The password used to authenticate to ProxySQL admin interface
+    default: None
+  login_host:
+    description:
+      - The host used to connect to ProxySQL admin interface
+    default: '127.0.0.1'
+  login_port:
+    description:
+      - The port used to connect to ProxySQL admin interface
+    default: 6032
+  config_file:
+    description:
+      - Specify a config file from which login_user and login_password are to
+        be read
+    default: ''
+  connection_broker:
+    description:
+      - Run the statements through a local connection broker, which keeps the
+        authenticated admin interface sessions open between tasks instead of
+        connecting for every task.  The broker is started on the first use
+        and exits after being idle for 10 minutes.  If it can't be started
+        the module connects directly.
+    default: False
+  login_hosts:
+    description:
+      - A list of admin interfaces, given as C(host) or C(host:port), to poll
+        in place of I(login_host) and I(login_port).  A host without a port
+        uses I(login_port).
+    default: None
+  login_hosts_concurrency:
+    description:
+      - The maximum number of I(login_hosts) to poll at once.
+    default: 10
+'''
+
+EXAMPLES = '''
+---
+# This example waits for the query rules pushed to the first node to be
+# running on the other two before carrying on with the play.
+
+- proxysql_wait_converged:
+    login_user: 'admin'
+    login_password: 'admin'
+    login_hosts:
+      - 10.0.1.10
+      - 10.0.1.11
+      - 10.0.1.12
+    config_settings: "MYSQL QUERY RULES"
+    timeout: 30
+
+# This example waits for every peer of a ProxySQL Cluster node to sync the
+# whole of its config, using the node's own cluster checksum stats.
+
+- proxysql_wait_converged:
+    config_file: '~/proxysql.cnf'
+'''
+
+RETURN = '''
+stdout:
+    description: The reference checksums and how long each node took to
+                 match them.
+    returned: On success, or when the nodes haven't converged in time
+    type: dict
+    "sample": {
+        "changed": false,
+        "checksums": {
+            "mysql_query_rules": "0x8B3F2A1E0C6D4F57"
+        },
+        "converged": true,
+        "elapsed": 1.5218,
+        "msg": "All 3 nodes converged after 1.52 seconds",
+        "nodes": [
+            {
+                "converged": true,
+                "latency": 0.0042,
+                "login_host": "10.0.1.10",
+                "login_port": 6032,
+                "lagging": [],
+                "source": "admin"
+            },
+            {
+                "converged": true,
+                "latency": 1.5218,
+                "login_host": "10.0.1.11",
+                "login_port": 6032,
+                "lagging": [],
+                "source": "admin"
+            },
+            {
+                "converged": true,
+                "latency": 0.7561,
+                "login_host": "10.0.1.12",
+                "login_port": 6032,
+                "lagging": [],
+                "source": "admin"
+            }
+        ]
+    }
+'''
+
+import sys
+import time
+
+try:
+    import MySQLdb
+except ImportError:
+    pass
+
+MIN_POLL_INTERVAL = 0.25
+
+# ===========================================
+# proxysql module specific support methods.
+#
+
+
+def perform_checks(module):
+    perform_common_checks(module)
+
+    for config_settings in get_config_settings(module):
+        if config_settings not in CLUSTER_CHECKSUM_NAMES:
+            module.fail_json(
+                msg=("config_settings must be one of: %s, got %s" %
+                     (", ".join(get_checksummed_config_settings()),
+                      config_settings))
+            )
+
+    if module.params["timeout"] < 0:
+        module.fail_json(
+            msg="timeout must be 0 or more seconds"
+        )
+
+    if module.params["max_poll_interval"] < MIN_POLL_INTERVAL:
+        module.fail_json(
+            msg="max_poll_interval must be at least %s seconds" %
+            MIN_POLL_INTERVAL
+        )
+
+
+def get_checksummed_config_settings():
+    return [config_settings for config_settings in CONFIG_SETTINGS_ORDER
+            if config_settings in CLUSTER_CHECKSUM_NAMES]
+
+
+def get_config_settings(module):
+    if module.params["config_settings"] is None:
+        return get_checksummed_config_settings()
+    else:
+        return module.params["config_settings"]
+
+
+def get_nodes(module):
+    if module.params["login_hosts"] is not None:
+        login_hosts = get_login_hosts(module)
+    else:
+        login_hosts = [{"login_host": module.params["login_host"],
+                        "login_port": module.params["login_port"],
+                        "login_unix_socket":
+                            module.params["login_unix_socket"]}]
+
+    return [ProxySQLNode(module, login_params)
+            for login_params in login_hosts]
+
+
+def get_node_name(login_host, login_port):
+    return "%s:%s" % (login_host, login_port)
+
+
+class ProxySQLNode(object):
+
+    def __init__(self, module, login_params):
+        self.module = ProxySQLLoginHostModule(module, login_params)
+        self.login_host = login_params["login_host"]
+        self.login_port = login_params["login_port"]
+        self.cursor = None
+
+    def connect(self):
+        if self.cursor is None:
+            try:
+                self.cursor = proxysql_connect(self.module)
+            except ProxySQLLoginHostExit:
+                e = sys.exc_info()[1]
+                raise MySQLdb.OperationalError(str(e))
+        return self.cursor
+
+    def get_checksums(self, checksum_names):
+        query_string = \
+            """SELECT name, checksum
+               FROM runtime_checksums_values"""
+
+        cursor = self.connect()
+        cursor.execute(query_string)
+        return dict((row["name"], row["checksum"])
+                    for row in cursor.fetchall()
+                    if row["name"] in checksum_names)
+
+    def get_peer_checksums(self, checksum_names):
+        peer_checksums = {}
+
+        query_string = \
+            """SELECT hostname, port, name, checksum
+               FROM stats_proxysql_servers_checksums"""
+
+        try:
+            self.cursor.execute(query_string)
+        except MySQLdb.Error:
+            # older ProxySQL releases don't have cluster support
+            return peer_checksums
+
+        for row in self.cursor.fetchall():
+            if row["name"] in checksum_names:
+                peer_name = get_node_name(row["hostname"], row["port"])
+                peer = peer_checksums.setdefault(peer_name, {
+                    "login_host": row["hostname"],
+                    "login_port": int(row["port"]),
+                    "checksums": {}})
+                peer["checksums"][row["name"]] = row["checksum"]
+
+        return peer_checksums
+
+    def poll(self, checksum_names, reference):
+        node_poll = {"checksums": None, "peers": {}, "error": None}
+
+        try:
+            node_poll["checksums"] = self.get_checksums(checksum_names)
+            if reference:
+                node_poll["peers"] = self.get_peer_checksums(checksum_names)
+        except MySQLdb.Error:
+            node_poll["error"] = str(sys.exc_info()[1])
+            self.cursor = None
+
+        return node_poll
+
+
+class ProxySQLConvergence(object):
+
+    def __init__(self, module):
+        self.config_settings = get_config_settings(module)
+        self.checksum_names = [CLUSTER_CHECKSUM_NAMES[config_settings]
+                               for config_settings in self.config_settings]
+        self.nodes = get_nodes(module)
+        self.concurrency = module.params["login_hosts_concurrency"]
+        self.timeout = module.params["timeout"]
+        self.max_poll_interval = module.params["max_poll_interval"]
+        self.node_results = {}
+        self.reference = {}
+
+    def poll_nodes(self):
+        reference_node = self.nodes[0]
+
+        def poll_node(node):
+            return node.poll(self.checksum_names, node is reference_node)
+
+        node_polls = run_in_threads(poll_node, self.nodes, self.concurrency)
+
+        polled = []
+        for node, node_poll in zip(self.nodes, node_polls):
+            polled.append((get_node_name(node.login_host, node.login_port),
+                           {"login_host": node.login_host,
+                            "login_port": node.login_port,
+                            "source": "admin",
+                            "checksums": node_poll["checksums"],
+                            "error": node_poll["error"]}))
+
+        # peers the reference node knows of through ProxySQL Cluster, which
+        # weren't polled directly
+        polled_names = set(node_name for node_name, node_state in polled)
+        for peer_name, peer in sorted(node_polls[0]["peers"].items()):
+            if peer_name not in polled_names:
+                peer["source"] = "cluster_stats"
+                peer["error"] = None
+                polled.append((peer_name, peer))
+
+        return node_polls[0]["checksums"] or {}, polled
+
+    def get_lagging(self, node_state):
+        checksums = node_state["checksums"] or {}
+
+        lagging = []
+        for config_settings, checksum_name in zip(self.config_settings,
+                                                  self.checksum_names):
+            # the cluster stats only cover the sections the peer syncs
+            if node_state["source"] == "cluster_stats" and \
+                    checksum_name not in checksums:
+                continue
+            if checksum_name not in self.reference or \
+                    checksums.get(checksum_name) != \
+                    self.reference[checksum_name]:
+                lagging.append(config_settings)
+        return lagging
+
+    def update_node_results(self, polled, elapsed):
+        progressed = False
+
+        for node_name, node_state in polled:
+            node_result = self.node_results.setdefault(node_name, {
+                "login_host": node_state["login_host"],
+                "login_port": node_state["login_port"],
+                "source": node_state["source"],
+                "converged": False,
+                "latency": None,
+                "checksums": None})
+
+            if node_state["checksums"] != node_result["checksums"]:
+                progressed = True
+            node_result["checksums"] = node_state["checksums"]
+
+            node_result["lagging"] = self.get_lagging(node_state)
+
+            if node_state["error"]:
+                node_result["error"] = node_state["error"]
+            else:
+                node_result.pop("error", None)
+
+            if node_result["lagging"]:
+                node_result["converged"] = False
+                node_result["latency"] = None
+            elif not node_result["converged"]:
+                node_result["converged"] = True
+                node_result["latency"] = round(elapsed, 4)
+
+        return progressed
+
+    def wait(self):
+        start_time = time.time()
+        deadline = start_time + self.timeout
+        poll_interval = MIN_POLL_INTERVAL
+
+        while True:
+            self.reference, polled = self.poll_nodes()
+            progressed = self.update_node_results(polled,
+                                                  time.time() - start_time)
+
+            if all(node_result["converged"]
+                   for node_result in self.node_results.values()):
+                return True, time.time() - start_time
+
+            now = time.time()
+            if now >= deadline:
+                return False, now - start_time
+
+            if progressed:
+                poll_interval = MIN_POLL_INTERVAL
+            time.sleep(min(poll_interval, deadline - now))
+            poll_interval = min(poll_interval * 2, self.max_poll_interval)
+
+    def get_nodes_result(self):
+        nodes_result = []
+        for node_name, node_result in sorted(self.node_results.items()):
+            node_result = dict(node_result)
+            del node_result["checksums"]
+            nodes_result.append(node_result)
+        return nodes_result
+
+# ===========================================
+# Module execution.
+#
+
+
+def main():
+    argument_spec = proxysql_common_argument_spec()
+    for name in ("login_hosts_fail_fast",
+                 "cluster_apply",
+                 "cluster_apply_timeout",
+                 "snapshot",
+                 "snapshot_file"):
+        del argument_spec[name]
+    argument_spec.update(
+        dict(
+            config_settings=dict(type='list'),
+            timeout=dict(default=60, type='int'),
+            max_poll_interval=dict(default=5, type='float')
+        )
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    perform_checks(module)
+
+    convergence = ProxySQLConvergence(module)
+    converged, elapsed = convergence.wait()
+
+    result = {}
+    result['changed'] = False
+    result['converged'] = converged
+    result['elapsed'] = round(elapsed, 4)
+    result['checksums'] = convergence.reference
+    result['nodes'] = convergence.get_nodes_result()
+
+    if not converged:
+        lagging = ["%s:%s" % (node_result['login_host'],
+                              node_result['login_port'])
+                   for node_result in result['nodes']
+                   if not node_result['converged']]
+        result['msg'] = ("%d of %d nodes hadn't converged within %d" +
+                         " seconds: %s") % (len(lagging),
+                                            len(result['nodes']),
+                                            convergence.timeout,
+                                            ", ".join(lagging))
+        module.fail_json(**result)
+
+    result['msg'] = ("All %d nodes converged after %.2f seconds" %
+                     (len(result['nodes']), elapsed))
+    module.exit_json(**result)
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.proxysql import *
+if __name__ == '__main__':
+    main()